@@ -1,11 +1,21 @@
+import io
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
-from random import randint
+from random import getstate, randint, random
+from threading import Event
 
-from tic_tac_toe import core, minimax
+from tic_tac_toe import batch, book, core, engine, evaluate, mcts, minimax, playout, pns, tablebase, threats
+from tic_tac_toe.arena import Arena, SHARE_BOARDS, SHARE_SYMMETRIES
+from tic_tac_toe.budget import Budget, BudgetExceeded
 
 
 DEPTH = 4
 
+GEOMETRIES = [core.DEFAULT_GEOMETRY, core.get_geometry(4, 3), core.get_geometry(6, 4)]
+
 
 class TestMinimax(unittest.TestCase):
 
@@ -18,13 +28,718 @@ class TestMinimax(unittest.TestCase):
             board = children[randint(0, len(children) - 1)]
             self._test_minimax(board)
 
+        # X's first child in search order loses, so PVS has no null
+        # window for the next one.
+        board = core.EMPTY_BOARD
+        for move in [1, 0, 3, 2, 10, 4, 11, 5, 15, 7, 17, 9, 18, 14, 21, 19, 23, 22]:
+            board = core.add_move(move, board)
+        self._test_minimax(board)
+
+    def test_minimax_geometries(self):
+        for geometry in GEOMETRIES[1:]:
+            board = core.EMPTY_BOARD
+            while geometry.check_outcome(board) is None:
+                val = minimax.minimax(minimax.Node(board, geometry), minimax.Stats(), depth=2)
+                self.assertEqual(minimax.test_minimax(board, 2, geometry), val)
+
+                children = geometry.get_children(board)
+                board = children[randint(0, len(children) - 1)]
+
+    def test_cancel(self):
+        cancel = Event()
+        cancel.set()
+        board = core.add_move(core.MID_INDEX, core.EMPTY_BOARD)
+        with self.assertRaises(BudgetExceeded):
+            minimax.Tree().get_next_board(board, cancel=cancel)
+        with self.assertRaises(BudgetExceeded):
+            mcts.Tree().get_next_board(board, cancel=cancel)
+
+    def test_parallel_minimax(self):
+        pool = minimax.Pool(2, core.DEFAULT_GEOMETRY)
+        board = core.EMPTY_BOARD
+        for _ in range(core.OFFSET // 2):
+            children = core.get_children(board)
+            board = children[randint(0, len(children) - 1)]
+            if core.check_outcome(board) is not None:
+                break
+
+            best_child, val = minimax.parallel_minimax(minimax.Node(board), minimax.Stats(), pool, depth=2)
+            serial_best_child, serial_val = minimax.minimax(minimax.Node(board), minimax.Stats(), depth=2,
+                                                            get_best_child=True)
+            self.assertEqual(serial_best_child.get_board(), best_child.get_board())
+            self.assertEqual(serial_val, val)
+            self.assertEqual(minimax.test_minimax(board, 2), val)
+
+        # Workers of a cancelled search can't be stopped, but the bounds
+        # they write don't reach the next search. Here two slow workers
+        # of a cancelled search hold up the pool, and then workers with a
+        # won board write every slot during the next search.
+        cancel = Event()
+        cancel.set()
+        budget = Budget()
+        budget.start(cancel)
+        with self.assertRaises(BudgetExceeded):
+            minimax.parallel_minimax(minimax.Node(core.EMPTY_BOARD), minimax.Stats(), pool, depth=4, budget=budget)
+        won_board = core.EMPTY_BOARD
+        for move in [0, 5, 1, 6, 2, 7, 3, 8, 4]:
+            won_board = core.add_move(move, won_board)
+        generation = pool.generation.value
+        for index, board, depth in [(1, core.EMPTY_BOARD, 5)] * 2 + [(i, won_board, 1) for i in range(1, core.OFFSET)]:
+            pool.executor.submit(minimax.search_child, board, core.SIZE, core.DEFAULT_GEOMETRY.win_length, index,
+                                 depth, True, False, generation)
+        board = core.add_move(12, core.add_move(0, core.EMPTY_BOARD))
+        best_child, val = minimax.parallel_minimax(minimax.Node(board), minimax.Stats(), pool, depth=3)
+        serial_best_child, serial_val = minimax.minimax(minimax.Node(board), minimax.Stats(), depth=3,
+                                                        get_best_child=True)
+        self.assertEqual(serial_best_child.get_board(), best_child.get_board())
+        self.assertEqual(serial_val, val)
+        pool.shutdown()
+
+    def test_threats(self):
+        # X to move can make two wins at once by playing in the corner
+        # between its row and its column.
+        board = core.EMPTY_BOARD
+        for move in [0, 6, 1, 7, 2, 8, 9, 11, 14, 12, 19, 21]:
+            board = core.add_move(move, board)
+
+        self.assertEqual(threats.Threats(wins=0, blocks=0, double_threats=1 << 4), threats.get_threats(board))
+        self.assertEqual([4], threats.get_forced_moves(board))
+
+        stats = minimax.Stats()
+        self.assertEqual(core.INF, minimax.minimax(minimax.Node(board), stats, depth=DEPTH, threats=True))
+        self.assertLessEqual(stats.visited, 10)
+
+        # O to move must block.
+        board = core.add_move(4, board)
+        self.assertEqual([3, 24], threats.get_forced_moves(board))
+
     def _test_minimax(self, board):
         val = minimax.minimax(minimax.Node(board), minimax.Stats(), depth=DEPTH)
         self.assertEqual(minimax.test_minimax(board, DEPTH), val)
+
+        table = minimax.TranspositionTable()
+        self.assertEqual(val, minimax.minimax(minimax.Node(board), minimax.Stats(), depth=DEPTH, table=table))
+
+        self.assertEqual(val, minimax.pvs(minimax.Node(board), minimax.Stats(), depth=DEPTH))
+        self.assertEqual(val, minimax.pvs(minimax.Node(board), minimax.Stats(), depth=DEPTH,
+                                          table=minimax.TranspositionTable(), ordering=minimax.MoveOrdering()))
+
         # noinspection PyUnreachableCode
         if __debug__:
             print(f'Val: {val}')
 
+    def test_ponder(self):
+        # Pondering on the opponent's turn adds nodes and table entries,
+        # and the search after the opponent's move uses them instead of
+        # starting over.
+        tree = minimax.Tree(budget=Budget(nodes=500), use_pvs=True)
+        board = tree.get_next_board(core.EMPTY_BOARD)
+        arena = tree.get_root().get_arena()
+        nodes, entries = len(arena), len(tree.get_table())
+        cancel = Event()
+
+        def stop_pondering(stats):
+            if stats.depth >= 3:
+                cancel.set()
+
+        tree.ponder(board, cancel, stop_pondering)
+        self.assertEqual(board, tree.get_root().get_board())
+        self.assertGreater(len(arena), nodes)
+        self.assertGreater(len(tree.get_table()), entries)
+
+        reply = minimax.ordered_children(tree.get_root(), tree.get_table())[0].get_board()
+        stats = []
+        tree.get_next_board(reply, progress=stats.append)
+        fresh_stats = []
+        minimax.Tree(budget=Budget(nodes=500), use_pvs=True).get_next_board(reply, progress=fresh_stats.append)
+        self.assertGreater(stats[-1].table_hits, 0)
+        self.assertLess(stats[-1].created, fresh_stats[-1].created)
+
+    def test_iterative_deepening(self):
+        board = core.EMPTY_BOARD
+        for _ in range(core.OFFSET // 2):
+            children = core.get_children(board)
+            board = children[randint(0, len(children) - 1)]
+            if core.check_outcome(board) is not None:
+                break
+
+            tree = minimax.Tree(budget=Budget(nodes=500))
+            self.assertIn(tree.get_next_board(board), core.get_children(board))
+
+            tree = minimax.Tree(budget=Budget(nodes=500), use_pvs=True)
+            self.assertIn(tree.get_next_board(board), core.get_children(board))
+
+
+class TestMcts(unittest.TestCase):
+
+    def test_budget(self):
+        stats = mcts.Stats()
+        mcts.mcts(mcts.Node(core.EMPTY_BOARD), stats, Budget(nodes=200))
+        self.assertEqual(200, stats.iterations)
+        self.assertFalse(stats.stopped_early)
+
+        # A stopped budget is run afresh by the next search.
+        budget = Budget(nodes=200)
+        budget.start()
+        budget.stop()
+        self.assertTrue(budget.exceeded(0))
+        stats = mcts.Stats()
+        mcts.mcts(mcts.Node(core.EMPTY_BOARD), stats, budget)
+        self.assertEqual(200, stats.iterations)
+
+        # A forced move (X's win) is played without using up the
+        # budget.
+        geometry = core.get_geometry(3)
+        board = core.EMPTY_BOARD
+        for move in [0, 4, 1, 8]:
+            board = geometry.add_move(move, board)
+        stats = mcts.Stats()
+        best_child = mcts.mcts(mcts.Node(board, geometry), stats, Budget(seconds=60))
+        self.assertTrue(stats.stopped_early)
+        self.assertEqual(2, geometry.get_move(board, best_child.board()))
+
+    def test_random_game(self):
+        # Uniformly random 3x3 games: X wins 58.5%, O wins 28.8%.
+        geometry = core.get_geometry(3)
+        outcomes = [mcts.random_game(core.EMPTY_BOARD, geometry) for _ in range(10000)]
+        self.assertAlmostEqual(0.585, outcomes.count(core.INF) / len(outcomes), delta=0.02)
+        self.assertAlmostEqual(0.288, outcomes.count(core.NEG_INF) / len(outcomes), delta=0.02)
+
+        for geometry in GEOMETRIES:
+            board = core.EMPTY_BOARD
+            while geometry.count_empty(board) > 1 or geometry.check_outcome(board) is not None:
+                if geometry.check_outcome(board) is not None:
+                    board = core.EMPTY_BOARD
+                children = geometry.get_children(board)
+                board = children[randint(0, len(children) - 1)]
+            self.assertEqual(geometry.check_outcome(geometry.get_children(board)[0]),
+                             mcts.random_game(board, geometry))
+
+    @unittest.skipUnless(batch.is_available(), 'needs NumPy')
+    def test_batch_rollouts(self):
+        geometry = core.get_geometry(3)
+        rollouts = batch.BatchRollouts(geometry, 10000, seed=0)
+        X_wins, O_wins, draws = rollouts.play(core.EMPTY_BOARD)
+        self.assertEqual(10000, X_wins + O_wins + draws)
+        self.assertAlmostEqual(0.585, X_wins / 10000, delta=0.02)
+        self.assertAlmostEqual(0.288, O_wins / 10000, delta=0.02)
+
+        # Boards bigger than 5x5 don't fit in 64 bits, but their pieces
+        # do.
+        for geometry in [core.get_geometry(6, 4), core.get_geometry(7, 5)]:
+            rollouts = batch.BatchRollouts(geometry, 64, seed=0)
+            board = core.EMPTY_BOARD
+            for move in [0, geometry.offset - 1, 1, geometry.offset - 2]:
+                board = geometry.add_move(move, board)
+                self.assertEqual(64, sum(rollouts.play(board)))
+
+        stats = mcts.Stats()
+        root = mcts.Node(core.EMPTY_BOARD)
+        mcts.mcts(root, stats, Budget(nodes=20), batch=batch.BatchRollouts(size=16, seed=0))
+        self.assertEqual(20 * 16, stats.simulations)
+        self.assertEqual(20 * 16, root.simulations())
+
+    def test_playout(self):
+        geometry = core.get_geometry(3)
+        uniform = playout.Playout(geometry, playout.UNIFORM)
+        results = [uniform.play(core.EMPTY_BOARD) for _ in range(10000)]
+        self.assertAlmostEqual(0.585, sum(result[0] == 1 for result in results) / len(results), delta=0.02)
+        self.assertAlmostEqual(0.288, sum(result[1] == 1 for result in results) / len(results), delta=0.02)
+
+        # X wins at once rather than blocking O's win.
+        board = core.EMPTY_BOARD
+        for move in [0, 3, 1, 4]:
+            board = geometry.add_move(move, board)
+        for policy in [playout.WIN_BLOCK, playout.SOFTMAX]:
+            X_win, O_win, end_board = playout.Playout(geometry, policy).play(board)
+            self.assertEqual((1, 0), (X_win, O_win))
+            self.assertEqual(geometry.add_move(2, board) & ~1, end_board & ~1)
+
+        # O blocks X's win.
+        board = geometry.add_move(3, geometry.add_move(0, core.EMPTY_BOARD))
+        board = geometry.add_move(1, board)
+        for _ in range(20):
+            _, O_pieces = geometry.split_board(playout.Playout(geometry).play(board)[2])
+            self.assertTrue(O_pieces >> 2 & 1)
+
+        # A cutoff scores the game with the evaluator.
+        geometry = core.get_geometry(5, 4)
+        cutoff = playout.Playout(geometry, playout.SOFTMAX, cutoff=2)
+        for _ in range(20):
+            X_win, O_win, end_board = cutoff.play(core.EMPTY_BOARD)
+            self.assertTrue(0 < X_win < 1)
+            self.assertAlmostEqual(1, X_win + O_win)
+            self.assertEqual(2, geometry.offset - geometry.count_empty(end_board))
+
+        board = geometry.add_move(geometry.mid_index, core.EMPTY_BOARD)
+        tree = mcts.Tree(geometry, Budget(nodes=100), policy=playout.WIN_BLOCK, cutoff=6)
+        self.assertIn(tree.get_next_board(board), geometry.get_children(board))
+
+    def test_solver(self):
+        # Searches of late positions stop once the root is proven, with
+        # the outcome that proof-number search finds.
+        geometry = core.get_geometry(4, 3)
+        solver = pns.Solver(geometry)
+        for _ in range(10):
+            board = core.EMPTY_BOARD
+            while geometry.count_empty(board) > 9 or geometry.check_outcome(board) is not None:
+                if geometry.check_outcome(board) is not None:
+                    board = core.EMPTY_BOARD
+                children = geometry.get_children(board)
+                board = children[randint(0, len(children) - 1)]
+
+            root = mcts.Node(board, geometry)
+            stats = mcts.Stats()
+            best_child = mcts.mcts(root, stats, Budget(seconds=60))
+            self.assertTrue(stats.proven)
+            result = solver.solve(board)
+            self.assertEqual(result.outcome, root.outcome())
+            self.assertEqual(result.outcome, best_child.outcome())
+
+    def test_rave(self):
+        # Every simulation through a child of the root plays the child's
+        # move after the root, so it counts for the child's AMAF
+        # statistics too.
+        geometry = core.get_geometry(4, 3)
+        root = mcts.Node(core.EMPTY_BOARD, arena=Arena(geometry, rave=mcts.RAVE_EQUIVALENCE))
+        mcts.search(root, mcts.Stats(), Budget(nodes=300))
+        arena = root.arena()
+        for child in root.children():
+            self.assertGreaterEqual(arena.amaf_visits[child.index()], child.simulations())
+            self.assertGreaterEqual(arena.amaf_wins[child.index()], child.wins())
+
+        board = core.EMPTY_BOARD
+        for move in [0, 5, 1]:
+            board = geometry.add_move(move, board)
+        tree = mcts.Tree(geometry, Budget(nodes=300), rave=mcts.RAVE_EQUIVALENCE)
+        self.assertEqual(2, geometry.get_move(board, tree.get_next_board(board)))
+
+    def test_ponder(self):
+        # Pondering on the opponent's turn adds simulations to the root,
+        # and the search after the opponent's move goes on from the
+        # simulations of the reply's node.
+        tree = mcts.Tree(budget=Budget(nodes=200))
+        board = tree.get_next_board(core.EMPTY_BOARD)
+        simulations = tree.root().simulations()
+        cancel = Event()
+
+        def stop_pondering(stats):
+            if stats.simulations >= 1000:
+                cancel.set()
+
+        tree.ponder(board, cancel, stop_pondering)
+        self.assertEqual(board, tree.root().board())
+        self.assertGreaterEqual(tree.root().simulations(), simulations + 1000)
+
+        reply = max(tree.root().children(), key=lambda child: child.simulations())
+        reply_simulations = reply.simulations()
+        self.assertGreater(reply_simulations, 0)
+        progress = []
+        tree.get_next_board(reply.board(),
+                            progress=lambda stats: progress.append((tree.root().simulations(), stats.iterations)))
+        root_simulations, iterations = progress[-1]
+        self.assertEqual(reply_simulations + iterations, root_simulations)
+
+    def test_seed(self):
+        # Serial searches with a seed and a budget of nodes are
+        # reproducible, with or without a playout policy, and leave the
+        # random module's generator alone.
+        board = core.add_move(core.MID_INDEX, core.EMPTY_BOARD)
+        for policy in [None, playout.WIN_BLOCK]:
+            results = []
+            for _ in range(2):
+                state = getstate()
+                tree = mcts.Tree(budget=Budget(nodes=200), seed=0, policy=policy)
+                next_board = tree.get_next_board(board)
+                self.assertEqual(state, getstate())
+                random()
+                results.append((next_board, [(child.board(), child.wins()) for child in tree.root().children()]))
+            self.assertEqual(results[0], results[1])
+
+    def test_parallel_mcts(self):
+        # Root parallelization with a seed and a budget of nodes is
+        # reproducible.
+        pool = mcts.Pool(2)
+        board = core.add_move(core.MID_INDEX, core.EMPTY_BOARD)
+        results = []
+        for _ in range(2):
+            stats = mcts.Stats()
+            next_board = mcts.root_parallel_mcts(board, core.DEFAULT_GEOMETRY, stats, Budget(nodes=100), pool,
+                                                 seed=0)
+            self.assertIn(next_board, core.get_children(board))
+            self.assertEqual(2 * 100, stats.simulations)
+            results.append((next_board, stats.visited))
+        self.assertEqual(results[0], results[1])
+        pool.shutdown()
+
+        # Tree parallelization takes back every virtual loss.
+        stats = mcts.Stats()
+        root = mcts.Node(core.EMPTY_BOARD)
+        mcts.tree_parallel_mcts(root, stats, Budget(nodes=300), 3)
+        self.assertEqual(300, stats.iterations)
+        self.assertEqual(300, root.simulations())
+        self.assertEqual(300, sum(child.simulations() for child in root.children()))
+
+
+class TestEngine(unittest.TestCase):
+
+    def test_engine(self):
+        geometry = core.get_geometry(3)
+        for name in engine.ENGINES:
+            output = io.StringIO()
+            runner = engine.Engine(geometry, name, output)
+            for line in ['position 0 3 1 4', 'budget nodes 1000', 'go']:
+                runner.handle(line)
+            runner.wait()
+            info, best_move = output.getvalue().splitlines()[-2:]
+            self.assertRegex(info, r'^info depth 1 nodes \d+ score win$')
+            self.assertEqual('bestmove 2', best_move)
+
+        # A search without limits runs until stop.
+        output = io.StringIO()
+        runner = engine.Engine(core.get_geometry(5, 4), engine.MCTS, output)
+        for line in ['position 12', 'budget', 'go', 'stop', 'position 12 12', 'fly', 'quit']:
+            runner.handle(line)
+        lines = output.getvalue().splitlines()
+        self.assertTrue(lines[-3].startswith('bestmove '))
+        self.assertEqual(['error illegal move: 12', 'error unknown command: fly'], lines[-2:])
+
+        # The engine runs without Tk: -X importtime has the engine's
+        # process list each module it imports on stderr.
+        result = subprocess.run([sys.executable, '-O', '-X', 'importtime', '-m', 'tic_tac_toe.engine', '--size', '3'],
+                                check=True, input='position 0 3 1 4\nbudget nodes 100\ngo\n', capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual('bestmove 2', result.stdout.splitlines()[-1])
+        imported = [line.split('|')[-1].strip() for line in result.stderr.splitlines()
+                    if line.startswith('import time:')]
+        self.assertIn('tic_tac_toe.minimax', imported)
+        self.assertFalse([module for module in imported if module.split('.')[0] in ('tkinter', '_tkinter')])
+
+
+class TestPns(unittest.TestCase):
+
+    def test_small_boards(self):
+        self.assertEqual(0, pns.Solver(core.get_geometry(3)).solve(core.EMPTY_BOARD).outcome)
+        self.assertEqual(core.INF, pns.Solver(core.get_geometry(4, 3)).solve(core.EMPTY_BOARD).outcome)
+
+    def test_late_positions(self):
+        empty = 7
+        for _ in range(10):
+            board = core.EMPTY_BOARD
+            while core.count_empty(board) > empty and core.check_outcome(board) is None:
+                children = core.get_children(board)
+                board = children[randint(0, len(children) - 1)]
+            if core.check_outcome(board) is not None:
+                continue
+
+            solver = pns.Solver()
+            result = solver.solve(board)
+            self.assertEqual(minimax.test_minimax(board, empty), result.outcome)
+            self.assertEqual(result.outcome, solver.solve(core.add_move(result.move, board)).outcome)
+
+
+class TestBook(unittest.TestCase):
+
+    def test_book(self):
+        geometry = core.get_geometry(3)
+        with tempfile.TemporaryDirectory() as directory:
+            path = book.get_book_path(geometry, directory)
+            count = book.build_book(geometry, path, plies=3, depth=geometry.offset)
+            opening_book = book.load_book(geometry, directory)
+            self.assertEqual(count, len(opening_book))
+
+            # Every board with fewer than 3 pieces is in the book, under
+            # any symmetry.
+            layer = [core.EMPTY_BOARD]
+            for _ in range(3):
+                for board in layer:
+                    entry = opening_book.get(board)
+                    self.assertIn(entry.move, geometry.legal_moves(board))
+                    child = geometry.add_move(entry.move, board)
+                    self.assertEqual(entry.score, minimax.test_minimax(child, geometry.offset, geometry))
+                layer = [child for board in layer for child in geometry.get_children(board)]
+            self.assertIsNone(opening_book.get(layer[0]))
+
+            tree = minimax.Tree(geometry, book=opening_book)
+            self.assertEqual(opening_book.get_next_board(core.EMPTY_BOARD), tree.get_next_board(core.EMPTY_BOARD))
+            opening_book.close()
+
+
+class TestTablebase(unittest.TestCase):
+
+    def test_tablebase(self):
+        geometry = core.get_geometry(3)
+        with tempfile.TemporaryDirectory() as directory:
+            path = tablebase.get_tablebase_path(geometry, directory)
+            tablebase.build_tablebase(geometry, path, max_empty=5)
+            table = tablebase.load_tablebase(geometry, directory)
+
+            for _ in range(20):
+                board = core.EMPTY_BOARD
+                while geometry.count_empty(board) > 3 and geometry.check_outcome(board) is None:
+                    children = geometry.get_children(board)
+                    board = children[randint(0, len(children) - 1)]
+                if geometry.check_outcome(board) is not None:
+                    continue
+                outcome = minimax.test_minimax(board, geometry.offset, geometry)
+                self.assertEqual(outcome, table.get_outcome(board))
+                next_board = table.get_next_board(board)
+                self.assertEqual(outcome, minimax.test_minimax(next_board, geometry.offset, geometry))
+
+            # Searches from boards that the tablebase doesn't have stop at
+            # the boards that it does.
+            board = geometry.add_move(0, geometry.add_move(4, core.EMPTY_BOARD))
+            self.assertIsNone(table.get(board))
+            _, val = minimax.minimax(minimax.Node(board, arena=Arena(geometry, tablebase=table)), minimax.Stats(),
+                                     depth=2, get_best_child=True)
+            self.assertEqual(minimax.test_minimax(board, geometry.offset, geometry), val)
+            table.close()
+
+
+class TestCore(unittest.TestCase):
+
+    def test_canonical_board(self):
+        board = core.EMPTY_BOARD
+        for _ in range(core.OFFSET // 2):
+            children = core.get_children(board)
+            board = children[randint(0, len(children) - 1)]
+
+            canonical, symmetry = core.canonical_board(board)
+            for i in range(len(core.SYMMETRIES)):
+                self.assertEqual(canonical, core.canonical_board(core.transform_board(board, i))[0])
+
+            for move in core.legal_moves(canonical):
+                child = core.add_move(core.untransform_move(move, symmetry), board)
+                self.assertEqual(core.add_move(move, canonical), core.transform_board(child, symmetry))
+
+    def test_count_bits(self):
+        for num in [0, 1, 0b1011, (1 << 99) | 1, randint(0, 1 << 99)]:
+            self.assertEqual(sum(num >> i & 1 for i in range(num.bit_length())), core.count_bits(num))
+
+        geometry = core.get_geometry(7, 5)
+        board = core.EMPTY_BOARD
+        for move in [0, geometry.offset - 1, 24]:
+            board = geometry.add_move(move, board)
+        self.assertEqual(3, geometry.count_pieces(board))
+        self.assertEqual(geometry.offset - 3, geometry.count_empty(board))
+
+    def test_line_counts(self):
+        for geometry in GEOMETRIES:
+            board = core.EMPTY_BOARD
+            derived = core.LineCounts(geometry, board)
+            while geometry.check_outcome(board) is None:
+                lines = core.LineCounts(geometry, board)
+                self.assertEqual(vars(lines), vars(derived))
+                for move in geometry.legal_moves(board):
+                    child = geometry.add_move(move, board)
+                    pieces, O_pieces = geometry.split_board(child)
+                    self.assertEqual(
+                        (geometry.check_outcome(child),
+                         evaluate.max_connected(pieces, O_pieces, geometry),
+                         evaluate.max_connected(O_pieces, pieces, geometry)),
+                        lines.after_move(move)
+                    )
+
+                children = geometry.get_children(board)
+                board = children[randint(0, len(children) - 1)]
+                derived = derived.after(geometry.get_move(derived.get_board(), board))
+
+
+class TestEvaluate(unittest.TestCase):
+
+    def test_pattern_evaluator(self):
+        for geometry in GEOMETRIES + [core.get_geometry(3)]:
+            evaluator = evaluate.PatternEvaluator(geometry, weight=lambda pieces, enemy_pieces: pieces,
+                                                  combine=sum)
+            board = core.EMPTY_BOARD
+            while geometry.check_outcome(board) is None:
+                self.assertEqual(evaluate.eval_turn(board) + evaluate.eval_max_connected(board, geometry),
+                                 evaluate.eval_board(board, geometry))
+
+                # With a player's pieces in a line as its weight, the sum
+                # gives each player's pieces in each line.
+                X_pieces, O_pieces = geometry.split_board(board)
+                lines_val = self._sum_lines(X_pieces, geometry) - self._sum_lines(O_pieces, geometry)
+                self.assertEqual(evaluate.eval_turn(board) + lines_val, evaluator.evaluate(board))
+
+                children = geometry.get_children(board)
+                board = children[randint(0, len(children) - 1)]
+
+    @staticmethod
+    def _sum_lines(pieces, geometry):
+        return sum(sum(1 << i for i, index in enumerate(geometry.get_indices(state)) if pieces >> index & 1)
+                   for state in geometry.win_states)
+
+
+class TestArena(unittest.TestCase):
+
+    def test_compact(self):
+        root = mcts.Node(core.EMPTY_BOARD)
+        stats = mcts.Stats()
+        for _ in range(500):
+            mcts.iterate(root, stats)
+
+        arena = root.arena()
+        child = max(root.children(), key=lambda node: node.simulations())
+        subtree = self._subtree_stats(child)
+        index = arena.compact(child.index())
+
+        self.assertEqual(0, index)
+        self.assertEqual(len(subtree), len(arena))
+        self.assertEqual(subtree, self._subtree_stats(mcts.node_at(arena, index)))
+
+    def test_shared_nodes(self):
+        geometry = core.get_geometry(4, 3)
+        for share in (SHARE_BOARDS, SHARE_SYMMETRIES):
+            arena = Arena(geometry, share=share)
+            root = mcts.Node(core.EMPTY_BOARD, arena=arena)
+            stats = mcts.Stats()
+            for _ in range(500):
+                mcts.iterate(root, stats)
+
+            # There is one node per key, and every node but the root is
+            # visited exactly through the links to it.
+            keys = [arena.get_key(board) for board in arena.boards]
+            self.assertEqual(len(keys), len(set(keys)))
+            link_visits = [0] * len(arena)
+            for slot, child in enumerate(arena.children):
+                link_visits[child] += arena.edge_visits[slot]
+            link_visits[0] = 500
+            self.assertEqual(list(arena.visits), link_visits)
+
+            child = max(root.children(), key=lambda node: node.simulations())
+            links = self._get_links(arena, child.index())
+            self.assertEqual(links, self._get_links(arena, arena.compact(child.index())))
+
+    def test_prune(self):
+        geometry = core.get_geometry(4, 3)
+        root = mcts.Node(core.EMPTY_BOARD, geometry)
+        stats = mcts.Stats()
+        for _ in range(500):
+            mcts.iterate(root, stats)
+
+        # Compacting to a size keeps the most visited subtrees, with the
+        # statistics of every node that is kept.
+        arena = root.arena()
+        subtree = self._path_stats(root)
+        child = max(root.children(), key=lambda node: node.simulations())
+        child_board = child.board()
+        grandchild_board = max(child.children(), key=lambda node: node.simulations()).board()
+        root = mcts.node_at(arena, arena.compact(root.index(), 200))
+        self.assertLessEqual(len(arena), 200)
+        kept = self._path_stats(root)
+        self.assertEqual(len(arena), len(kept))
+        for path, stats in kept.items():
+            self.assertEqual(subtree[path], stats)
+        index = arena.find_child(arena.find_child(root.index(), child_board), grandchild_board)
+        self.assertIsNotNone(index)
+
+        # A node is found any number of moves below the root.
+        self.assertEqual(index, arena.find_node(root.index(), grandchild_board))
+        self.assertEqual(root.index(), arena.find_node(root.index(), root.board()))
+        self.assertIsNone(arena.find_node(index, root.board()))
+
+    def test_capacity(self):
+        # Arenas always have room for a root and its children, and trees
+        # whose arenas are full still play legal moves.
+        geometry = core.get_geometry(4, 3)
+        self.assertEqual(geometry.offset + 1, Arena(geometry, capacity=5).capacity)
+        trees = [minimax.Tree(geometry, Budget(nodes=200), capacity=5, use_pvs=True),
+                 mcts.Tree(geometry, Budget(nodes=200), capacity=5)]
+        for _ in range(3):
+            board = core.EMPTY_BOARD
+            while geometry.check_outcome(board) is None:
+                next_board = trees[core.turn_bit(board)].get_next_board(board)
+                self.assertIn(next_board, geometry.get_children(board))
+                board = next_board
+
+        # A search that runs out of room stops at the deepest depth that
+        # fits, and every depth it reports has the value of a full search
+        # to that depth.
+        board = core.EMPTY_BOARD
+        for move in [5, 0, 6]:
+            board = geometry.add_move(move, board)
+        for capacity in [100, 1000]:
+            for use_pvs in [False, True]:
+                reports = []
+                tree = minimax.Tree(geometry, Budget(), capacity=capacity, use_pvs=use_pvs)
+                tree.get_next_board(board, progress=lambda stats: reports.append((stats.depth, stats.val)))
+                self.assertLess(reports[-1][0], geometry.count_empty(board))
+                for depth, val in reports:
+                    self.assertEqual(minimax.minimax(minimax.Node(board, geometry), minimax.Stats(), depth=depth), val)
+
+        # So does a fixed-depth search.
+        reports = []
+        minimax.Tree(geometry, capacity=100).get_next_board(board, progress=lambda stats: reports.append(stats.depth))
+        self.assertLess(max(reports), minimax.DEPTH)
+
+    def test_memory(self):
+        # Trees stay within their memory through a game.
+        geometry = core.get_geometry(4, 3)
+        minimax_tree = minimax.Tree(geometry, Budget(nodes=2000), memory=2 ** 17, use_pvs=True)
+        mcts_tree = mcts.Tree(geometry, Budget(nodes=2000), memory=2 ** 17)
+        arenas = [minimax_tree.get_root().get_arena(), mcts_tree.root().arena()]
+        board = core.EMPTY_BOARD
+        while geometry.check_outcome(board) is None:
+            board = (mcts_tree if core.turn_bit(board) else minimax_tree).get_next_board(board)
+            for arena in arenas:
+                self.assertLess(arena.capacity, 2 ** 17 // 20)
+                self.assertLessEqual(len(arena), arena.capacity)
+
+        # A memory too small for any nodes still leaves room for a root
+        # and its children.
+        self.assertEqual(geometry.offset + 1, Arena(geometry, memory=0).capacity)
+        tree = mcts.Tree(geometry, Budget(nodes=200), memory=100)
+        board = core.EMPTY_BOARD
+        while geometry.check_outcome(board) is None:
+            next_board = tree.get_next_board(board)
+            self.assertIn(next_board, geometry.get_children(board))
+            board = next_board
+
+        # A tree keeps the subtree of a board after moves played without
+        # it.
+        tree = mcts.Tree(geometry, Budget(nodes=1000))
+        tree.get_next_board(core.EMPTY_BOARD)
+        grandchild = max(tree.root().children(), key=lambda node: node.simulations()).children()[0]
+        simulations = grandchild.simulations()
+        cancel = Event()
+        cancel.set()
+        tree.ponder(grandchild.board(), cancel)
+        self.assertEqual(grandchild.board(), tree.root().board())
+        self.assertEqual(simulations, tree.root().simulations())
+
+    @staticmethod
+    def _get_links(arena: Arena, root):
+        # The visits of each link reachable from root, by the boards it
+        # links.
+        links = {}
+        stack = [root]
+        while stack:
+            parent = stack.pop()
+            first = arena.first_child[parent]
+            for slot in range(first, first + arena.child_count[parent]):
+                child = arena.children[slot]
+                key = (arena.boards[parent], arena.boards[child])
+                if key not in links:
+                    links[key] = arena.edge_visits[slot]
+                    stack.append(child)
+        return links
+
+    def _path_stats(self, node, path=()):
+        # The statistics of each node in the subtree, by the boards on
+        # the path to it, since a board can have several nodes.
+        path += (node.board(),)
+        stats = {path: (node.wins(), node.simulations())}
+        for child in node.children():
+            stats.update(self._path_stats(child, path))
+        return stats
+
+    def _subtree_stats(self, node):
+        stats = [(node.board(), node.wins(), node.simulations())]
+        for child in node.children():
+            stats += self._subtree_stats(child)
+        return stats
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,304 @@
+# Jake Herrmann
+# CS 405
+#
+# arena.py
+# Compact node storage for the search trees.
+
+from array import array
+from heapq import heappop, heappush
+
+from . import core
+
+# ----------------------------------------------------------------------
+# Constants
+# ----------------------------------------------------------------------
+
+# Default maximum number of nodes in an arena.
+CAPACITY = 2 ** 21
+
+# How full an arena gets before collect compacts it.
+COMPACT_FRACTION = 0.5
+
+# Bytes per entry of a dict, for the table of shared nodes, and of a
+# Python int with its list entry, for boards that don't fit in 64 bits.
+DICT_ENTRY_SIZE = 100
+INT_SIZE = 44
+
+# Peak memory per node of capacity over the memory of the node itself:
+# compact makes a copy of up to COMPACT_FRACTION of the nodes, and the
+# arrays grow by up to an eighth at a time.
+MEMORY_OVERHEAD = (1 + COMPACT_FRACTION) * 1.125
+
+NO_CHILDREN = -1
+
+# Kinds of node sharing (see Arena).
+SHARE_BOARDS = 'boards'
+SHARE_SYMMETRIES = 'symmetries'
+
+
+# ----------------------------------------------------------------------
+# Arena
+# ----------------------------------------------------------------------
+
+class Arena:
+    # Stores the nodes of a search tree in parallel typed arrays, so that
+    # a node is just an index and costs a few dozen bytes rather than a
+    # Python object with its own dict and lists. The children of a node
+    # are the entries children[first_child : first_child + child_count].
+    #
+    # Which fields mean what is up to the engine: minimax uses vals for
+    # node values, while MCTS uses them for outcomes along with the
+    # wins, visits and expanded fields.
+    #
+    # tablebase, if given, is a tablebase.Tablebase that the engines
+    # probe for the outcomes of new nodes, which are then leaves just like
+    # nodes for finished games.
+    #
+    # With share, the arena keeps a table of its nodes by key, so that
+    # there is one node per key, shared by every parent that has a child
+    # with that key, which makes the tree a directed acyclic graph. With
+    # SHARE_BOARDS the key is the board, and with SHARE_SYMMETRIES it is
+    # the canonical board (see core.Geometry.canonical_board), so a
+    # node's board can be any of the boards symmetric to a child's.
+    # Statistics for each link from a parent to a child are then kept in
+    # edge_visits, which has an entry per entry of children.
+    #
+    # rave, if given, is the equivalence parameter of MCTS's RAVE (see
+    # mcts.Node.value), whose all-moves-as-first statistics are kept in
+    # amaf_wins and amaf_visits. These statistics are for the move to a
+    # node, so symmetric boards can't share a node.
+    #
+    # memory, if given, is a limit in bytes that sets the capacity
+    # instead (see get_node_size).
+
+    def __init__(self, geometry: core.Geometry = core.DEFAULT_GEOMETRY, capacity=CAPACITY, tablebase=None,
+                 share=None, rave=None, memory=None):
+        assert tablebase is None or tablebase.geometry is geometry
+        assert share in (None, SHARE_BOARDS, SHARE_SYMMETRIES)
+        assert rave is None or share != SHARE_SYMMETRIES
+        self.geometry = geometry
+        self.tablebase = tablebase
+        self.share = share
+        self.rave = rave
+        self._clear()
+        self.capacity = capacity if memory is None else int(memory // (self.get_node_size() * MEMORY_OVERHEAD))
+        # There is always room for a root and its children.
+        self.capacity = max(self.capacity, geometry.offset + 1)
+
+    def _clear(self):
+        # Boards that don't fit in 64 bits are kept in a list.
+        self.boards = array('Q') if 2 * self.geometry.offset + 1 <= 64 else []
+        self.vals = array('d')
+        self.leaves = array('b')
+        self.wins = array('d')
+        self.visits = array('L')
+        self.expanded = array('H')
+        self.first_child = array('l')
+        self.child_count = array('H')
+        self.children = array('l')
+        self.edge_visits = None if self.share is None else array('L')
+        self.amaf_wins = None if self.rave is None else array('d')
+        self.amaf_visits = None if self.rave is None else array('L')
+        self._nodes_by_key = None if self.share is None else {}
+
+    def __len__(self):
+        return len(self.vals)
+
+    def get_node_size(self):
+        # The bytes per node, counting one entry of children per node.
+        arrays = [self.vals, self.leaves, self.wins, self.visits, self.expanded, self.first_child, self.child_count,
+                  self.children, self.edge_visits, self.amaf_wins, self.amaf_visits]
+        size = sum(fields.itemsize for fields in arrays if fields is not None)
+        size += self.boards.itemsize if isinstance(self.boards, array) else INT_SIZE
+        if self._nodes_by_key is not None:
+            size += DICT_ENTRY_SIZE
+        return size
+
+    def has_room(self, count):
+        return len(self.vals) + count <= self.capacity
+
+    def get_key(self, board):
+        # The key that nodes are shared by (the board itself if they
+        # aren't shared).
+        if self.share == SHARE_SYMMETRIES:
+            return self.geometry.canonical_board(board)[0]
+        return board
+
+    def add(self, board, leaf, val):
+        # Returns the index of a new node with no children, or if nodes
+        # are shared, of the node for the board's key if there is one.
+        if self._nodes_by_key is not None:
+            key = self.get_key(board)
+            index = self._nodes_by_key.get(key)
+            if index is not None:
+                return index
+            self._nodes_by_key[key] = len(self.vals)
+        self.boards.append(board)
+        self.vals.append(val)
+        self.leaves.append(leaf)
+        self.wins.append(0)
+        self.visits.append(0)
+        self.expanded.append(0)
+        self.first_child.append(NO_CHILDREN)
+        self.child_count.append(0)
+        if self.rave is not None:
+            self.amaf_wins.append(0)
+            self.amaf_visits.append(0)
+        return len(self.vals) - 1
+
+    def add_children(self, parent, children):
+        # Adds a node for each (board, leaf, val) in children, in order,
+        # as the children of parent. Returns False, adding nothing, if
+        # there isn't room for them.
+        assert self.first_child[parent] == NO_CHILDREN
+        if self.share is not None:
+            return self._add_shared_children(parent, children)
+        if not self.has_room(len(children)):
+            return False
+        count = len(children)
+        start = len(self.vals)
+        self.first_child[parent] = len(self.children)
+        self.child_count[parent] = count
+
+        # Bulk appends, since this is where almost all nodes are added.
+        boards, leaves, vals = zip(*children)
+        self.boards.extend(boards)
+        self.leaves.extend(leaves)
+        self.vals.extend(vals)
+        self.wins.extend(array('d', [0]) * count)
+        self.visits.extend(array('L', [0]) * count)
+        self.expanded.extend(array('H', [0]) * count)
+        self.first_child.extend(array('l', [NO_CHILDREN]) * count)
+        self.child_count.extend(array('H', [0]) * count)
+        if self.rave is not None:
+            self.amaf_wins.extend(array('d', [0]) * count)
+            self.amaf_visits.extend(array('L', [0]) * count)
+        self.children.extend(range(start, start + count))
+        return True
+
+    def _add_shared_children(self, parent, children):
+        # Same as add_children, but links the existing node for each child
+        # whose key has one, and links only the first of several children
+        # with the same key, which are the same position.
+        nodes_by_key = self._nodes_by_key
+        keys = {}
+        for child in children:
+            keys.setdefault(self.get_key(child[0]), child)
+        if not self.has_room(sum(key not in nodes_by_key for key in keys)):
+            return False
+        self.first_child[parent] = len(self.children)
+        self.child_count[parent] = len(keys)
+        for board, leaf, val in keys.values():
+            self.children.append(self.add(board, leaf, val))
+        self.edge_visits.extend(array('L', [0]) * len(keys))
+        return True
+
+    def add_edge_visits(self, parent, child, count):
+        # Adds count to the visits of the link from parent to child.
+        first = self.first_child[parent]
+        children = self.children
+        for slot in range(first, first + self.child_count[parent]):
+            if children[slot] == child:
+                self.edge_visits[slot] += count
+                return
+        assert False
+
+    def get_children(self, index):
+        first = self.first_child[index]
+        if first == NO_CHILDREN:
+            return []
+        return self.children[first:first + self.child_count[index]]
+
+    def has_children(self, index):
+        return self.first_child[index] != NO_CHILDREN
+
+    def find_child(self, index, board):
+        for child in self.get_children(index):
+            if self.boards[child] == board:
+                return child
+        return None
+
+    def find_node(self, root, board):
+        # The index of a node for the board's key that is root or one of
+        # its descendants, or None if there isn't one. With shared nodes,
+        # this is the node for the key wherever it is. Otherwise only the
+        # nodes whose pieces are all on the board can lead to it, so the
+        # search takes one path per order of the moves since root.
+        if self._nodes_by_key is not None:
+            return self._nodes_by_key.get(self.get_key(board))
+        pieces = board >> 1
+        stack = [root]
+        while stack:
+            index = stack.pop()
+            if self.boards[index] == board:
+                return index
+            for child in self.get_children(index):
+                if not self.boards[child] >> 1 & ~pieces:
+                    stack.append(child)
+        return None
+
+    def collect(self, root):
+        # Once the arena is more than COMPACT_FRACTION full, drops the
+        # nodes that aren't reachable from root, and if root's subtree
+        # alone is that big, its least visited subtrees too (see
+        # compact), so that the next search has room to grow. Returns the
+        # new index of root.
+        threshold = self.capacity * COMPACT_FRACTION
+        if len(self) <= threshold:
+            return root
+        return self.compact(root, int(threshold))
+
+    def compact(self, root, size=None):
+        # Drops every node that isn't reachable from root. Returns the
+        # new index of root, which is 0. Other indices are invalidated.
+        #
+        # With size, keeps at most that many nodes. The nodes are then
+        # copied in order of their visits, most first, and a node whose
+        # children don't all fit loses them (becoming unexpanded), so
+        # the least visited subtrees are the ones dropped. Their nodes'
+        # statistics are still counted in their ancestors'.
+        old_fields = (self.boards, self.vals, self.leaves, self.wins, self.visits, self.expanded, self.amaf_wins,
+                      self.amaf_visits)
+        old_first_child, old_child_count, old_children = self.first_child, self.child_count, self.children
+        old_visits = self.visits
+        old_edge_visits = self.edge_visits
+        self._clear()
+
+        # Without size, the queue is first in, first out.
+        new_indices = {root: self._copy(root, old_fields)}
+        queue = [(0, 0, root)]
+        order = 1
+        while queue:
+            _, _, old_index = heappop(queue)
+            first = old_first_child[old_index]
+            if first == NO_CHILDREN:
+                continue
+            new_index = new_indices[old_index]
+            slots = range(first, first + old_child_count[old_index])
+            if size is not None and len(self) + sum(old_children[slot] not in new_indices for slot in slots) > size:
+                self.expanded[new_index] = 0
+                continue
+            self.first_child[new_index] = len(self.children)
+            self.child_count[new_index] = old_child_count[old_index]
+            for slot in slots:
+                old_child = old_children[slot]
+                if old_child not in new_indices:
+                    new_indices[old_child] = self._copy(old_child, old_fields)
+                    heappush(queue, (0 if size is None else -old_visits[old_child], order, old_child))
+                    order += 1
+                self.children.append(new_indices[old_child])
+                if old_edge_visits is not None:
+                    self.edge_visits.append(old_edge_visits[slot])
+
+        return new_indices[root]
+
+    def _copy(self, index, old_fields):
+        boards, vals, leaves, wins, visits, expanded, amaf_wins, amaf_visits = old_fields
+        new_index = self.add(boards[index], leaves[index], vals[index])
+        self.wins[new_index] = wins[index]
+        self.visits[new_index] = visits[index]
+        self.expanded[new_index] = expanded[index]
+        if self.rave is not None:
+            self.amaf_wins[new_index] = amaf_wins[index]
+            self.amaf_visits[new_index] = amaf_visits[index]
+        return new_index
@@ -0,0 +1,58 @@
+# Jake Herrmann
+# CS 405
+#
+# background.py
+# Engine searches on a background thread.
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+
+
+class Worker:
+    # Runs one search at a time, in order of submission, on a single
+    # background thread.
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def submit(self, search, board):
+        # Starts search(board, cancel=..., progress=...), e.g. a Tree's
+        # get_next_board, and returns its Job.
+        job = Job()
+        job.future = self._executor.submit(search, board, cancel=job.cancel_event, progress=job.report)
+        return job
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+class Job:
+
+    def __init__(self):
+        self.future = None
+        self.cancel_event = Event()
+        self._stats = None
+
+    def cancel(self):
+        # The search stops at its next check of the cancel event, or
+        # never starts if it is still waiting for the worker.
+        self.cancel_event.set()
+        self.future.cancel()
+
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def done(self):
+        return self.future.done()
+
+    def result(self):
+        assert not self.cancelled()
+        return self.future.result()
+
+    def progress(self):
+        # The stats most recently reported by the search, or None.
+        return self._stats
+
+    def report(self, stats):
+        # Called by the search, on the worker thread.
+        self._stats = stats
@@ -0,0 +1,86 @@
+# Jake Herrmann
+# CS 405
+#
+# batch.py
+# Batches of random games played at once with NumPy, for MCTS rollouts.
+
+from . import core
+
+# NumPy is optional: only batched rollouts need it.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# ----------------------------------------------------------------------
+# Constants
+# ----------------------------------------------------------------------
+
+# Default number of games per batch.
+BATCH_SIZE = 256
+
+
+# ----------------------------------------------------------------------
+# Batched rollouts
+# ----------------------------------------------------------------------
+
+class BatchRollouts:
+    # Plays batches of uniformly random games from a board. The pieces of
+    # the games are uint64 arrays with an entry per game, so each move
+    # and win check is a few array operations for the whole batch. seed,
+    # if given, makes the games reproducible.
+
+    def __init__(self, geometry: core.Geometry = core.DEFAULT_GEOMETRY, size=BATCH_SIZE, seed=None):
+        if np is None:
+            raise ImportError('Batched rollouts need NumPy')
+        assert geometry.offset <= 64
+        self._geometry = geometry
+        self.size = size
+        self._rng = np.random.default_rng(seed)
+        self._cell_bits = np.array([1 << index for index in range(geometry.offset)], dtype=np.uint64)
+        self._win_states = np.array(geometry.win_states, dtype=np.uint64)
+
+    def play(self, board):
+        # Returns the numbers of X wins, O wins and draws in a batch of
+        # games from the board, which must not have an outcome.
+        #
+        # A uniformly random game fills the empty cells in a uniformly
+        # random order, so each game's moves are a random permutation of
+        # the empty cells, drawn all at once before the first move.
+        geometry = self._geometry
+        size = self.size
+        X_pieces, O_pieces = geometry.split_board(board)
+        # X's part of the board also has O's pieces above the offset.
+        X_pieces &= (1 << geometry.offset) - 1
+        empty_cells = [index for index in range(geometry.offset) if not (X_pieces | O_pieces) >> index & 1]
+        order = np.array(empty_cells)[np.argsort(self._rng.random((size, len(empty_cells))), axis=1)]
+        moves = self._cell_bits[order]
+
+        pieces = [np.full(size, X_pieces, dtype=np.uint64), np.full(size, O_pieces, dtype=np.uint64)]
+        counts = [core.count_bits(X_pieces), core.count_bits(O_pieces)]
+        wins = [0, 0]
+        playing = np.ones(size, dtype=bool)
+        mover = core.turn_bit(board)
+        win_states = self._win_states
+
+        for ply in range(len(empty_cells)):
+            mover_pieces = pieces[mover]
+            mover_pieces |= moves[:, ply]
+            counts[mover] += 1
+
+            # There can't be a win before the mover has enough pieces.
+            if counts[mover] >= geometry.win_length:
+                won = playing & ((mover_pieces[:, None] & win_states) == win_states).any(axis=1)
+                wins[mover] += int(won.sum())
+                playing &= ~won
+                if not playing.any():
+                    break
+
+            mover = 1 - mover
+
+        X_wins, O_wins = wins
+        return X_wins, O_wins, size - X_wins - O_wins
+
+
+def is_available():
+    return np is not None
@@ -0,0 +1,152 @@
+# Jake Herrmann
+# CS 405
+#
+# bench.py
+# Benchmarks of the search engines.
+
+import argparse
+from time import time
+
+from . import core, mcts
+from .batch import BatchRollouts
+from .budget import Budget
+from .playout import POLICIES, UNIFORM
+
+# ----------------------------------------------------------------------
+# Constants
+# ----------------------------------------------------------------------
+
+# Default search time for each run of a benchmark.
+SECONDS = 2
+
+# Default worker counts.
+WORKERS = [1, 2, 4]
+
+# Default search time per move and number of games for matches.
+MOVE_SECONDS = 0.2
+GAMES = 20
+
+
+# ----------------------------------------------------------------------
+# Parallel MCTS
+# ----------------------------------------------------------------------
+
+def bench_parallel_mcts(geometry: core.Geometry, parallelism, workers, seconds=SECONDS, batch_size=None, seed=None):
+    # Runs a parallel search (see mcts.Tree) from the empty board for
+    # the given number of seconds, and returns its simulations per
+    # second. Starting the worker processes isn't timed.
+    stats = mcts.Stats()
+    budget = Budget(seconds=seconds)
+    if parallelism == mcts.ROOT_PARALLEL:
+        pool = mcts.Pool(workers)
+        mcts.root_parallel_mcts(core.EMPTY_BOARD, geometry, mcts.Stats(), Budget(nodes=1), pool)
+        t1 = time()
+        mcts.root_parallel_mcts(core.EMPTY_BOARD, geometry, stats, budget, pool, seed=seed, batch_size=batch_size)
+        t2 = time()
+        pool.shutdown()
+    else:
+        batches = None
+        if batch_size is not None:
+            batches = [BatchRollouts(geometry, batch_size, None if seed is None else seed + i)
+                       for i in range(workers)]
+        t1 = time()
+        mcts.tree_parallel_mcts(mcts.Node(core.EMPTY_BOARD, geometry), stats, budget, workers, batches=batches)
+        t2 = time()
+    return stats.simulations / (t2 - t1)
+
+
+# ----------------------------------------------------------------------
+# Playout policies
+# ----------------------------------------------------------------------
+
+def bench_simulations(geometry: core.Geometry, seconds=SECONDS, **options):
+    # The simulations per second of a search from the empty board by an
+    # mcts.Tree with the given options.
+    tree = mcts.Tree(geometry, Budget(seconds=seconds), **options)
+    stats = None
+
+    def progress(search_stats):
+        nonlocal stats
+        stats = search_stats
+
+    t1 = time()
+    tree.get_next_board(core.EMPTY_BOARD, progress=progress)
+    t2 = time()
+    return 0 if stats is None else stats.simulations / (t2 - t1)
+
+
+def play_match(geometry: core.Geometry, options, opponent_options, games=GAMES, seconds=MOVE_SECONDS):
+    # The score (a win is 1 and a draw 1/2) of an mcts.Tree with the
+    # given options against one with opponent_options, out of the number
+    # of games, with each tree playing X in half of them. Each move gets
+    # the given search time.
+    score = 0
+    for game in range(games):
+        trees = [mcts.Tree(geometry, Budget(seconds=seconds), **options),
+                 mcts.Tree(geometry, Budget(seconds=seconds), **opponent_options)]
+        X = game % 2
+        board = core.EMPTY_BOARD
+        while geometry.check_outcome(board) is None:
+            X_to_move = not core.turn_bit(board)
+            board = trees[0 if X_to_move == (X == 0) else 1].get_next_board(board)
+        outcome = geometry.check_outcome(board)
+        if outcome == 0:
+            score += 0.5
+        elif (outcome == core.INF) == (X == 0):
+            score += 1
+    return score
+
+
+# ----------------------------------------------------------------------
+# Command line
+# ----------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the search engines.')
+    parser.add_argument('--size', type=int, default=core.SIZE)
+    parser.add_argument('--win-length', type=int)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    parallel_parser = subparsers.add_parser('parallel', help='simulations per second of parallel MCTS')
+    parallel_parser.add_argument('--seconds', type=float, default=SECONDS, help='search time for each run')
+    parallel_parser.add_argument('--workers', type=int, nargs='+', default=WORKERS, help='worker counts to run')
+    parallel_parser.add_argument('--parallelism', nargs='+', choices=[mcts.ROOT_PARALLEL, mcts.TREE_PARALLEL],
+                                 default=[mcts.ROOT_PARALLEL, mcts.TREE_PARALLEL])
+    parallel_parser.add_argument('--batch-size', type=int, help='games per rollout, played with NumPy')
+    parallel_parser.add_argument('--seed', type=int)
+
+    playouts_parser = subparsers.add_parser(
+        'playouts', help='simulations per second of MCTS playout policies, and their scores against uniform playouts')
+    playouts_parser.add_argument('--policies', nargs='+', choices=POLICIES, default=POLICIES)
+    playouts_parser.add_argument('--cutoffs', type=int, nargs='+', default=[],
+                                 help='playout cutoffs to run each policy with, besides none')
+    playouts_parser.add_argument('--seconds', type=float, default=MOVE_SECONDS, help='search time per move')
+    playouts_parser.add_argument('--games', type=int, default=GAMES, help='games per match')
+    args = parser.parse_args()
+
+    geometry = core.get_geometry(args.size, args.win_length)
+    if args.benchmark == 'playouts':
+        for policy in args.policies:
+            for cutoff in [None] + args.cutoffs:
+                options = {'policy': policy, 'cutoff': cutoff}
+                rate = bench_simulations(geometry, SECONDS, **options)
+                name = policy if cutoff is None else f'{policy}, cutoff {cutoff}'
+                if policy == UNIFORM and cutoff is None:
+                    print(f'{name}: {rate:.0f} simulations / s')
+                    continue
+                score = play_match(geometry, options, {}, args.games, args.seconds)
+                print(f'{name}: {rate:.0f} simulations / s, {score} / {args.games} against {UNIFORM}')
+        return
+
+    for parallelism in args.parallelism:
+        base_rate = None
+        for workers in args.workers:
+            rate = bench_parallel_mcts(geometry, parallelism, workers, args.seconds, args.batch_size, args.seed)
+            if base_rate is None:
+                base_rate = rate
+            print(f'{parallelism} parallel, {workers} workers: {rate:.0f} simulations / s '
+                  f'({rate / base_rate:.2f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+# Jake Herrmann
+# CS 405
+#
+# book.py
+# Opening books: best moves for the first plies of a game, searched
+# offline.
+
+import argparse
+import os
+from collections import namedtuple
+from time import time
+
+from . import core, minimax
+from .records import RecordFile, write_records
+
+# ----------------------------------------------------------------------
+# Constants
+# ----------------------------------------------------------------------
+
+BOOK_DIR = 'books'
+
+# Default number of plies that a book covers, i.e. it has the boards
+# with fewer pieces than this.
+PLIES = 3
+
+# Default search depth for each board in a book.
+DEPTH = 6
+
+# Move (for the canonical board), score and search depth.
+VALUE_FORMAT = 'BfB'
+
+BookEntry = namedtuple('BookEntry', ['move', 'score', 'depth'])
+
+
+# ----------------------------------------------------------------------
+# Book
+# ----------------------------------------------------------------------
+
+class Book:
+    # A book file, which has a record for each canonical board (see
+    # core.Geometry.canonical_board) that it covers. The file is memory
+    # mapped, so loading a book costs next to nothing.
+
+    def __init__(self, path):
+        self._records = RecordFile(path)
+        self.geometry = self._records.geometry
+
+    def __len__(self):
+        return len(self._records)
+
+    def get(self, board):
+        # The BookEntry for the board, with the move mapped back from the
+        # canonical board, or None if the board isn't in the book.
+        if not self._records.covers(board):
+            return None
+        canonical, symmetry = self.geometry.canonical_board(board)
+        values = self._records.get(canonical)
+        if values is None:
+            return None
+        move, score, depth = values
+        return BookEntry(self.geometry.untransform_move(move, symmetry), score, depth)
+
+    def get_next_board(self, board):
+        entry = self.get(board)
+        if entry is None:
+            return None
+        return self.geometry.add_move(entry.move, board)
+
+    def close(self):
+        self._records.close()
+
+
+def get_book_path(geometry: core.Geometry, directory=BOOK_DIR):
+    return os.path.join(directory, f'book-{geometry.size}-{geometry.win_length}.bin')
+
+
+def load_book(geometry: core.Geometry, directory=BOOK_DIR):
+    # The book for the geometry, or None if it hasn't been built.
+    path = get_book_path(geometry, directory)
+    if not os.path.exists(path):
+        return None
+    return Book(path)
+
+
+# ----------------------------------------------------------------------
+# Building
+# ----------------------------------------------------------------------
+
+def build_book(geometry: core.Geometry, path, plies=PLIES, depth=DEPTH):
+    # Searches each canonical board with fewer than plies pieces and no
+    # outcome to the given depth, and writes the book to path. Returns
+    # the number of boards in the book.
+    table = minimax.TranspositionTable()
+    records = []
+    for board in get_positions(geometry, plies):
+        search_depth = min(depth, geometry.count_empty(board))
+        best_child, score = minimax.pvs(minimax.Node(board, geometry), minimax.Stats(), depth=search_depth,
+                                        get_best_child=True, table=table, ordering=minimax.MoveOrdering(geometry),
+                                        threats=True)
+        move = geometry.get_move(board, best_child.get_board())
+        records.append((board, (move, score, search_depth)))
+
+        # noinspection PyUnreachableCode
+        if __debug__:
+            if len(records) % 100 == 0:
+                print(f'Book: {len(records)} boards searched')
+
+    write_records(path, geometry, VALUE_FORMAT, records)
+    return len(records)
+
+
+def get_positions(geometry: core.Geometry, plies):
+    # The canonical boards with fewer than plies pieces and no outcome,
+    # one ply at a time.
+    positions = []
+    layer = [core.EMPTY_BOARD]
+    for ply in range(plies):
+        positions += layer
+        if ply == plies - 1:
+            break
+        next_layer = set()
+        for board in layer:
+            for child in geometry.get_children(board):
+                if geometry.check_outcome(child) is None:
+                    next_layer.add(geometry.canonical_board(child)[0])
+        layer = sorted(next_layer)
+    return positions
+
+
+# ----------------------------------------------------------------------
+# Command line
+# ----------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description='Build an opening book.')
+    parser.add_argument('--size', type=int, default=core.SIZE)
+    parser.add_argument('--win-length', type=int)
+    parser.add_argument('--plies', type=int, default=PLIES, help='number of plies the book covers')
+    parser.add_argument('--depth', type=int, default=DEPTH, help='search depth for each board')
+    parser.add_argument('--output', help=f'book file (default: in {BOOK_DIR}/, where the game looks for it)')
+    args = parser.parse_args()
+
+    geometry = core.get_geometry(args.size, args.win_length)
+    path = args.output
+    if path is None:
+        os.makedirs(BOOK_DIR, exist_ok=True)
+        path = get_book_path(geometry)
+
+    t1 = time()
+    count = build_book(geometry, path, args.plies, args.depth)
+    t2 = time()
+    print(f'Wrote {count} boards to {path} in {t2 - t1:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
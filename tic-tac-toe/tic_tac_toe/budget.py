@@ -0,0 +1,63 @@
+# Jake Herrmann
+# CS 405
+#
+# budget.py
+# Limits on how long a search may run.
+
+from time import perf_counter
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class Budget:
+
+    def __init__(self, seconds=None, nodes=None):
+        # Either limit may be None, meaning no limit of that kind.
+        self.seconds = seconds
+        self.nodes = nodes
+        self._start_time = None
+        self._stop_time = None
+        self._cancel = None
+        self._stopped = False
+
+    def start(self, cancel=None):
+        # cancel, if given, is a threading.Event that ends the search
+        # early when set. A budget that was stopped is run afresh.
+        self._start_time = perf_counter()
+        self._stop_time = None if self.seconds is None else self._start_time + self.seconds
+        self._cancel = cancel
+        self._stopped = False
+
+    def stop(self):
+        # Runs the budget out, from any thread, so that the search ends
+        # at its next check as if it had used up the budget. Unlike a
+        # cancel, which may discard the search, this keeps its result.
+        self._stopped = True
+
+    def exceeded(self, nodes):
+        if self._stopped:
+            return True
+        if self.nodes is not None and nodes >= self.nodes:
+            return True
+        if self._cancel is not None and self._cancel.is_set():
+            return True
+        return self._stop_time is not None and perf_counter() >= self._stop_time
+
+    def check(self, nodes):
+        if self.exceeded(nodes):
+            raise BudgetExceeded()
+
+    def remaining(self, nodes):
+        # An estimate of how many more nodes there is room for, given the
+        # number so far, assuming that nodes keep coming at the same rate.
+        # None if there is no limit, or if there is only a time limit and
+        # no nodes yet to estimate the rate from.
+        estimates = []
+        if self.nodes is not None:
+            estimates.append(max(0, self.nodes - nodes))
+        if self._stop_time is not None and nodes:
+            now = perf_counter()
+            estimates.append(max(0.0, nodes / (now - self._start_time) * (self._stop_time - now)))
+        return min(estimates, default=None)
@@ -4,75 +4,234 @@
 # core.py
 # Core tic-tac-toe game logic.
 
+from functools import lru_cache
+
 # ----------------------------------------------------------------------
 # Constants
 # ----------------------------------------------------------------------
 
 SIZE = 5
-OFFSET = SIZE * SIZE
 EMPTY_BOARD = 0
 
 INF = float('inf')
 NEG_INF = -INF
 
+# (row, col) steps between the cells of rows, columns, upper-left
+# diagonals and upper-right diagonals.
+LINE_DIRECTIONS = [(0, 1), (1, 0), (1, 1), (1, -1)]
 
-def mid_index():
-    mid_coord = (SIZE - 1) // 2
-    return SIZE * mid_coord + mid_coord
-
-
-MID_INDEX = mid_index()
+# Boards are permuted a byte at a time: a geometry's
+# permutation_tables[s][i][byte] is the image under symmetry s of the
+# given byte at byte position i of the (X and O) pieces.
+PERMUTATION_CHUNK = 8
+PERMUTATION_MASK = 2 ** PERMUTATION_CHUNK - 1
 
 
 # ----------------------------------------------------------------------
-# Win states
+# Geometry
 # ----------------------------------------------------------------------
 
-def get_win_states():
-    states = []
-
-    # Rows
-    row_mask = 2**SIZE - 1
-    for row in range(SIZE):
-        state = row_mask << (row * SIZE)
-        states.append(state)
-
-    # Columns
-    for col in range(SIZE):
-        col_bit = 1 << col
-        state = col_bit
-        for _ in range(SIZE - 1):
-            state <<= SIZE
-            state |= col_bit
-        states.append(state)
-
-    # Upper-left diagonal
-    state = 1
-    for _ in range(SIZE - 1):
-        state <<= (SIZE + 1)
-        state |= 1
-    states.append(state)
-
-    # Upper-right diagonal
-    top_right_bit = 1 << (SIZE - 1)
-    state = top_right_bit
-    for _ in range(SIZE - 1):
-        state <<= (SIZE - 1)
-        state |= top_right_bit
-    states.append(state)
-
-    return states
-
-
-WIN_STATES = get_win_states()
-
-
-def print_win_states():
-    print('Win states:\n')
-    for state in WIN_STATES:
-        print_win_state(state, SIZE)
-        print()
-    print('(End win states)\n')
+def get_geometry(size=SIZE, win_length=None):
+    # Returns the geometry for a size x size board on which win_length
+    # pieces in a line win. win_length defaults to size. Each geometry
+    # is only built once.
+    return _get_geometry(size, size if win_length is None else win_length)
+
+
+@lru_cache(maxsize=None)
+def _get_geometry(size, win_length):
+    return Geometry(size, win_length)
+
+
+class Geometry:
+    # A board size and win length, along with the tables that depend on
+    # them. Use get_geometry instead of creating these directly.
+
+    def __init__(self, size, win_length):
+        assert 1 <= win_length <= size
+        self.size = size
+        self.win_length = win_length
+        self.offset = size * size
+        self.mid_index = self._get_mid_index()
+        self.win_states = self._get_win_states()
+        self.cell_lines = self._get_cell_lines()
+        self.cell_win_states = [[self.win_states[line] for line in lines] for lines in self.cell_lines]
+        self.symmetries = self._get_symmetries()
+        self.inverse_symmetries = self._get_inverse_symmetries()
+        self.permutation_tables = self._get_permutation_tables()
+
+    def __repr__(self):
+        return f'Geometry(size={self.size}, win_length={self.win_length})'
+
+    # ------------------------------------------------------------------
+    # Tables
+    # ------------------------------------------------------------------
+
+    def _get_mid_index(self):
+        mid_coord = (self.size - 1) // 2
+        return self.size * mid_coord + mid_coord
+
+    def _get_win_states(self):
+        # Rows, then columns, then upper-left diagonals, then upper-right
+        # diagonals.
+        size = self.size
+        states = []
+        for row_step, col_step in LINE_DIRECTIONS:
+            for row in range(size):
+                for col in range(size):
+                    cells = [(row + i * row_step, col + i * col_step) for i in range(self.win_length)]
+                    if all(0 <= r < size and 0 <= c < size for r, c in cells):
+                        state = 0
+                        for r, c in cells:
+                            state |= 1 << (size * r + c)
+                        states.append(state)
+        return states
+
+    def _get_cell_lines(self):
+        # For each cell, the indices of the win states that contain it.
+        return [[i for i, state in enumerate(self.win_states) if state >> index & 1] for index in range(self.offset)]
+
+    def _get_symmetries(self):
+        # Each symmetry of the square is a list mapping each cell index
+        # to the index it moves to. The identity comes first.
+        size = self.size
+        last = size - 1
+        coord_maps = [
+            lambda row, col: (row, col),
+            lambda row, col: (col, last - row),
+            lambda row, col: (last - row, last - col),
+            lambda row, col: (last - col, row),
+            lambda row, col: (row, last - col),
+            lambda row, col: (last - row, col),
+            lambda row, col: (col, row),
+            lambda row, col: (last - col, last - row),
+        ]
+        symmetries = []
+        for coord_map in coord_maps:
+            symmetry = []
+            for index in range(self.offset):
+                row, col = coord_map(*divmod(index, size))
+                symmetry.append(size * row + col)
+            symmetries.append(symmetry)
+        return symmetries
+
+    def _get_inverse_symmetries(self):
+        inverses = []
+        for symmetry in self.symmetries:
+            inverse = [0] * self.offset
+            for index, image in enumerate(symmetry):
+                inverse[image] = index
+            inverses.append(inverse)
+        return inverses
+
+    def _get_permutation_tables(self):
+        offset = self.offset
+        piece_bits = 2 * offset
+        tables = []
+        for symmetry in self.symmetries:
+            chunk_tables = []
+            for chunk_start in range(0, piece_bits, PERMUTATION_CHUNK):
+                chunk_table = []
+                for byte in range(PERMUTATION_MASK + 1):
+                    image = 0
+                    for bit in range(PERMUTATION_CHUNK):
+                        pos = chunk_start + bit
+                        if byte >> bit & 1 and pos < piece_bits:
+                            image |= 1 << (symmetry[pos % offset] + offset * (pos // offset))
+                    chunk_table.append(image)
+                chunk_tables.append(chunk_table)
+            tables.append(chunk_tables)
+        return tables
+
+    def print_win_states(self):
+        print('Win states:\n')
+        for state in self.win_states:
+            print_win_state(state, self.size)
+            print()
+        print('(End win states)\n')
+
+    # ------------------------------------------------------------------
+    # Symmetries
+    # ------------------------------------------------------------------
+
+    def transform_board(self, board, symmetry_index):
+        pieces = board >> 1
+        image = 0
+        for chunk_table in self.permutation_tables[symmetry_index]:
+            image |= chunk_table[pieces & PERMUTATION_MASK]
+            pieces >>= PERMUTATION_CHUNK
+        return (image << 1) | (board & 1)
+
+    def canonical_board(self, board):
+        # Returns the smallest of the board's symmetric images and the
+        # index of the symmetry that produces it.
+        return min((self.transform_board(board, i), i) for i in range(len(self.symmetries)))
+
+    def transform_move(self, index, symmetry_index):
+        return self.symmetries[symmetry_index][index]
+
+    def untransform_move(self, index, symmetry_index):
+        # Maps a move on a transformed board back to the original board.
+        return self.inverse_symmetries[symmetry_index][index]
+
+    # ------------------------------------------------------------------
+    # Bitboard functions
+    # ------------------------------------------------------------------
+
+    def add_move(self, index, board):
+        move_bit = 0b10 << index
+        move_bit <<= (self.offset * turn_bit(board))
+        return (board ^ 1) | move_bit
+
+    def get_move(self, board, child):
+        # Inverse of add_move: the index of the move that turns board
+        # into child.
+        move_bit = (board ^ child) >> 1
+        return (move_bit.bit_length() - 1) % self.offset
+
+    def legal_moves(self, board):
+        moves = []
+        pieces, O_pieces = self.split_board(board)
+        pieces |= O_pieces
+        for i in range(self.offset):
+            if not (pieces & 1):
+                moves.append(i)
+            pieces >>= 1
+        return moves
+
+    def get_children(self, board):
+        return [self.add_move(index, board) for index in self.legal_moves(board)]
+
+    def check_outcome(self, board):
+        pieces, O_pieces = self.split_board(board)
+        for state in self.win_states:
+            if pieces & state == state:
+                return INF
+            if O_pieces & state == state:
+                return NEG_INF
+        return 0 if count_bits(pieces) == self.offset else None
+
+    def count_pieces(self, board):
+        # X's and O's pieces are in separate bits, so one popcount counts
+        # both.
+        return count_bits(board >> 1)
+
+    def count_empty(self, board):
+        return self.offset - self.count_pieces(board)
+
+    def split_indices(self, board):
+        pieces, O_pieces = self.split_board(board)
+        return self.get_indices(pieces), self.get_indices(O_pieces)
+
+    def get_indices(self, pieces):
+        for i in range(self.offset):
+            if pieces & 1:
+                yield i
+            pieces >>= 1
+
+    def split_board(self, board):
+        pieces = board >> 1
+        return pieces, pieces >> self.offset
 
 
 def print_win_state(state, size):
@@ -85,70 +244,154 @@ def print_win_state(state, size):
     assert state == 0
 
 
-# noinspection PyUnreachableCode
-if __debug__:
-    print_win_states()
-
-
 # ----------------------------------------------------------------------
-# Bitboard functions
+# Line counts
 # ----------------------------------------------------------------------
 
-def add_move(index, board):
-    move_bit = 0b10 << index
-    move_bit <<= (OFFSET * turn_bit(board))
-    return (board ^ 1) | move_bit
+class LineCounts:
+    # Counts of each player's pieces in each win state of a board, which
+    # give the outcome and max connected pieces of the board's children
+    # in O(win states through the move's cell). The counts of a child
+    # are derived from its parent's the same way (see after).
+
+    def __init__(self, geometry: Geometry, board):
+        pieces, O_pieces = geometry.split_board(board)
+
+        self._geometry = geometry
+        self._board = board
+        self._O_turn = turn_bit(board)
+        self._empty = geometry.offset - count_bits(pieces)
+
+        self._X_counts = [count_bits(pieces & state) for state in geometry.win_states]
+        self._O_counts = [count_bits(O_pieces & state) for state in geometry.win_states]
+
+        # X_open[n] is the number of win states with n X pieces and no O
+        # pieces, and vice versa for O_open.
+        self._X_open = [0] * (geometry.win_length + 1)
+        self._O_open = [0] * (geometry.win_length + 1)
+        for X_count, O_count in zip(self._X_counts, self._O_counts):
+            if not O_count:
+                self._X_open[X_count] += 1
+            if not X_count:
+                self._O_open[O_count] += 1
+
+    def get_board(self):
+        return self._board
+
+    def after(self, index):
+        # Returns the LineCounts of the child for the given move, only
+        # updating the win states through the move's cell. The board must
+        # not have an outcome.
+        child = object.__new__(LineCounts)
+        child._geometry = self._geometry
+        child._board = self._geometry.add_move(index, self._board)
+        child._O_turn = 1 - self._O_turn
+        child._empty = self._empty - 1
+        child._X_counts = X_counts = self._X_counts.copy()
+        child._O_counts = O_counts = self._O_counts.copy()
+        child._X_open = X_open = self._X_open.copy()
+        child._O_open = O_open = self._O_open.copy()
+
+        if self._O_turn:
+            mover_counts, other_counts, mover_open, other_open = O_counts, X_counts, O_open, X_open
+        else:
+            mover_counts, other_counts, mover_open, other_open = X_counts, O_counts, X_open, O_open
+        for line in self._geometry.cell_lines[index]:
+            mover_count = mover_counts[line]
+            if not other_counts[line]:
+                mover_open[mover_count] -= 1
+                mover_open[mover_count + 1] += 1
+            if not mover_count:
+                other_open[other_counts[line]] -= 1
+            mover_counts[line] = mover_count + 1
+        return child
+
+    def after_move(self, index):
+        # Returns the outcome of the child for the given move (as
+        # check_outcome would) and the max connected pieces of X and O
+        # in the child. The board must not have an outcome.
+        if self._O_turn:
+            mover_counts, other_counts = self._O_counts, self._X_counts
+            mover_open, other_open = self._O_open.copy(), self._X_open.copy()
+            win = NEG_INF
+        else:
+            mover_counts, other_counts = self._X_counts, self._O_counts
+            mover_open, other_open = self._X_open.copy(), self._O_open.copy()
+            win = INF
+
+        win_length = self._geometry.win_length
+        outcome = None
+        for line in self._geometry.cell_lines[index]:
+            mover_count = mover_counts[line]
+            if not other_counts[line]:
+                mover_open[mover_count] -= 1
+                mover_open[mover_count + 1] += 1
+                if mover_count + 1 == win_length:
+                    outcome = win
+            if not mover_count:
+                other_open[other_counts[line]] -= 1
+
+        if outcome is None and self._empty == 1:
+            outcome = 0
+
+        if self._O_turn:
+            return outcome, max_open(other_open), max_open(mover_open)
+        return outcome, max_open(mover_open), max_open(other_open)
+
+
+def max_open(open_counts):
+    for count in range(len(open_counts) - 1, 0, -1):
+        if open_counts[count]:
+            return count
+    return 0
 
 
+# ----------------------------------------------------------------------
+# Geometry-independent bitboard functions
+# ----------------------------------------------------------------------
+
 def turn_bit(board):
     return board & 1
 
 
-def legal_moves(board):
-    moves = []
-    pieces, O_pieces = split_board(board)
-    pieces |= O_pieces
-    for i in range(OFFSET):
-        if not (pieces & 1):
-            moves.append(i)
-        pieces >>= 1
-    return moves
-
-
-def get_children(board):
-    return [add_move(index, board) for index in legal_moves(board)]
-
-
-def check_outcome(board):
-    pieces, O_pieces = split_board(board)
-    for state in WIN_STATES:
-        if pieces & state == state:
-            return INF
-        if O_pieces & state == state:
-            return NEG_INF
-    return 0 if count_bits(pieces) == OFFSET else None
-
+# A popcount: int.bit_count where there is one (Python 3.10+), or else
+# counting the ones in the binary string, which is also done in C.
+if hasattr(int, 'bit_count'):
+    count_bits = int.bit_count
+else:
+    def count_bits(num):
+        return bin(num).count('1')
 
-def count_bits(num):
-    count = 0
-    while num != 0:
-        count += num & 1
-        num >>= 1
-    return count
 
+# ----------------------------------------------------------------------
+# Default geometry
+# ----------------------------------------------------------------------
 
-def split_indices(board):
-    pieces, O_pieces = split_board(board)
-    return get_indices(pieces), get_indices(O_pieces)
-
-
-def get_indices(pieces):
-    for i in range(OFFSET):
-        if pieces & 1:
-            yield i
-        pieces >>= 1
-
+# Module-level shortcuts for the default SIZE x SIZE game.
+
+DEFAULT_GEOMETRY = get_geometry()
+
+OFFSET = DEFAULT_GEOMETRY.offset
+MID_INDEX = DEFAULT_GEOMETRY.mid_index
+WIN_STATES = DEFAULT_GEOMETRY.win_states
+CELL_LINES = DEFAULT_GEOMETRY.cell_lines
+SYMMETRIES = DEFAULT_GEOMETRY.symmetries
+
+transform_board = DEFAULT_GEOMETRY.transform_board
+canonical_board = DEFAULT_GEOMETRY.canonical_board
+transform_move = DEFAULT_GEOMETRY.transform_move
+untransform_move = DEFAULT_GEOMETRY.untransform_move
+add_move = DEFAULT_GEOMETRY.add_move
+get_move = DEFAULT_GEOMETRY.get_move
+legal_moves = DEFAULT_GEOMETRY.legal_moves
+get_children = DEFAULT_GEOMETRY.get_children
+check_outcome = DEFAULT_GEOMETRY.check_outcome
+count_pieces = DEFAULT_GEOMETRY.count_pieces
+count_empty = DEFAULT_GEOMETRY.count_empty
+split_indices = DEFAULT_GEOMETRY.split_indices
+get_indices = DEFAULT_GEOMETRY.get_indices
+split_board = DEFAULT_GEOMETRY.split_board
 
-def split_board(board):
-    pieces = board >> 1
-    return pieces, pieces >> OFFSET
+# noinspection PyUnreachableCode
+if __debug__:
+    DEFAULT_GEOMETRY.print_win_states()
@@ -0,0 +1,225 @@
+# Jake Herrmann
+# CS 405
+#
+# engine.py
+# A line protocol for running the engines without the GUI.
+#
+# Commands are read from stdin, one per line:
+#
+#   position [<move> ...]       Sets up the game with the given moves from
+#                               the empty board, as cell indices (row-major,
+#                               starting at 0).
+#   budget [seconds <seconds>] [nodes <nodes>]
+#                               Sets the limits of each search. With
+#                               neither, a search runs until stop.
+#   go                          Searches the position, writing info lines as
+#                               it goes and then "bestmove <move>".
+#   stop                        Ends the search, which writes its best move
+#                               so far before the next command is read.
+#   isready                     Writes "readyok".
+#   quit                        Ends the search, if any, and exits.
+#
+# Info lines are "info depth <depth> nodes <nodes> score <score>", where
+# the score is for the player to move: "win", "loss" or "draw" once the
+# search proves it, and otherwise minimax's evaluation or the win ratio
+# of MCTS's best move. A bad command gets "error <message>". At the end
+# of stdin, the engine exits once its search is done.
+#
+# Run with -O, since the debugging output otherwise starts when the
+# modules are imported. After that it goes to stderr, so that stdout
+# only has the protocol's lines.
+
+import argparse
+import sys
+from threading import Lock
+
+from . import background, book, core, mcts, minimax, tablebase
+from .budget import Budget
+
+# ----------------------------------------------------------------------
+# Constants
+# ----------------------------------------------------------------------
+
+MINIMAX = 'minimax'
+MCTS = 'mcts'
+
+ENGINES = [MINIMAX, MCTS]
+
+# Search time used until a budget is set.
+SECONDS = 5
+
+
+# ----------------------------------------------------------------------
+# Engine
+# ----------------------------------------------------------------------
+
+class Engine:
+    # Runs the commands of the protocol with a minimax.Tree or an
+    # mcts.Tree, writing its lines to output. Searches run on a
+    # background.Worker, so that stop can end them.
+
+    commands = {
+        'position': '_position',
+        'budget': '_budget',
+        'go': '_go',
+        'stop': '_stop',
+        'isready': '_is_ready',
+        'quit': '_quit',
+    }
+
+    def __init__(self, geometry: core.Geometry = core.DEFAULT_GEOMETRY, engine=MINIMAX, output=sys.stdout,
+                 book=None, tablebase=None):
+        # book and tablebase, if given, are passed on to the tree (see
+        # minimax.Tree and mcts.Tree).
+        assert engine in ENGINES
+        self._geometry = geometry
+        if engine == MINIMAX:
+            self._tree = minimax.Tree(geometry, use_pvs=True, use_threats=True, book=book, tablebase=tablebase)
+        else:
+            self._tree = mcts.Tree(geometry, book=book, tablebase=tablebase)
+        self._engine = engine
+        self._output = output
+        self._output_lock = Lock()
+        self._worker = background.Worker()
+        self._board = core.EMPTY_BOARD
+        self._seconds = SECONDS
+        self._nodes = None
+        self._search = None
+        self._search_budget = None
+
+    def handle(self, line):
+        # Runs the command on the line. Returns False after quit.
+        words = line.split()
+        if not words:
+            return True
+        if words[0] not in Engine.commands:
+            self._write(f'error unknown command: {words[0]}')
+            return True
+        try:
+            return getattr(self, Engine.commands[words[0]])(words[1:]) is not False
+        except ValueError as error:
+            self._write(f'error {error}')
+            return True
+
+    def wait(self):
+        # Waits for the search, if any, to write its best move.
+        if self._search is not None:
+            self._search.future.result()
+            self._search = None
+
+    def searching(self):
+        return self._search is not None and not self._search.done()
+
+    def _position(self, args):
+        if self.searching():
+            raise ValueError('search in progress')
+        geometry = self._geometry
+        board = core.EMPTY_BOARD
+        for arg in args:
+            move = int(arg) if arg.isdigit() else None
+            if move not in geometry.legal_moves(board) or geometry.check_outcome(board) is not None:
+                raise ValueError(f'illegal move: {arg}')
+            board = geometry.add_move(move, board)
+        self._board = board
+
+    def _budget(self, args):
+        if len(args) % 2:
+            raise ValueError('budget takes pairs of a limit and its value')
+        limits = {'seconds': None, 'nodes': None}
+        for name, value in zip(args[::2], args[1::2]):
+            if name not in limits:
+                raise ValueError(f'unknown limit: {name}')
+            limits[name] = float(value) if name == 'seconds' else int(value)
+        self._seconds = limits['seconds']
+        self._nodes = limits['nodes']
+
+    def _go(self, args):
+        if self.searching():
+            raise ValueError('search in progress')
+        if self._geometry.check_outcome(self._board) is not None:
+            raise ValueError('the game is over')
+        self.wait()
+        self._search_budget = Budget(self._seconds, self._nodes)
+        self._search = self._worker.submit(self._run_search, self._board)
+
+    def _stop(self, args):
+        # Returns once the search has written its best move.
+        if self.searching():
+            self._search_budget.stop()
+        self.wait()
+
+    def _is_ready(self, args):
+        self._write('readyok')
+
+    def _quit(self, args):
+        self._stop(args)
+        self._worker.shutdown()
+        return False
+
+    def _run_search(self, board, cancel=None, progress=None):
+        # Runs on the worker thread. The search stops with its budget,
+        # not cancel, so that it always has a move.
+        def report(stats):
+            progress(stats)
+            self._write(self._get_info(board, stats))
+
+        next_board = self._tree.get_next_board(board, progress=report, budget=self._search_budget)
+        self._write(f'bestmove {self._geometry.get_move(board, next_board)}')
+        return next_board
+
+    def _get_info(self, board, stats):
+        # The info line for the stats of a search from the board, while
+        # the search (on this thread) isn't changing the tree.
+        sign = -1 if core.turn_bit(board) else 1
+        if self._engine == MINIMAX:
+            val = stats.val
+            if val in (core.INF, core.NEG_INF) or (val == 0 and stats.depth >= self._geometry.count_empty(board)):
+                score = format_outcome(sign * val)
+            else:
+                score = f'{sign * val:g}'
+            nodes = stats.visited
+        else:
+            root = self._tree.root()
+            if root.has_outcome():
+                score = format_outcome(sign * root.outcome())
+            else:
+                best_child = max(root.children(), key=lambda child: child.simulations(), default=None)
+                score = '0' if best_child is None else mcts.format_ratio(best_child.wins(),
+                                                                            best_child.simulations())
+            nodes = stats.iterations
+        return f'info depth {stats.depth} nodes {nodes} score {score}'
+
+    def _write(self, line):
+        with self._output_lock:
+            print(line, file=self._output, flush=True)
+
+
+def format_outcome(outcome):
+    # Formats an outcome for the player to move.
+    return {core.INF: 'win', core.NEG_INF: 'loss', 0: 'draw'}[outcome]
+
+
+# ----------------------------------------------------------------------
+# Command line
+# ----------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description='Run an engine over a line protocol on stdin and stdout.')
+    parser.add_argument('--engine', choices=ENGINES, default=MINIMAX)
+    parser.add_argument('--size', type=int, default=core.SIZE)
+    parser.add_argument('--win-length', type=int)
+    args = parser.parse_args()
+
+    geometry = core.get_geometry(args.size, args.win_length)
+    output = sys.stdout
+    sys.stdout = sys.stderr
+    engine = Engine(geometry, args.engine, output, book.load_book(geometry), tablebase.load_tablebase(geometry))
+    for line in sys.stdin:
+        if not engine.handle(line):
+            return
+    engine.wait()
+    engine.handle('quit')
+
+
+if __name__ == '__main__':
+    main()
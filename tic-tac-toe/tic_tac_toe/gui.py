@@ -11,14 +11,19 @@ import tkinter.messagebox
 from datetime import datetime, timezone
 from random import randint
 
-from . import core, minimax, mcts
+from . import background, book, core, minimax, mcts, pns, tablebase
+from .budget import Budget
 
 # ----------------------------------------------------------------------
 # Constants
 # ----------------------------------------------------------------------
 
 CELL_SIZE = 100
-CANVAS_SIZE = core.SIZE * CELL_SIZE
+
+SIZES = [3, 4, 5, 6, 7]
+
+# Time the solver gets before the Solver player falls back to minimax.
+SOLVER_SECONDS = 5
 
 BG = 'black'
 FG = 'white'
@@ -35,12 +40,14 @@ class Game:
     RANDOM = 'Random moves'
     MINIMAX = 'Minimax'
     MCTS = 'MCTS'
+    SOLVER = 'Solver'
 
     move_funcs = {
         HUMAN: '_human_move_func',
         RANDOM: '_random_move_func',
         MINIMAX: '_minimax_move_func',
         MCTS: '_mcts_move_func',
+        SOLVER: '_solver_move_func',
     }
 
     def _get_move_func(self, name):
@@ -50,26 +57,80 @@ class Game:
         if self._human_move is not None:
             human_move = self._human_move
             self._human_move = None
-            if human_move in core.legal_moves(self._current_board()):
-                return core.add_move(human_move, self._current_board())
+            if human_move in self._geometry.legal_moves(self._current_board()):
+                return self._geometry.add_move(human_move, self._current_board())
 
     def _random_move_func(self):
-        moves = core.legal_moves(self._current_board())
-        return core.add_move(moves[randint(0, len(moves) - 1)], self._current_board())
+        moves = self._geometry.legal_moves(self._current_board())
+        return self._geometry.add_move(moves[randint(0, len(moves) - 1)], self._current_board())
 
     def _minimax_move_func(self):
         board = self._current_board()
         if board == core.EMPTY_BOARD:
-            return core.add_move(core.MID_INDEX, core.EMPTY_BOARD)
-        return minimax.tree.get_next_board(board)
+            return self._geometry.add_move(self._geometry.mid_index, core.EMPTY_BOARD)
+        return self._search_move(self._minimax_tree.get_next_board)
 
     def _mcts_move_func(self):
         board = self._current_board()
         if board == core.EMPTY_BOARD:
-            return core.add_move(core.MID_INDEX, core.EMPTY_BOARD)
-        return mcts.tree.get_next_board(board)
+            return self._geometry.add_move(self._geometry.mid_index, core.EMPTY_BOARD)
+        return self._search_move(self._mcts_tree.get_next_board)
+
+    def _solver_move_func(self):
+        # Plays a proven best move if the solver finds one in time, and
+        # the minimax move otherwise.
+        board = self._current_board()
+        if board == core.EMPTY_BOARD:
+            return self._geometry.add_move(self._geometry.mid_index, core.EMPTY_BOARD)
+        return self._search_move(self._solver.get_next_board)
+
+    def _search_move(self, search):
+        # Searches run on the worker thread so that they don't block the
+        # GUI. Returns None until the search for the current board is
+        # done.
+        if self._search is None:
+            self._search = worker.submit(search, self._current_board())
+            return None
+        if not self._search.done():
+            return None
+        job = self._search
+        self._search = None
+        return job.result()
+
+    def cancel_search(self):
+        if self._search is not None:
+            self._search.cancel()
+            self._search = None
+        self._stop_pondering()
+
+    def _start_pondering(self):
+        # While a human thinks about their move, an engine opponent keeps
+        # searching from the current board.
+        board = self._current_board()
+        if core.turn_bit(board):
+            mover, opponent = self._Omover, self._Xmover
+        else:
+            mover, opponent = self._Xmover, self._Omover
+        trees = {Game.MINIMAX: self._minimax_tree, Game.MCTS: self._mcts_tree}
+        if self._outcome is None and mover == Game.HUMAN and opponent in trees:
+            self._pondering = worker.submit(trees[opponent].ponder, board)
+
+    def _stop_pondering(self):
+        if self._pondering is not None:
+            self._pondering.cancel()
+            self._pondering = None
 
     def __init__(self):
+        self._geometry = None
+        self._book = None
+        self._tablebase = None
+        self._minimax_tree = None
+        self._mcts_tree = None
+        self._solver = None
+        self._set_geometry(core.DEFAULT_GEOMETRY)
+        self._search = None
+        self._pondering = None
+
         self._game_active = False
         self._Xmover = None
         self._Omover = None
@@ -81,7 +142,13 @@ class Game:
         self._moveX_func = None
         self._moveO_func = None
 
-    def _set_game_fields(self, game_active, Xmover, Omover, outcome, human_move, boards, history_index):
+    def _set_game_fields(self, geometry, game_active, Xmover, Omover, outcome, human_move, boards, history_index):
+        self.cancel_search()
+
+        if geometry is not self._geometry:
+            self._set_geometry(geometry)
+            resize_canvas(geometry)
+
         self._game_active = game_active
         self._Xmover = Xmover
         self._Omover = Omover
@@ -93,12 +160,25 @@ class Game:
         self._moveX_func = self._get_move_func(Xmover)
         self._moveO_func = self._get_move_func(Omover)
 
+    def _set_geometry(self, geometry):
+        # New engines for the geometry, which use its opening book and
+        # tablebase if they have been built (see book.py and
+        # tablebase.py). A search that was just cancelled may still be
+        # reading the old ones, so they stay open.
+        self._geometry = geometry
+        self._book = book.load_book(geometry)
+        self._tablebase = tablebase.load_tablebase(geometry)
+        self._minimax_tree = minimax.Tree(geometry, use_pvs=True, use_threats=True, book=self._book,
+                                          tablebase=self._tablebase)
+        self._mcts_tree = mcts.Tree(geometry, book=self._book, tablebase=self._tablebase)
+        self._solver = new_solver(geometry, self._minimax_tree)
+
     def active(self):
         return self._game_active
 
     def handle_click(self, event):
         if self._history_index == len(self._boards) - 1:
-            self._human_move = point_to_index(event.x, event.y)
+            self._human_move = point_to_index(event.x, event.y, self._geometry)
 
     def inc_history_index(self):
         if self._history_index < len(self._boards) - 1:
@@ -106,26 +186,39 @@ class Game:
             self._refresh_display()
 
     def dec_history_index(self):
+        # The game is paused until the history is back at the current
+        # board.
         if self._history_index > 0:
+            self.cancel_search()
             self._history_index -= 1
             self._refresh_display()
 
     def make_move(self):
+        if self._history_index != len(self._boards) - 1:
+            return
+
         next_board = self._moveO_func() if core.turn_bit(self._current_board()) else self._moveX_func()
 
+        if next_board is None and self._search is not None:
+            status_line['text'] = self._get_status()
+
         if next_board is not None:
-            assert next_board in core.get_children(self._current_board())
+            assert next_board in self._geometry.get_children(self._current_board())
+            self._stop_pondering()
             self._boards.append(next_board)
-            self._outcome = core.check_outcome(self._current_board())
+            self._outcome = self._geometry.check_outcome(self._current_board())
             self._history_index = len(self._boards) - 1
             self._refresh_display()
 
             if self._outcome is not None:
                 self._game_active = False
                 self._save_summary()
+            else:
+                self._start_pondering()
 
-    def new_game(self, Xmover, Omover):
+    def new_game(self, Xmover, Omover, geometry):
         self._set_game_fields(
+            geometry=geometry,
             game_active=True,
             Xmover=Xmover,
             Omover=Omover,
@@ -135,32 +228,34 @@ class Game:
             history_index=0
         )
         self._refresh_display()
+        self._start_pondering()
         timer()
 
     def load_old_game(self, name):
         with open(os.path.join(HISTORY_DIR, name), 'r') as f:
             summary = json.loads(f.read())
 
-        if summary['size'] == core.SIZE:
-            self._set_game_fields(
-                game_active=False,
-                Xmover=summary['X player'],
-                Omover=summary['O player'],
-                outcome=self._parse_outcome(summary['outcome']),
-                human_move=None,
-                boards=summary['history'],
-                history_index=len(summary['history']) - 1
-            )
-            self._refresh_display()
-        else:
-            tkinter.messagebox.showerror(message='Selected game used a different board size')
+        # Games saved before the win length was configurable have no win
+        # length, and were won by filling a whole line.
+        self._set_game_fields(
+            geometry=core.get_geometry(summary['size'], summary.get('win length')),
+            game_active=False,
+            Xmover=summary['X player'],
+            Omover=summary['O player'],
+            outcome=self._parse_outcome(summary['outcome']),
+            human_move=None,
+            boards=summary['history'],
+            history_index=len(summary['history']) - 1
+        )
+        self._refresh_display()
 
     def _save_summary(self):
         summary = json.dumps(
             {'X player': self._Xmover,
              'O player': self._Omover,
              'outcome': str(self._outcome),
-             'size': core.SIZE,
+             'size': self._geometry.size,
+             'win length': self._geometry.win_length,
              'history': self._boards}
         )
         with open(os.path.join(HISTORY_DIR, datetime.now(timezone.utc).isoformat() + '.json'), 'w') as f:
@@ -170,7 +265,7 @@ class Game:
         return self._boards[-1]
 
     def _refresh_display(self):
-        draw_board(self._boards[self._history_index])
+        draw_board(self._boards[self._history_index], self._geometry)
         status_line['text'] = self._get_status()
         root.update()
 
@@ -178,9 +273,18 @@ class Game:
         return '\n'.join([
             f'{self._Xmover} (X) vs. {self._Omover} (O)',
             f'Result: {self._outcome_status(self._outcome)}',
-            f'Move: {self._history_index}'
+            f'Move: {self._history_index}',
+            self._search_status(),
         ])
 
+    def _search_status(self):
+        if self._search is None:
+            return ''
+        stats = self._search.progress()
+        if stats is None:
+            return 'Searching'
+        return f'Searching: {stats.visited} nodes visited'
+
     @staticmethod
     def _outcome_status(outcome):
         if outcome is core.INF:
@@ -202,13 +306,18 @@ class Game:
         return 0
 
 
+def new_solver(geometry, minimax_tree):
+    return pns.Solver(geometry, Budget(seconds=SOLVER_SECONDS), fallback=minimax_tree)
+
+
 # ----------------------------------------------------------------------
 # Global objects
 # ----------------------------------------------------------------------
 
 root = tkinter.Tk()
-canvas = tkinter.Canvas(root, bg=BG, width=CANVAS_SIZE, height=CANVAS_SIZE)
+canvas = tkinter.Canvas(root, bg=BG)
 status_line = tkinter.Label(root)
+worker = background.Worker()
 game = Game()
 
 
@@ -228,21 +337,31 @@ def timer():
 
 def new_game_command():
     def _new_game():
+        if win_length.get() > size.get():
+            tkinter.messagebox.showerror(message='Win length cannot be greater than board size')
+            return
         window.destroy()
-        game.new_game(Xmover=Xmover.get(), Omover=Omover.get())
+        geometry = core.get_geometry(size.get(), win_length.get())
+        game.new_game(Xmover=Xmover.get(), Omover=Omover.get(), geometry=geometry)
 
     window = tkinter.Toplevel()
-    window.geometry('300x150')
+    window.geometry('300x200')
     window.wm_title('New game')
 
     Xmover = tkinter.StringVar(window, value=Game.MINIMAX)
     Omover = tkinter.StringVar(window, value=Game.MINIMAX)
+    size = tkinter.IntVar(window, value=core.SIZE)
+    win_length = tkinter.IntVar(window, value=core.SIZE)
 
     Xmover_label = tkinter.Label(window, text='X player:')
     Omover_label = tkinter.Label(window, text='O player:')
+    size_label = tkinter.Label(window, text='Board size:')
+    win_length_label = tkinter.Label(window, text='Win length:')
 
     Xmover_menu = tkinter.OptionMenu(window, Xmover, *Game.move_funcs.keys())
     Omover_menu = tkinter.OptionMenu(window, Omover, *Game.move_funcs.keys())
+    size_menu = tkinter.OptionMenu(window, size, *SIZES)
+    win_length_menu = tkinter.OptionMenu(window, win_length, *SIZES)
 
     button = tkinter.Button(window, text='Play', command=_new_game)
 
@@ -252,7 +371,13 @@ def new_game_command():
     Omover_label.grid(row=1, column=0)
     Omover_menu.grid(row=1, column=1)
 
-    button.grid(row=2, column=0)
+    size_label.grid(row=2, column=0)
+    size_menu.grid(row=2, column=1)
+
+    win_length_label.grid(row=3, column=0)
+    win_length_menu.grid(row=3, column=1)
+
+    button.grid(row=4, column=0)
 
 
 def history_command():
@@ -282,29 +407,39 @@ def history_command():
 # Drawing functions
 # ----------------------------------------------------------------------
 
-def draw_board(board):
+def resize_canvas(geometry):
+    canvas_size = canvas_size_for(geometry)
+    canvas.config(width=canvas_size, height=canvas_size)
+
+
+def canvas_size_for(geometry):
+    return geometry.size * CELL_SIZE
+
+
+def draw_board(board, geometry):
     canvas.delete('all')
-    draw_grid()
-    draw_pieces(board)
+    draw_grid(geometry)
+    draw_pieces(board, geometry)
 
 
-def draw_grid():
-    for cell in range(core.SIZE):
+def draw_grid(geometry):
+    canvas_size = canvas_size_for(geometry)
+    for cell in range(geometry.size):
         pos = cell * CELL_SIZE
-        canvas.create_line(pos, 0, pos, CANVAS_SIZE, fill=FG)
-        canvas.create_line(0, pos, CANVAS_SIZE, pos, fill=FG)
+        canvas.create_line(pos, 0, pos, canvas_size, fill=FG)
+        canvas.create_line(0, pos, canvas_size, pos, fill=FG)
 
 
-def draw_pieces(board):
-    X_indices, O_indices = core.split_indices(board)
+def draw_pieces(board, geometry):
+    X_indices, O_indices = geometry.split_indices(board)
     for i in X_indices:
-        draw_piece(i, 'X')
+        draw_piece(i, 'X', geometry)
     for i in O_indices:
-        draw_piece(i, 'O')
+        draw_piece(i, 'O', geometry)
 
 
-def draw_piece(index, char):
-    x, y = index_to_point(index)
+def draw_piece(index, char, geometry):
+    x, y = index_to_point(index, geometry)
     canvas.create_text(x, y, text=char, font='Mono 32', fill=FG)
 
 
@@ -312,14 +447,14 @@ def draw_piece(index, char):
 # Coordinate conversion functions
 # ----------------------------------------------------------------------
 
-def point_to_index(x, y):
+def point_to_index(x, y, geometry):
     row = y // CELL_SIZE
     col = x // CELL_SIZE
-    return core.SIZE * row + col
+    return geometry.size * row + col
 
 
-def index_to_point(index):
-    row, col = divmod(index, core.SIZE)
+def index_to_point(index, geometry):
+    row, col = divmod(index, geometry.size)
     return center_coord(col), center_coord(row)
 
 
@@ -337,6 +472,7 @@ def main():
 
     root.title('Tic-tac-toe')
     root.resizable(False, False)
+    resize_canvas(core.DEFAULT_GEOMETRY)
 
     canvas.bind('<Button-1>', game.handle_click)
 
@@ -353,3 +489,4 @@ def main():
     history_inc_button.pack(side=tkinter.LEFT)
 
     root.mainloop()
+    game.cancel_search()
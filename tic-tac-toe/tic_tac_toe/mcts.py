@@ -4,12 +4,34 @@
 # mcts.py
 # Monte Carlo tree search (MCTS).
 
+from concurrent.futures import ProcessPoolExecutor, wait
 from dataclasses import dataclass
 from math import sqrt, log
-from random import randint
+from multiprocessing import Event
+from random import Random, random
+from threading import Lock, Thread
 from time import time
 
 from . import core
+from .arena import Arena, CAPACITY
+from .batch import BatchRollouts
+from .budget import Budget, BudgetExceeded
+from .playout import Playout, UNIFORM
+from .threats import get_moves
+
+# ----------------------------------------------------------------------
+# Constants
+# ----------------------------------------------------------------------
+
+# Search time used when a Tree has no budget.
+SECONDS = 10
+
+# Kinds of parallel search (see Tree).
+ROOT_PARALLEL = 'root'
+TREE_PARALLEL = 'tree'
+
+# Seconds between checks for a cancel while waiting for workers.
+WAIT_INTERVAL = 0.05
 
 
 # ----------------------------------------------------------------------
@@ -18,16 +40,111 @@ from . import core
 
 class Tree:
 
-    def __init__(self):
-        self._root = Node(core.EMPTY_BOARD)
-
-    def get_next_board(self, board):
-        self._update_root(board)
-
+    def __init__(self, geometry: core.Geometry = core.DEFAULT_GEOMETRY, budget: Budget = None, capacity=CAPACITY,
+                 book=None, tablebase=None, batch_size=None, workers=None, parallelism=ROOT_PARALLEL, seed=None,
+                 share=None, rave=None, policy=None, cutoff=None, memory=None):
+        # budget limits the time and number of iterations (its nodes) of
+        # each search, which runs for SECONDS without one. A search also
+        # stops once its best move can't change (see mcts). capacity is
+        # the maximum number of nodes in the tree, or memory, if given, is
+        # a limit in bytes that sets it instead. Once it is reached,
+        # rollouts go on without adding nodes. Between searches, the tree
+        # keeps the subtree of the current board, pruned to its most
+        # visited nodes once it gets big (see Arena.collect). book, if
+        # given, is a book.Book whose moves are played without searching,
+        # and so are the moves of tablebase, a tablebase.Tablebase, whose
+        # outcomes also end rollouts at the nodes it has (see Arena). With
+        # batch_size, each rollout is a batch of that many games played
+        # with NumPy (see batch.py).
+        #
+        # With workers, each search runs in that many workers. With
+        # parallelism ROOT_PARALLEL, they are processes that each search
+        # a tree of their own (see root_parallel_mcts), which don't last
+        # past the search, so there is no pondering. With TREE_PARALLEL,
+        # they are threads that share this tree (see
+        # tree_parallel_mcts). seed, if given, seeds the tree's own random
+        # number generator, which plays the games of its rollouts and
+        # picks among unvisited children, so that with a budget of nodes
+        # the searches are reproducible. Root-parallel workers and
+        # batched rollouts get seeds of their own. Tree-parallel threads
+        # share the tree's generator, so their games still depend on how
+        # the threads are scheduled.
+        #
+        # share, if given, is arena.SHARE_BOARDS or
+        # arena.SHARE_SYMMETRIES, and makes positions reached by
+        # different move orders (or, with SHARE_SYMMETRIES, symmetric
+        # positions) share one node (see Arena and Node.max_uct_child).
+        # rave, if given, turns on RAVE with that equivalence parameter
+        # (see Node.value and RAVE_EQUIVALENCE), which doesn't work with
+        # batched rollouts or shared symmetries.
+        #
+        # policy and cutoff, if given, set how rollouts play their games
+        # (see playout.Playout), which is otherwise with uniformly
+        # random moves to the end of the game, and can't be changed for
+        # batched rollouts.
+        assert book is None or book.geometry is geometry
+        assert rave is None or batch_size is None
+        assert batch_size is None or (policy is None and cutoff is None)
+        assert parallelism in (ROOT_PARALLEL, TREE_PARALLEL)
+        self._geometry = geometry
+        self._random = Random(seed)
+        self._budget = budget if budget is not None else Budget(seconds=SECONDS)
+        self._batch_size = batch_size
+        self._batches = None
+        if batch_size is not None:
+            self._batches = [BatchRollouts(geometry, batch_size, None if seed is None else seed + i)
+                             for i in range(workers or 1)]
+        self._batch = None if batch_size is None else self._batches[0]
+        self._policy = policy
+        self._cutoff = cutoff
+        self._playout = None
+        if policy is not None or cutoff is not None:
+            self._playout = Playout(geometry, UNIFORM if policy is None else policy, cutoff, rng=self._random)
+        self._workers = workers
+        self._parallelism = parallelism
+        self._seed = seed
+        self._share = share
+        self._rave = rave
+        self._pool = None
+        self._book = book
+        self._arena = Arena(geometry, capacity, tablebase, share, rave, memory)
+        self._root = Node(core.EMPTY_BOARD, arena=self._arena)
+
+    def get_next_board(self, board, cancel=None, progress=None, budget: Budget = None):
+        # cancel, if given, is a threading.Event that stops the search
+        # with BudgetExceeded when set. progress, if given, is called
+        # with the search's Stats as the search goes. budget, if given,
+        # is used instead of the tree's budget for this search.
+        next_board = self._look_up(board)
+        if next_board is not None:
+            return next_board
+
+        if budget is None:
+            budget = self._budget
         stats = Stats()
 
         t1 = time()
-        self._root = mcts(self._root, stats)
+        if self._workers is not None and self._parallelism == ROOT_PARALLEL:
+            if self._pool is None:
+                self._pool = Pool(self._workers)
+            next_board = root_parallel_mcts(board, self._geometry, stats, budget, self._pool, cancel, self._seed,
+                                            self._batch_size, self._share, self._rave, self._policy, self._cutoff)
+            if progress is not None:
+                progress(stats)
+        else:
+            self._update_root(board)
+            if self._workers is not None:
+                best_child = tree_parallel_mcts(self._root, stats, budget, self._workers, cancel, progress,
+                                                self._batches, self._playout, self._random)
+            else:
+                best_child = mcts(self._root, stats, budget, cancel, progress, self._batch, self._playout,
+                                  self._random)
+            if best_child is None:
+                # The arena had no room for the root's children.
+                next_board = self._geometry.add_move(get_moves(board, self._geometry)[0], board)
+            else:
+                self._root = best_child
+                next_board = self._get_game_board(board, best_child.board())
         t2 = time()
 
         # noinspection PyUnusedLocal
@@ -36,23 +153,88 @@ class Tree:
         # noinspection PyUnreachableCode
         if __debug__:
             print('MCTS')
+            stop = ' (proven)' if stats.proven else ' (stopped early)' if stats.stopped_early else ''
+            print(f'Iterations: {stats.iterations}{stop}')
             print(f'Nodes visited: {stats.visited}')
+            print(f'Simulations: {stats.simulations}')
             print(f'Search time: {total:.3f} ms')
-            print(f'Rate: {(stats.visited / total):.1f} nodes visited / ms')
+            print(f'Rate: {(stats.visited / total):.1f} nodes visited / ms, '
+                  f'{(stats.simulations / total):.1f} simulations / ms')
+            print()
+
+        return next_board
+
+    def ponder(self, board, cancel, progress=None):
+        # Runs iterations from the board, where it is the opponent's
+        # turn, until cancel is set. The statistics of the child for the
+        # opponent's move are then kept by the search after that move.
+        if self._workers is not None and self._parallelism == ROOT_PARALLEL:
+            return
+        self._update_root(board)
+        if self._root.has_outcome():
+            return
+
+        stats = Stats()
+        ponder(self._root, stats, cancel, progress, self._batch, self._playout, self._random)
+
+        # noinspection PyUnreachableCode
+        if __debug__:
+            print('MCTS: Pondering')
+            print(f'Nodes visited: {stats.visited}')
             print()
 
-        return self._root.board()
+    def root(self):
+        return self._root
+
+    def _look_up(self, board):
+        # The next board from the book or the tablebase, or None if
+        # neither has the board.
+        if self._book is not None:
+            next_board = self._book.get_next_board(board)
+            if next_board is not None:
+                # noinspection PyUnreachableCode
+                if __debug__:
+                    print('MCTS: Book move\n')
+                return next_board
+        if self._arena.tablebase is not None:
+            next_board = self._arena.tablebase.get_next_board(board)
+            if next_board is not None:
+                # noinspection PyUnreachableCode
+                if __debug__:
+                    print('MCTS: Tablebase move\n')
+                return next_board
+        return None
+
+    def _get_game_board(self, board, child_board):
+        # A child of the board with the same key as child_board, which is
+        # the board of a child of the board's node. With shared
+        # symmetries, the boards of nodes are only symmetric to those of
+        # the game.
+        get_key = self._arena.get_key
+        key = get_key(child_board)
+        for child in self._geometry.get_children(board):
+            if get_key(child) == key:
+                return child
+        assert False
 
     def _update_root(self, board):
-        if self._root.board() != board:
-            for child in self._root.children():
-                if child.board() == board:
-                    self._root = child
-                    return
+        # Keeps the subtree of the board's node if the tree has one, which
+        # can be any number of moves below the root, e.g. after book moves.
+        index = self._arena.find_node(self._root.index(), board)
+        if index is None:
             # noinspection PyUnreachableCode
             if __debug__:
                 print('MCTS: Replacing tree\n')
-            self._root = Node(board)
+            self._root = Node(board, arena=self._arena)
+        else:
+            self._root = node_at(self._arena, index)
+        self._root = node_at(self._arena, self._arena.collect(self._root.index()))
+
+        # A root that the search proved (see prove) loses its proof if
+        # collect drops its children.
+        root = self._root.index()
+        if self._root.has_outcome() and not self._arena.has_children(root) and get_outcome(self._arena, board) is None:
+            self._arena.leaves[root] = False
 
 
 # ----------------------------------------------------------------------
@@ -61,156 +243,680 @@ class Tree:
 
 UCT_PARAM = sqrt(2)
 
+# A good RAVE equivalence parameter (see Node.value) for tic-tac-toe
+# boards.
+RAVE_EQUIVALENCE = 1000
+
 
 class Node:
+    # A handle for a node stored in an Arena, which holds the node's
+    # outcome (once the game is over there, or once the search proves
+    # it) in vals, its statistics in wins and visits, and the number
+    # of its children that have been visited in expanded. Creating a Node
+    # adds a new node for the board to the arena (or to a new arena if
+    # none is given). Use node_at for a handle to a node that is already
+    # in one.
+
+    __slots__ = ('_arena', '_index')
+
+    def __init__(self, board, geometry: core.Geometry = core.DEFAULT_GEOMETRY, arena: Arena = None):
+        if arena is None:
+            arena = Arena(geometry)
+        outcome = get_outcome(arena, board)
+        self._arena = arena
+        self._index = arena.add(board, outcome is not None, 0 if outcome is None else outcome)
+
+    def __eq__(self, other):
+        return self._arena is other._arena and self._index == other._index
 
-    def __init__(self, board):
-        self._board = board
-        self._outcome = core.check_outcome(self._board)
-        self._children = []
-        self._unvisited_children = []
-        self._wins = 0
-        self._simulations = 0
+    def __hash__(self):
+        return hash(self._index)
 
     def board(self):
-        return self._board
+        return self._arena.boards[self._index]
+
+    def geometry(self):
+        return self._arena.geometry
+
+    def arena(self):
+        return self._arena
+
+    def index(self):
+        return self._index
 
     def children(self):
-        return self._children
+        arena = self._arena
+        return [node_at(arena, index) for index in arena.get_children(self._index)]
 
     def outcome(self):
-        return self._outcome
+        if not self.has_outcome():
+            return None
+        return self._arena.vals[self._index]
 
     def has_outcome(self):
-        return self._outcome is not None
+        return bool(self._arena.leaves[self._index])
 
     def wins(self):
-        return self._wins
+        return self._arena.wins[self._index]
 
     def simulations(self):
-        return self._simulations
+        return self._arena.visits[self._index]
 
     def win_ratio(self):
-        return self._wins / self._simulations
+        return self.wins() / self.simulations()
+
+    def value(self):
+        # The win ratio, or with RAVE, the win ratio blended with the
+        # all-moves-as-first (AMAF) win ratio: that of the simulations
+        # through the node's parent where the player who moved to the
+        # node played the same move at any later point. AMAF statistics
+        # come much faster but are biased, so their weight
+        # sqrt(k / (3n + k)) goes from 1 to 0 as the node's simulations
+        # n grow, and is 1/2 at n = k / 3, where k is the arena's RAVE
+        # equivalence parameter (Gelly and Silver's schedule).
+        return get_value(self._arena, self._index)
 
     def is_X_child(self):
         # If it is O's turn to move, then this node is a child of an X node.
-        return bool(core.turn_bit(self._board))
+        return bool(core.turn_bit(self.board()))
 
     def fully_expanded(self):
-        if self.has_outcome():
+        if self.has_outcome() or not self._create_children():
             return False
-        self._create_children()
-        return not self._unvisited_children
+        arena = self._arena
+        return arena.expanded[self._index] == arena.child_count[self._index]
 
     def _create_children(self):
+        # Returns False if the node has no children because the arena is
+        # full. Where the board has forced moves, only their children are
+        # created (see threats.get_forced_moves), so that neither the
+        # search nor rollouts waste time on moves that lose at once.
         assert not self.has_outcome()
-        if not self._children:
-            assert not self._unvisited_children
-            self._children = [Node(board) for board in core.get_children(self._board)]
-            self._unvisited_children = self._children.copy()
+        arena = self._arena
+        if arena.has_children(self._index):
+            return True
+        geometry = arena.geometry
+        board = self.board()
+        children = []
+        for move in get_moves(board, geometry):
+            child = geometry.add_move(move, board)
+            outcome = get_outcome(arena, child)
+            children.append((child, outcome is not None, 0 if outcome is None else outcome))
+        return arena.add_children(self._index, children)
 
     def max_uct_child(self):
-        logN = log(self._simulations)
-        return max(self._children, key=lambda child: child.uct(logN))
+        # A child that is a proven loss for the player to move (see
+        # prove) is only selected when every child is one.
+        arena = self._arena
+        children, leaves, vals = arena.children, arena.leaves, arena.vals
+        first = arena.first_child[self._index]
+        slots = range(first, first + arena.child_count[self._index])
+        best = self._max_uct_slot(slots)
+        loss = -get_win(self.board())
+        if leaves[children[best]] and vals[children[best]] == loss:
+            slots = [slot for slot in slots if not (leaves[children[slot]] and vals[children[slot]] == loss)]
+            if slots:
+                best = self._max_uct_slot(slots)
+        return node_at(arena, children[best])
+
+    def _max_uct_slot(self, slots):
+        # The slot in the arena's children of the child with the highest
+        # UCT value out of those in the given slots. Works on the arena's
+        # arrays directly, since this is the hot loop of the selection
+        # step. In a tree-parallel search, the visits include the virtual
+        # losses of the paths that other threads are playing out (see
+        # tree_parallel_mcts).
+        #
+        # With shared nodes, a child's statistics include visits from
+        # its other parents. They still estimate its value, but the
+        # exploration term counts only the visits through this node's
+        # link to the child, out of the visits through all of its links.
+        arena = self._arena
+        wins, visits, children = arena.wins, arena.visits, arena.children
+        if arena.edge_visits is None and arena.rave is None:
+            logN = log(visits[self._index])
+            return max(slots, key=lambda slot: (wins[children[slot]] / visits[children[slot]]
+                                                + UCT_PARAM * sqrt(logN / visits[children[slot]])))
+
+        if arena.edge_visits is None:
+            logN = log(visits[self._index])
+            return max(slots, key=lambda slot: (get_value(arena, children[slot])
+                                                + UCT_PARAM * sqrt(logN / visits[children[slot]])))
+
+        edge_visits = arena.edge_visits
+        first = arena.first_child[self._index]
+        logN = log(sum(edge_visits[first:first + arena.child_count[self._index]]))
+        return max(slots,
+                   key=lambda slot: get_value(arena, children[slot]) + UCT_PARAM * sqrt(logN / edge_visits[slot]))
 
     def uct(self, logN):
         # https://en.wikipedia.org/wiki/Monte_Carlo_tree_search#Exploration_and_exploitation
-        return self._wins / self._simulations + UCT_PARAM * sqrt(logN / self._simulations)
+        return self.value() + UCT_PARAM * sqrt(logN / self.simulations())
 
-    def get_unvisited_child(self):
+    def get_unvisited_child(self, rng: Random = None):
+        # Returns None if the node has no children because the arena is
+        # full. The unvisited children are otherwise tied, so one of them
+        # is picked at random, with rng if given, and swapped into place
+        # after the others.
         assert not self.has_outcome()
-        return self._unvisited_children.pop()
-
-    def random_child(self):
-        self._create_children()
-        return self._children[randint(0, len(self._children) - 1)]
+        if not self._create_children():
+            return None
+        arena = self._arena
+        unvisited = arena.child_count[self._index] - arena.expanded[self._index]
+        assert unvisited > 0
+        arena.expanded[self._index] += 1
+        first = arena.first_child[self._index]
+        last = first + unvisited - 1
+        if arena.rave is not None:
+            # With RAVE, the unvisited child with the best AMAF win ratio
+            # is visited first, and swapped into place.
+            children, amaf_wins, amaf_visits = arena.children, arena.amaf_wins, arena.amaf_visits
+            best = max(range(first, last + 1),
+                       key=lambda slot: amaf_wins[children[slot]] / amaf_visits[children[slot]]
+                       if amaf_visits[children[slot]] else 0.5)
+        else:
+            children = arena.children
+            best = first + int((random() if rng is None else rng.random()) * unvisited)
+        children[best], children[last] = children[last], children[best]
+        return node_at(arena, arena.children[last])
 
     def get_best_child(self):
         # https://ai.stackexchange.com/a/17713
-        best_child = max(self._children, key=lambda child: child.simulations())
+        # None if the arena had no room for the children.
+        children = self.children()
+        if not children:
+            return None
+        best_child = children[get_best_index([child.outcome() for child in children],
+                                             [child.simulations() for child in children], self.board())]
 
         # noinspection PyUnreachableCode
         if __debug__:
-            print_children_stats(self._children, best_child)
+            print_children_stats(children, best_child)
 
         return best_child
 
-    def update_stats(self, win):
-        self._wins += win
-        self._simulations += 1
+    def update_stats(self, wins, simulations=1):
+        self._arena.wins[self._index] += wins
+        self._arena.visits[self._index] += simulations
+
+
+def get_outcome(arena: Arena, board):
+    # The board's outcome if the game is over or the arena's tablebase
+    # has it, or else None.
+    outcome = arena.geometry.check_outcome(board)
+    if outcome is None and arena.tablebase is not None:
+        outcome = arena.tablebase.get_outcome(board)
+    return outcome
+
+
+def get_value(arena: Arena, index):
+    # See Node.value.
+    wins = arena.wins[index]
+    visits = arena.visits[index]
+    if arena.rave is None or not arena.amaf_visits[index]:
+        return wins / visits
+    k = arena.rave
+    beta = sqrt(k / (3 * visits + k))
+    return (1 - beta) * wins / visits + beta * arena.amaf_wins[index] / arena.amaf_visits[index]
+
+
+def get_best_index(outcomes, simulations, board):
+    # The index of the child to play from the board given the children's
+    # outcomes (None if unproven) and simulations: the most simulated
+    # child that is a proven win for the player to move, or else the most
+    # simulated child that isn't a proven loss, if there is one.
+    win = get_win(board)
+    indices = [i for i, outcome in enumerate(outcomes) if outcome == win]
+    if not indices:
+        indices = [i for i, outcome in enumerate(outcomes) if outcome != -win] or range(len(outcomes))
+    return max(indices, key=lambda i: simulations[i])
+
+
+def get_win(board):
+    # The outcome that is a win for the player to move on the board. Its
+    # negation is a loss.
+    return core.NEG_INF if core.turn_bit(board) else core.INF
+
+
+def node_at(arena: Arena, index):
+    node = object.__new__(Node)
+    node._arena = arena
+    node._index = index
+    return node
 
 
 def print_children_stats(children, best_child):
     print('MCTS children (wins / simulations):')
     for child in children:
         marker = ''
-        if child is best_child:
+        if child == best_child:
             marker = ' (best child)'
-        print(f'{child.wins()} / {child.simulations()} = {child.win_ratio():.3f}{marker}')
+        print(f'{child.wins()} / {child.simulations()} = {format_ratio(child.wins(), child.simulations())}{marker}')
     print()
 
 
+def format_ratio(wins, simulations):
+    return f'{wins / simulations:.3f}' if simulations else '-'
+
+
 # ----------------------------------------------------------------------
 # MCTS
 # ----------------------------------------------------------------------
 
+# Number of iterations between progress reports.
+PROGRESS_INTERVAL = 100
+
+# Number of iterations between checks for an early stop.
+EARLY_STOP_INTERVAL = 100
+
+
 @dataclass
 class Stats:
     visited = 0
-
-
-def mcts(root: Node, stats: Stats):
-    stop_time = get_time() + 10
-    while get_time() < stop_time:
-        path = get_child(root)
-        outcome = rollout(path[-1])
-        backpropagate(path, outcome)
-        stats.visited += len(path)
+    iterations = 0
+    simulations = 0
+    depth = 0
+    stopped_early = False
+    proven = False
+
+
+def mcts(root: Node, stats: Stats, budget: Budget, cancel=None, progress=None, batch: BatchRollouts = None,
+         playout: Playout = None, rng: Random = None):
+    # Searches from the root (see search) and returns its best child, or
+    # None if the arena has no room for the children.
+    search(root, stats, budget, cancel, progress, batch, playout, rng)
     return root.get_best_child()
 
 
-def get_child(node: Node):
+def search(root: Node, stats: Stats, budget: Budget, cancel=None, progress=None, batch: BatchRollouts = None,
+           playout: Playout = None, rng: Random = None):
+    # Runs iterations until the budget runs out, until the root is
+    # proven (see prove), or until the most visited child of the root
+    # has more visits than any other child could catch up on in the rest
+    # of the budget. There is always at least one iteration. With batch,
+    # each iteration's rollout is a batch of games, and with playout,
+    # its game is played by the playout's policy. rng, if given, is the
+    # random number generator for everything else (see iterate).
+    # progress, if given, is called every PROGRESS_INTERVAL iterations
+    # and at the end.
+    budget.start()
+    simulations_per_iteration = 1 if batch is None else batch.size
+    iterations = 0
+    while not iterations or not budget.exceeded(iterations):
+        if cancel is not None and cancel.is_set():
+            raise BudgetExceeded()
+        iterate(root, stats, batch, playout, rng)
+        iterations += 1
+        stats.iterations = iterations
+        if progress is not None and iterations % PROGRESS_INTERVAL == 0:
+            progress(stats)
+        if root.has_outcome():
+            stats.proven = stats.stopped_early = True
+            break
+        if iterations % EARLY_STOP_INTERVAL == 0:
+            remaining = budget.remaining(iterations)
+            if remaining is not None:
+                remaining *= simulations_per_iteration
+            if remaining != 0 and is_decided(root, remaining):
+                stats.stopped_early = True
+                break
+    if progress is not None and iterations % PROGRESS_INTERVAL:
+        progress(stats)
+
+
+def is_decided(root: Node, remaining):
+    # Whether the most visited child of the root stays the most visited
+    # over at most remaining more simulations (None if unknown).
+    visits = sorted((child.simulations() for child in root.children()), reverse=True)
+    if len(visits) < 2:
+        return len(visits) == 1
+    return remaining is not None and visits[0] - visits[1] > remaining
+
+
+def ponder(root: Node, stats: Stats, cancel, progress=None, batch: BatchRollouts = None, playout: Playout = None,
+           rng: Random = None):
+    iterations = 0
+    while not cancel.is_set() and not root.has_outcome():
+        iterate(root, stats, batch, playout, rng)
+        iterations += 1
+        if progress is not None and iterations % PROGRESS_INTERVAL == 0:
+            progress(stats)
+
+
+def iterate(root: Node, stats: Stats, batch: BatchRollouts = None, playout: Playout = None, rng: Random = None):
+    # rng, if given, picks among unvisited children and plays uniformly
+    # random rollouts, which otherwise use the random module's
+    # generator.
+    path = get_child(root, rng)
+    X_wins, O_wins, simulations, end_board = rollout(path[-1], batch, playout, rng)
+    backpropagate(path, X_wins, O_wins, simulations, end_board)
+    stats.visited += len(path)
+    stats.simulations += simulations
+    stats.depth = max(stats.depth, len(path) - 1)
+
+
+def get_child(node: Node, rng: Random = None):
     path = [node]
     while node.fully_expanded():
         node = node.max_uct_child()
         path.append(node)
     if not node.has_outcome():
-        path.append(node.get_unvisited_child())
+        child = node.get_unvisited_child(rng)
+        if child is not None:
+            path.append(child)
     return path
 
 
-def rollout(node: Node):
-    while not node.has_outcome():
-        node = node.random_child()
-    return node.outcome()
-
-
-def backpropagate(path, outcome):
-    if outcome is core.INF:
-        X_win, O_win = 1, 0
-    elif outcome is core.NEG_INF:
-        X_win, O_win = 0, 1
-    else:
-        assert outcome == 0
-        X_win = O_win = 0.5
-
+def rollout(node: Node, batch: BatchRollouts = None, playout: Playout = None, rng: Random = None):
+    # Returns the X wins and O wins (with a draw counting as half a win
+    # for each) out of the returned number of simulations, which is 1, or
+    # the batch's size with batch, and the board at the end of the game
+    # (None with batch). Only expansion adds nodes to the tree. The rest
+    # of the game is played out on the bare board, by the playout if
+    # there is one.
+    simulations = 1 if batch is None else batch.size
+    if node.has_outcome():
+        X_win, O_win = get_wins(node.outcome())
+        return X_win * simulations, O_win * simulations, simulations, node.board()
+    if playout is not None:
+        X_win, O_win, end_board = playout.play(node.board())
+        return X_win, O_win, 1, end_board
+    if batch is None:
+        outcome, end_board = play_random_game(node.board(), node.geometry(), rng)
+        X_win, O_win = get_wins(outcome)
+        return X_win, O_win, 1, end_board
+    X_wins, O_wins, draws = batch.play(node.board())
+    return X_wins + draws / 2, O_wins + draws / 2, simulations, None
+
+
+def get_wins(outcome):
+    # X's and O's share of a win in a game with the given outcome.
+    if outcome == core.INF:
+        return 1, 0
+    if outcome == core.NEG_INF:
+        return 0, 1
+    assert outcome == 0
+    return 0.5, 0.5
+
+
+def random_game(board, geometry: core.Geometry, rng: Random = None):
+    # Plays uniformly random moves from the board, which must not have an
+    # outcome, until the game ends, and returns the outcome. rng, if
+    # given, is used instead of the random module's generator.
+    return play_random_game(board, geometry, rng)[0]
+
+
+def play_random_game(board, geometry: core.Geometry, rng: Random = None):
+    # Same as random_game, but returns the outcome and the board at the
+    # end of the game (with the turn bit left as it was). Works on
+    # the pieces and the mask of empty cells directly: each move clears
+    # a random number of the lowest empty cells from a copy of the mask
+    # to find its cell, and only the win states through that cell are
+    # checked.
+    X_pieces, O_pieces = geometry.split_board(board)
+    empty = ((1 << geometry.offset) - 1) & ~(X_pieces | O_pieces)
+    empty_count = geometry.count_empty(board)
+    cell_win_states = geometry.cell_win_states
+    O_turn = core.turn_bit(board)
+    outcome = 0
+    next_random = random if rng is None else rng.random
+
+    while empty_count:
+        cells = empty
+        for _ in range(int(next_random() * empty_count)):
+            cells &= cells - 1
+        cell = cells & -cells
+        empty ^= cell
+        empty_count -= 1
+
+        if O_turn:
+            O_pieces |= cell
+            pieces = O_pieces
+        else:
+            X_pieces |= cell
+            pieces = X_pieces
+        for state in cell_win_states[cell.bit_length() - 1]:
+            if pieces & state == state:
+                outcome = core.NEG_INF if O_turn else core.INF
+                break
+        if outcome:
+            break
+        O_turn = not O_turn
+
+    # split_board leaves O's pieces above X's in X_pieces, which O_pieces
+    # has too.
+    return outcome, ((X_pieces | O_pieces << geometry.offset) << 1) | (board & 1)
+
+
+def backpropagate(path, X_wins, O_wins, simulations=1, end_board=None):
+    # Adds the results of a rollout from the last node of the path to
+    # each node's statistics, where a node's wins are those of the player
+    # who moved to it, and with shared nodes, to those of each link
+    # along the path. With RAVE and the board at the end of the game,
+    # also adds them to the AMAF statistics of each child of a node on
+    # the path whose move the player to move there played later in the
+    # game (see Node.value).
     if path[0].is_X_child():
-        curr_win, next_win = X_win, O_win
+        curr_wins, next_wins = X_wins, O_wins
     else:
-        curr_win, next_win = O_win, X_win
-
-    for node in path:
-        node.update_stats(curr_win)
-        curr_win, next_win = next_win, curr_win
+        curr_wins, next_wins = O_wins, X_wins
 
+    arena = path[0].arena()
+    rave = arena.rave is not None and end_board is not None
+    if rave:
+        boards, amaf_wins, amaf_visits = arena.boards, arena.amaf_wins, arena.amaf_visits
+        end_pieces = end_board & ~1
 
-def get_time():
-    return round(time(), ndigits=1)
+    for node in path:
+        node.update_stats(curr_wins, simulations)
+        if rave:
+            # A child's move is the piece that it adds to the node's
+            # board. The end board has every move played after the node.
+            board = node.board()
+            for child in arena.get_children(node.index()):
+                if (boards[child] ^ board) & end_pieces:
+                    amaf_wins[child] += next_wins
+                    amaf_visits[child] += simulations
+        curr_wins, next_wins = next_wins, curr_wins
+    add_edge_visits(path, simulations)
+    prove(path)
+
+
+def prove(path):
+    # MCTS-Solver: once the last node of the path has an outcome, proves
+    # the outcomes of the nodes above it that it decides. A node is a
+    # proven win for the player to move there once one of its children
+    # is, and otherwise proven once all of its children are, with the
+    # best of their outcomes for that player. A proven node is a leaf
+    # like a finished game, so the search no longer goes below it, and
+    # its rollouts return its outcome.
+    #
+    # Where there are forced moves, a node only has their children (see
+    # Node._create_children), and they are at least as good as the
+    # moves left out.
+    arena = path[0].arena()
+    leaves, vals = arena.leaves, arena.vals
+    for child, node in zip(reversed(path), reversed(path[:-1])):
+        index = node.index()
+        if not leaves[child.index()] or leaves[index]:
+            return
+        win = get_win(node.board())
+        if vals[child.index()] == win:
+            outcome = win
+        else:
+            children = arena.get_children(index)
+            if not all(leaves[grandchild] for grandchild in children):
+                return
+            outcomes = [vals[grandchild] for grandchild in children]
+            outcome = max(outcomes) if win == core.INF else min(outcomes)
+        leaves[index] = True
+        vals[index] = outcome
+
+
+def add_edge_visits(path, count):
+    arena = path[0].arena()
+    if arena.edge_visits is not None:
+        for parent, child in zip(path, path[1:]):
+            arena.add_edge_visits(parent.index(), child.index(), count)
 
 
 # ----------------------------------------------------------------------
-# Global tree object
+# Parallel MCTS
 # ----------------------------------------------------------------------
 
-tree = Tree()
+# Simulations without wins that a thread adds to each node on its path,
+# per simulation of its rollout, while it plays the rollout out.
+VIRTUAL_LOSS = 1
+
+
+class Pool:
+    # Worker processes for root_parallel_mcts, along with an event that
+    # cancels their searches.
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.cancel = Event()
+        self.executor = ProcessPoolExecutor(workers, initializer=init_worker, initargs=(self.cancel,))
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+# The pool's cancel event, in worker processes.
+worker_cancel = None
+
+
+def init_worker(cancel):
+    global worker_cancel
+    worker_cancel = cancel
+
+
+def root_parallel_mcts(board, geometry: core.Geometry, stats: Stats, budget: Budget, pool: Pool, cancel=None,
+                       seed=None, batch_size=None, share=None, rave=None, policy=None, cutoff=None):
+    # Runs an independent search from the board (see search) in each of
+    # the pool's workers, each with the whole budget, adds up the wins
+    # and simulations of the root's children over all of the searches,
+    # and returns the child board with the most simulations. With seed,
+    # worker i's games use seed + i, so that with a budget of nodes
+    # alone the result is the same every time. With batch_size, each
+    # rollout is a batch of that many games. share and rave are passed
+    # on to each worker's Arena, and policy and cutoff to its Playout.
+    pool.cancel.clear()
+    futures = [
+        pool.executor.submit(search_root, board, geometry.size, geometry.win_length, budget.seconds, budget.nodes,
+                             None if seed is None else seed + i, batch_size, share, rave, policy, cutoff)
+        for i in range(pool.workers)
+    ]
+    pending = futures
+    while pending:
+        if cancel is not None and cancel.is_set():
+            pool.cancel.set()
+            wait(futures)
+            raise BudgetExceeded()
+        _, pending = wait(pending, timeout=WAIT_INTERVAL)
+
+    # Every worker creates the root's children in the same order. A
+    # child proven by any worker is proven.
+    totals = {}
+    for future in futures:
+        children, worker_stats = future.result()
+        for child, wins, simulations, outcome in children:
+            total_wins, total_simulations, total_outcome = totals.get(child, (0, 0, None))
+            totals[child] = (total_wins + wins, total_simulations + simulations,
+                             outcome if total_outcome is None else total_outcome)
+        stats.visited += worker_stats.visited
+        stats.iterations += worker_stats.iterations
+        stats.simulations += worker_stats.simulations
+        stats.depth = max(stats.depth, worker_stats.depth)
+        stats.proven |= worker_stats.proven
+    children = list(totals)
+    best_child = children[get_best_index([totals[child][2] for child in children],
+                                         [totals[child][1] for child in children], board)]
+
+    # noinspection PyUnreachableCode
+    if __debug__:
+        print(f'MCTS children (wins / simulations over {pool.workers} workers):')
+        for child, (wins, simulations, _) in totals.items():
+            marker = ' (best child)' if child == best_child else ''
+            print(f'{wins} / {simulations} = {format_ratio(wins, simulations)}{marker}')
+        print()
+
+    return best_child
+
+
+def search_root(board, size, win_length, seconds, nodes, seed, batch_size, share, rave, policy, cutoff):
+    # Runs in a worker process. Returns the board, wins, simulations
+    # and outcome of each child of the root after a search from the
+    # board, and the search's Stats, or None if the search is
+    # cancelled.
+    rng = Random(seed)
+    geometry = core.get_geometry(size, win_length)
+    batch = None if batch_size is None else BatchRollouts(geometry, batch_size, seed)
+    playout = None
+    if policy is not None or cutoff is not None:
+        playout = Playout(geometry, UNIFORM if policy is None else policy, cutoff, rng=rng)
+    root = Node(board, arena=Arena(geometry, share=share, rave=rave))
+    stats = Stats()
+    try:
+        search(root, stats, Budget(seconds, nodes), worker_cancel, batch=batch, playout=playout, rng=rng)
+    except BudgetExceeded:
+        return None
+    return [(child.board(), child.wins(), child.simulations(), child.outcome()) for child in root.children()], stats
+
+
+def tree_parallel_mcts(root: Node, stats: Stats, budget: Budget, threads, cancel=None, progress=None, batches=None,
+                       playout: Playout = None, rng: Random = None):
+    # Same as mcts, except that the given number of threads run the
+    # iterations on the one tree, and only a proven root stops the
+    # search early. batches, if given, has a BatchRollouts for each
+    # thread, and playout and rng, if given, are shared by the threads.
+    #
+    # Selection, expansion and backpropagation hold a lock on the tree,
+    # while rollouts run alongside each other. Until its rollout is
+    # backpropagated, a thread's path counts as lost for VIRTUAL_LOSS
+    # simulations per simulation of the rollout, so that other threads
+    # select other paths instead of waiting on the same result. Since
+    # Python threads share one interpreter lock, only batched rollouts
+    # (whose NumPy operations run without it) overlap much. Thread
+    # scheduling varies from run to run, so the results do too.
+    budget.start()
+    lock = Lock()
+
+    def run(batch):
+        virtual_loss = VIRTUAL_LOSS * (1 if batch is None else batch.size)
+        while True:
+            with lock:
+                if cancel is not None and cancel.is_set():
+                    return
+                if stats.iterations and (budget.exceeded(stats.iterations) or root.has_outcome()):
+                    return
+                path = get_child(root, rng)
+                for node in path:
+                    node.update_stats(0, virtual_loss)
+                add_edge_visits(path, virtual_loss)
+                stats.iterations += 1
+                iterations = stats.iterations
+
+            X_wins, O_wins, simulations, end_board = rollout(path[-1], batch, playout, rng)
+
+            with lock:
+                for node in path:
+                    node.update_stats(0, -virtual_loss)
+                add_edge_visits(path, -virtual_loss)
+                backpropagate(path, X_wins, O_wins, simulations, end_board)
+                stats.visited += len(path)
+                stats.simulations += simulations
+                stats.depth = max(stats.depth, len(path) - 1)
+                if progress is not None and iterations % PROGRESS_INTERVAL == 0:
+                    progress(stats)
+
+    workers = [Thread(target=run, args=(None if batches is None else batches[i],)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if cancel is not None and cancel.is_set():
+        raise BudgetExceeded()
+    if progress is not None:
+        progress(stats)
+    return root.get_best_child()
@@ -4,11 +4,43 @@
 # minimax.py
 # Minimax search with alpha-beta pruning.
 
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait
 from dataclasses import dataclass
+from functools import partial
+from math import isnan
+from multiprocessing import Array, Lock, Value
 from time import time
 
 from . import core
-from .evaluate import eval_board
+from .arena import Arena, CAPACITY
+from .budget import Budget, BudgetExceeded
+from .evaluate import eval_board, eval_connected
+from .threats import get_moves
+
+# ----------------------------------------------------------------------
+# Constants
+# ----------------------------------------------------------------------
+
+# Search depth used when a Tree has no budget.
+DEPTH = 6
+
+# Maximum number of entries kept by a Tree's transposition table.
+TABLE_SIZE = 2 ** 20
+
+# Half-width of the aspiration window around the previous iteration's
+# value during iterative deepening.
+ASPIRATION_WINDOW = 1
+
+# Seconds between budget checks while waiting for parallel workers.
+WAIT_INTERVAL = 0.05
+
+# Width of the null windows used by pvs. Non-outcome values are integers,
+# so a window this wide is empty of possible values.
+NULL_WINDOW = 1
+
+# Number of killer moves kept per ply.
+KILLERS = 2
 
 
 # ----------------------------------------------------------------------
@@ -17,42 +49,178 @@ from .evaluate import eval_board
 
 class Tree:
 
-    def __init__(self):
-        self._root = Node(core.EMPTY_BOARD)
+    def __init__(self, geometry: core.Geometry = core.DEFAULT_GEOMETRY, budget: Budget = None,
+                 table_size=TABLE_SIZE, workers=None, capacity=CAPACITY, use_pvs=False, use_threats=False,
+                 book=None, tablebase=None, memory=None):
+        # Without a budget, every search goes to a fixed depth of DEPTH,
+        # or as deep as fits in the arena if that is less (see ArenaFull).
+        # With workers, the fixed-depth search is split across that many
+        # processes (see parallel_minimax). capacity is the maximum number
+        # of nodes in the tree, or memory, if given, is a limit in bytes
+        # that sets it instead (the transposition table has its own limit
+        # of table_size entries). Between searches, the tree keeps the
+        # subtree of the current board, pruned to its most visited nodes
+        # once it gets big (see Arena.collect). With use_pvs, searches use
+        # principal variation search, with killer and history move
+        # ordering, instead of plain alpha-beta. With use_threats, only
+        # forced moves are searched where there are any (see minimax).
+        # book, if given, is a book.Book whose moves are played without
+        # searching, and so are the moves of tablebase, a
+        # tablebase.Tablebase, whose outcomes are also used at the nodes
+        # it has (see Arena). The workers of a parallel search don't use
+        # the tablebase.
+        assert budget is None or workers is None
+        assert not (use_pvs and workers)
+        assert book is None or book.geometry is geometry
+        self._geometry = geometry
+        self._use_pvs = use_pvs
+        self._use_threats = use_threats
+        self._arena = Arena(geometry, capacity, tablebase, memory=memory)
+        self._root = Node(core.EMPTY_BOARD, arena=self._arena)
+        self._table = TranspositionTable(table_size)
+        self._budget = budget
+        self._workers = workers
+        self._pool = None
+        self._book = book
+
+    def get_next_board(self, board, cancel=None, progress=None, budget: Budget = None):
+        # cancel, if given, is a threading.Event that stops the search
+        # when set. A fixed-depth search then raises BudgetExceeded, and
+        # a budgeted search returns its best result so far. progress, if
+        # given, is called with the search's Stats as the search goes.
+        # budget, if given, is used instead of the tree's budget for this
+        # search.
+        next_board = self._look_up(board)
+        if next_board is not None:
+            return next_board
 
-    def get_next_board(self, board):
         self._update_root(board)
 
+        if budget is None:
+            budget = self._budget
         stats = Stats()
 
         t1 = time()
-        self._root = minimax(self._root, stats, get_best_child=True)
+        if budget is None:
+            if cancel is not None:
+                budget = Budget()
+                budget.start(cancel)
+            try:
+                if self._workers is not None:
+                    if self._pool is None:
+                        self._pool = Pool(self._workers, self._geometry)
+                    best_child, stats.val = parallel_minimax(self._root, stats, self._pool, DEPTH, self._table,
+                                                             budget, self._use_threats)
+                else:
+                    best_child, stats.val = self._get_search()(self._root, stats, depth=DEPTH, get_best_child=True,
+                                                               table=self._table, budget=budget,
+                                                               ordering=self._get_ordering())
+                stats.depth = DEPTH
+                if progress is not None:
+                    progress(stats)
+            except ArenaFull:
+                # The arena has no room for a search to DEPTH, so the
+                # move is from the deepest search that fits.
+                best_child = iterative_deepening(self._root, stats, Budget() if budget is None else budget,
+                                                 self._table, cancel, progress, self._get_search(),
+                                                 self._get_ordering(), DEPTH)
+                if cancel is not None and cancel.is_set():
+                    raise BudgetExceeded()
+        else:
+            best_child = iterative_deepening(self._root, stats, budget, self._table, cancel, progress,
+                                             self._get_search(), self._get_ordering())
         t2 = time()
 
+        if best_child is None:
+            # The arena had no room for the root's children.
+            next_board = self._geometry.add_move(get_moves(board, self._geometry)[0], board)
+        else:
+            self._root = best_child
+            next_board = best_child.get_board()
+
         # noinspection PyUnusedLocal
         total = (t2 - t1) * 10 ** 3
 
         # noinspection PyUnreachableCode
         if __debug__:
             print('Minimax')
+            print(f'Depth: {stats.depth}')
             print(f'Nodes visited: {stats.visited}')
             print(f'Nodes created: {stats.created}')
+            print(f'Table hits: {stats.table_hits} ({len(self._table)} entries)')
+            print(f'Cutoffs: {stats.cutoffs} ({stats.first_move_cutoff_rate():.1%} on the first move)')
+            if self._use_pvs:
+                print(f'Re-searches: {stats.re_searches}')
             print(f'Search time: {total:.3f} ms')
             print(f'Rate: {(stats.visited / total):.1f} nodes visited / ms')
             print()
 
-        return self._root.get_board()
+        return next_board
+
+    def ponder(self, board, cancel, progress=None):
+        # Searches from the board, where it is the opponent's turn, until
+        # cancel is set. The nodes created and the table entries are then
+        # reused by the search after the opponent's move.
+        self._update_root(board)
+        if self._root.is_leaf():
+            return
+
+        stats = Stats()
+        iterative_deepening(self._root, stats, Budget(), self._table, cancel, progress, self._get_search(),
+                            self._get_ordering())
+
+        # noinspection PyUnreachableCode
+        if __debug__:
+            print('Minimax: Pondering')
+            print(f'Depth: {stats.depth}')
+            print(f'Nodes visited: {stats.visited}')
+            print()
+
+    def get_root(self):
+        return self._root
+
+    def get_table(self):
+        return self._table
+
+    def _look_up(self, board):
+        # The next board from the book or the tablebase, or None if
+        # neither has the board.
+        if self._book is not None:
+            next_board = self._book.get_next_board(board)
+            if next_board is not None:
+                # noinspection PyUnreachableCode
+                if __debug__:
+                    print('Minimax: Book move\n')
+                return next_board
+        if self._arena.tablebase is not None:
+            next_board = self._arena.tablebase.get_next_board(board)
+            if next_board is not None:
+                # noinspection PyUnreachableCode
+                if __debug__:
+                    print('Minimax: Tablebase move\n')
+                return next_board
+        return None
+
+    def _get_search(self):
+        return partial(pvs if self._use_pvs else minimax, threats=self._use_threats)
+
+    def _get_ordering(self):
+        # Each search gets a new ordering, since the killer moves are
+        # indexed by ply from the root.
+        return MoveOrdering(self._geometry) if self._use_pvs else None
 
     def _update_root(self, board):
-        if self._root.get_board() != board:
-            for child in self._root.get_children():
-                if child.get_board() == board:
-                    self._root = child
-                    return
+        # Keeps the subtree of the board's node if the tree has one, which
+        # can be any number of moves below the root, e.g. after book moves.
+        index = self._arena.find_node(self._root.get_index(), board)
+        if index is None:
             # noinspection PyUnreachableCode
             if __debug__:
                 print('Minimax: Replacing tree\n')
-            self._root = Node(board)
+            self._root = Node(board, arena=self._arena)
+        else:
+            self._root = node_at(self._arena, index)
+        self._root = node_at(self._arena, self._arena.collect(self._root.get_index()))
 
 
 # ----------------------------------------------------------------------
@@ -60,109 +228,673 @@ class Tree:
 # ----------------------------------------------------------------------
 
 class Node:
+    # A handle for a node stored in an Arena. Creating a Node adds a new
+    # node for the board to the arena (or to a new arena if none is
+    # given). Use node_at for a handle to a node that is already in one.
+
+    __slots__ = ('_arena', '_index')
 
-    def __init__(self, board):
-        self._board = board
+    def __init__(self, board, geometry: core.Geometry = core.DEFAULT_GEOMETRY, arena: Arena = None):
+        if arena is None:
+            arena = Arena(geometry)
+        geometry = arena.geometry
 
-        self._val = core.check_outcome(self._board)
-        self._leaf = self._val is not None
+        val = geometry.check_outcome(board)
+        if val is None and arena.tablebase is not None:
+            val = arena.tablebase.get_outcome(board)
+        leaf = val is not None
+        if not leaf:
+            val = eval_board(board, geometry)
 
-        if not self._leaf:
-            self._val = eval_board(self._board)
+        self._arena = arena
+        self._index = arena.add(board, leaf, val)
 
-        self._children = []
+    def __eq__(self, other):
+        return self._arena is other._arena and self._index == other._index
+
+    def __hash__(self):
+        return hash(self._index)
 
     def is_leaf(self):
-        return self._leaf
+        return self._arena.leaves[self._index]
 
     def is_max_node(self):
-        return not core.turn_bit(self._board)
+        return not core.turn_bit(self._arena.boards[self._index])
 
     def get_board(self):
-        return self._board
+        return self._arena.boards[self._index]
+
+    def get_geometry(self):
+        return self._arena.geometry
+
+    def get_arena(self):
+        return self._arena
+
+    def get_index(self):
+        return self._index
 
     def get_val(self):
-        return self._val
+        return self._arena.vals[self._index]
+
+    def get_visits(self):
+        return self._arena.visits[self._index]
+
+    def add_visit(self):
+        # Visits decide which subtrees are kept when the tree is pruned
+        # (see Arena.compact).
+        self._arena.visits[self._index] += 1
 
     def get_children(self):
-        return self._children
+        arena = self._arena
+        return [node_at(arena, index) for index in arena.get_children(self._index)]
+
+    def create_children(self, threats=False, lines: core.LineCounts = None):
+        # Returns the number of children created, which is 0 if the node
+        # already has children or if the arena is full. With threats, the
+        # children are only those for the board's forced moves when it has
+        # any (see threats.get_forced_moves). lines is the board's
+        # LineCounts, if the caller already has it.
+        arena = self._arena
+        if arena.has_children(self._index):
+            return 0
 
-    def create_children(self):
-        if self._children:
+        geometry = arena.geometry
+        tablebase = arena.tablebase
+        board = arena.boards[self._index]
+        if lines is None:
+            lines = core.LineCounts(geometry, board)
+        children = []
+        for move in get_moves(board, geometry) if threats else geometry.legal_moves(board):
+            child = geometry.add_move(move, board)
+            outcome, X_connected, O_connected = lines.after_move(move)
+            if outcome is None and tablebase is not None:
+                outcome = tablebase.get_outcome(child)
+            if outcome is None:
+                children.append((child, False, eval_connected(child, X_connected, O_connected)))
+            else:
+                children.append((child, True, outcome))
+        children.sort(key=lambda child_fields: child_fields[2], reverse=self.is_max_node())
+
+        if not arena.add_children(self._index, children):
             return 0
-        self._children = [Node(board) for board in core.get_children(self._board)]
-        self._children.sort(key=lambda child: child.get_val(), reverse=self.is_max_node())
-        return len(self._children)
+        return len(children)
+
+
+def node_at(arena: Arena, index):
+    node = object.__new__(Node)
+    node._arena = arena
+    node._index = index
+    return node
+
+
+# ----------------------------------------------------------------------
+# Transposition table
+# ----------------------------------------------------------------------
+
+# Bound types for table entries.
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+Entry = namedtuple('Entry', ['depth', 'val', 'bound', 'move'])
+
+
+class TranspositionTable:
+    # Maps boards to search results. When the table is full, the least
+    # recently used entry is evicted. A result for a board that is
+    # already in the table only replaces the old one if it was searched
+    # at least as deep.
+
+    def __init__(self, size=TABLE_SIZE):
+        assert size > 0
+        self._size = size
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, board):
+        entry = self._entries.get(board)
+        if entry is not None:
+            self._entries.move_to_end(board)
+        return entry
+
+    def put(self, board, depth, val, bound, move):
+        old_entry = self._entries.get(board)
+        if old_entry is not None:
+            if old_entry.depth > depth:
+                return
+        elif len(self._entries) >= self._size:
+            self._entries.popitem(last=False)
+        self._entries[board] = Entry(depth, val, bound, move)
+        self._entries.move_to_end(board)
+
+    def clear(self):
+        self._entries.clear()
+
+
+# ----------------------------------------------------------------------
+# Move ordering
+# ----------------------------------------------------------------------
+
+class MoveOrdering:
+    # Killer moves and history scores for ordering the children of a
+    # node. The killer moves of a ply are the latest moves that caused a
+    # cutoff at that ply (the root is ply 0), and the history score of a
+    # cell, for each player, is the sum of depth ** 2 over the cutoffs
+    # caused by moves there. An ordering is meant to be kept across the
+    # iterations of an iterative deepening search.
+
+    def __init__(self, geometry: core.Geometry = core.DEFAULT_GEOMETRY):
+        self._geometry = geometry
+        self._killers = [[None] * KILLERS for _ in range(geometry.offset + 1)]
+        self._history = [[0] * geometry.offset, [0] * geometry.offset]
+
+    def order(self, node: Node, children, move, ply):
+        # The child for the move from the node's table entry comes first.
+        # The rest are ordered by static value, then by history score,
+        # then by killer rank. Static values are small integers with lots
+        # of ties, which the other two break. (Putting killers before the
+        # static value turned out to visit more nodes.)
+        board = node.get_board()
+        get_move = self._geometry.get_move
+        sign = 1 if node.is_max_node() else -1
+        killers = self._killers[ply]
+        history = self._history[core.turn_bit(board)]
+
+        def score(child):
+            child_move = get_move(board, child.get_board())
+            if child_move == move:
+                return 1, 0, 0, 0
+            killer_rank = KILLERS - killers.index(child_move) if child_move in killers else 0
+            return 0, sign * child.get_val(), history[child_move], killer_rank
+
+        # Sorting in reverse is still stable.
+        return sorted(children, key=score, reverse=True)
+
+    def add_cutoff(self, node: Node, child: Node, ply, depth):
+        board = node.get_board()
+        move = self._geometry.get_move(board, child.get_board())
+        killers = self._killers[ply]
+        if move in killers:
+            killers.remove(move)
+        else:
+            killers.pop()
+        killers.insert(0, move)
+        self._history[core.turn_bit(board)][move] += depth * depth
 
 
 # ----------------------------------------------------------------------
 # Minimax
 # ----------------------------------------------------------------------
 
+class ArenaFull(BudgetExceeded):
+    # Raised by a search when a node above the horizon can't get
+    # children. Its static value isn't the value of a search to that
+    # depth, so the search is abandoned like one that ran out of budget,
+    # before anything is stored in the table.
+    pass
+
+
 @dataclass
 class Stats:
     visited = 0
     created = 0
+    table_hits = 0
+    depth = 0
+    val = 0
+    cutoffs = 0
+    first_move_cutoffs = 0
+    re_searches = 0
+
+    def first_move_cutoff_rate(self):
+        # The fraction of cutoffs that were caused by the first child
+        # searched, which is higher the better the move ordering.
+        return self.first_move_cutoffs / self.cutoffs if self.cutoffs else 0
+
+
+def iterative_deepening(node: Node, stats: Stats, budget: Budget, table: TranspositionTable, cancel=None,
+                        progress=None, search=None, ordering: MoveOrdering = None, max_depth=None):
+    # Searches one ply deeper at a time until the budget runs out (or
+    # cancel is set) and returns the best child from the deepest search
+    # that finished, or None if the arena has no room for the children.
+    # The first ply is always searched in full so that there is a
+    # result. Each search starts with the previous best move, which it
+    # gets from the table, and with a narrow window around the previous
+    # value. progress, if given, is called with the stats after each
+    # finished search. search is minimax (the default) or pvs. A search
+    # that runs out of room in the arena ends the deepening like one
+    # that runs out of budget (see ArenaFull). max_depth, if given, is
+    # the deepest search, which is otherwise to the end of the game.
+
+    if search is None:
+        search = minimax
+
+    budget.start(cancel)
+    try:
+        best_child, val = search(node, stats, depth=1, get_best_child=True, table=table, ordering=ordering)
+    except ArenaFull:
+        return None
+    stats.depth = 1
+    stats.val = val
+    if progress is not None:
+        progress(stats)
+
+    if max_depth is None:
+        max_depth = node.get_geometry().count_empty(node.get_board())
+    for depth in range(2, max_depth + 1):
+        if val in (core.INF, core.NEG_INF):
+            break
+        try:
+            best_child, val = aspiration_search(node, stats, depth, val, table, budget, search, ordering)
+        except BudgetExceeded:
+            break
+        stats.depth = depth
+        stats.val = val
+        if progress is not None:
+            progress(stats)
+
+    return best_child
+
+
+def aspiration_search(node: Node, stats: Stats, depth, prev_val, table: TranspositionTable, budget: Budget,
+                      search=None, ordering: MoveOrdering = None):
+    if search is None:
+        search = minimax
+    alpha, beta = prev_val - ASPIRATION_WINDOW, prev_val + ASPIRATION_WINDOW
+    best_child, val = search(node, stats, alpha, beta, depth, True, table, budget, ordering)
+    if alpha < val < beta:
+        return best_child, val
+    return search(node, stats, depth=depth, get_best_child=True, table=table, budget=budget, ordering=ordering)
+
+
+def minimax(node: Node, stats: Stats, alpha=core.NEG_INF, beta=core.INF, depth=DEPTH, get_best_child=False,
+            table: TranspositionTable = None, budget: Budget = None, ordering: MoveOrdering = None, ply=0,
+            threats=False, parent_lines: core.LineCounts = None):
+    # With threats, nodes with forced moves only get children for those
+    # moves, so forced lines take a few nodes to search instead of a full
+    # width search. Values are then no longer those of a plain depth
+    # limited search, since moves that lose to a threat aren't searched.
+    # parent_lines is the LineCounts of the node's parent, if the caller
+    # has it, which the node's are derived from (see get_lines).
+    stats.visited += 1
+    node.add_visit()
+
+    if budget is not None:
+        budget.check(stats.visited)
 
+    if node.is_leaf() or depth == 0:
+        return node.get_val()
+
+    val, alpha, beta, best_move = probe_table(node, stats, table, depth, alpha, beta, get_best_child)
+    if val is not None:
+        return val
 
-def minimax(node: Node, stats: Stats, alpha=core.NEG_INF, beta=core.INF, depth=6, get_best_child=False):
+    lines = get_lines(node, parent_lines, depth)
+    stats.created += node.create_children(threats, lines)
+    children = order_children(node, best_move, ordering, ply, depth)
+    if not children:
+        raise ArenaFull()
+
+    orig_alpha, orig_beta = alpha, beta
+    best_child = None
+    if node.is_max_node():
+        val = core.NEG_INF
+        for i, child in enumerate(children):
+            child_val = minimax(child, stats, alpha, beta, depth - 1, table=table, budget=budget, ordering=ordering,
+                                ply=ply + 1, threats=threats, parent_lines=lines)
+            if child_val > val:
+                val = child_val
+                best_child = child
+            alpha = max(alpha, val)
+            if alpha >= beta:
+                add_cutoff(node, child, i, stats, ordering, ply, depth)
+                break
+    else:
+        val = core.INF
+        for i, child in enumerate(children):
+            child_val = minimax(child, stats, alpha, beta, depth - 1, table=table, budget=budget, ordering=ordering,
+                                ply=ply + 1, threats=threats, parent_lines=lines)
+            if child_val < val:
+                val = child_val
+                best_child = child
+            beta = min(beta, val)
+            if alpha >= beta:
+                add_cutoff(node, child, i, stats, ordering, ply, depth)
+                break
+
+    store_table(node, table, depth, val, orig_alpha, orig_beta, best_child)
+
+    if get_best_child:
+        # All children are -inf (if max node) or inf (if min node), so
+        # any child will do.
+        if best_child is None:
+            best_child = children[0]
+        return best_child, val
+
+    return val
+
+
+def pvs(node: Node, stats: Stats, alpha=core.NEG_INF, beta=core.INF, depth=DEPTH, get_best_child=False,
+        table: TranspositionTable = None, budget: Budget = None, ordering: MoveOrdering = None, ply=0,
+        threats=False, parent_lines: core.LineCounts = None):
+    # Principal variation search. Returns the same value as minimax, but
+    # only searches the first child with the full window. Each later
+    # child is searched with a null window, which only shows whether it
+    # is better than the best child so far, and searched again with the
+    # full window if it is. While every child so far loses, there is no
+    # null window around an infinite bound, so the full window is used.
     stats.visited += 1
+    node.add_visit()
+
+    if budget is not None:
+        budget.check(stats.visited)
 
     if node.is_leaf() or depth == 0:
         return node.get_val()
 
-    stats.created += node.create_children()
+    val, alpha, beta, best_move = probe_table(node, stats, table, depth, alpha, beta, get_best_child)
+    if val is not None:
+        return val
+
+    lines = get_lines(node, parent_lines, depth)
+    stats.created += node.create_children(threats, lines)
+    children = order_children(node, best_move, ordering, ply, depth)
+    if not children:
+        raise ArenaFull()
 
+    orig_alpha, orig_beta = alpha, beta
     best_child = None
     if node.is_max_node():
         val = core.NEG_INF
-        for child in node.get_children():
-            child_val = minimax(child, stats, alpha, beta, depth - 1)
+        for i, child in enumerate(children):
+            if i == 0 or alpha == core.NEG_INF:
+                child_val = pvs(child, stats, alpha, beta, depth - 1, False, table, budget, ordering, ply + 1, threats,
+                                lines)
+            else:
+                child_val = pvs(child, stats, alpha, alpha + NULL_WINDOW, depth - 1, False, table, budget, ordering,
+                                ply + 1, threats, lines)
+                if alpha < child_val < beta:
+                    stats.re_searches += 1
+                    child_val = pvs(child, stats, alpha, beta, depth - 1, False, table, budget, ordering, ply + 1,
+                                    threats, lines)
             if child_val > val:
                 val = child_val
                 best_child = child
             alpha = max(alpha, val)
             if alpha >= beta:
+                add_cutoff(node, child, i, stats, ordering, ply, depth)
                 break
     else:
         val = core.INF
-        for child in node.get_children():
-            child_val = minimax(child, stats, alpha, beta, depth - 1)
+        for i, child in enumerate(children):
+            if i == 0 or beta == core.INF:
+                child_val = pvs(child, stats, alpha, beta, depth - 1, False, table, budget, ordering, ply + 1, threats,
+                                lines)
+            else:
+                child_val = pvs(child, stats, beta - NULL_WINDOW, beta, depth - 1, False, table, budget, ordering,
+                                ply + 1, threats, lines)
+                if alpha < child_val < beta:
+                    stats.re_searches += 1
+                    child_val = pvs(child, stats, alpha, beta, depth - 1, False, table, budget, ordering, ply + 1,
+                                    threats, lines)
             if child_val < val:
                 val = child_val
                 best_child = child
             beta = min(beta, val)
             if alpha >= beta:
+                add_cutoff(node, child, i, stats, ordering, ply, depth)
                 break
 
+    store_table(node, table, depth, val, orig_alpha, orig_beta, best_child)
+
     if get_best_child:
-        # TODO I think this assertion should fail if all children are
-        #  -inf (if max node) or inf (if min node), so the solution
-        #  would be to just return any child in that case
-        assert best_child is not None
-        return best_child
+        if best_child is None:
+            best_child = children[0]
+        return best_child, val
 
     return val
 
 
-def test_minimax(board, depth):
+def get_lines(node: Node, parent_lines: core.LineCounts, depth):
+    # The node's LineCounts, derived from its parent's if given, or None
+    # if neither the node nor its children will create children. Only
+    # the root of a search builds them from the board.
+    if depth == 1 and node.get_arena().has_children(node.get_index()):
+        return None
+    if parent_lines is None:
+        return core.LineCounts(node.get_geometry(), node.get_board())
+    return parent_lines.after(node.get_geometry().get_move(parent_lines.get_board(), node.get_board()))
+
+
+def probe_table(node: Node, stats: Stats, table: TranspositionTable, depth, alpha, beta, is_root):
+    # Returns the node's value if the table entry for it is enough to
+    # cut off the search (or None), the window narrowed by the entry,
+    # and the entry's best move. There are no cutoffs at the root, which
+    # has to return a best child.
+    if table is None:
+        return None, alpha, beta, None
+    entry = table.get(node.get_board())
+    if entry is None:
+        return None, alpha, beta, None
+    if entry.depth >= depth and not is_root:
+        stats.table_hits += 1
+        if entry.bound == EXACT:
+            return entry.val, alpha, beta, entry.move
+        if entry.bound == LOWER:
+            alpha = max(alpha, entry.val)
+        else:
+            beta = min(beta, entry.val)
+        if alpha >= beta:
+            return entry.val, alpha, beta, entry.move
+    return None, alpha, beta, entry.move
+
+
+def store_table(node: Node, table: TranspositionTable, depth, val, alpha, beta, best_child: Node):
+    # Stores the node's value from a search with the given window.
+    if table is None:
+        return
+    if val <= alpha:
+        bound = UPPER
+    elif val >= beta:
+        bound = LOWER
+    else:
+        bound = EXACT
+    move = None
+    if best_child is not None:
+        move = node.get_geometry().get_move(node.get_board(), best_child.get_board())
+    table.put(node.get_board(), depth, val, bound, move)
+
+
+def add_cutoff(node: Node, child: Node, index, stats: Stats, ordering: MoveOrdering, ply, depth):
+    # Records a cutoff caused by the child at the given index in search
+    # order.
+    stats.cutoffs += 1
+    if index == 0:
+        stats.first_move_cutoffs += 1
+    if ordering is not None:
+        ordering.add_cutoff(node, child, ply, depth)
+
+
+def order_children(node: Node, move, ordering: MoveOrdering, ply, depth):
+    # The children of the node in the order that they are searched, given
+    # the move from its table entry. One ply from the horizon, where the
+    # children's values are their static values, a MoveOrdering gains
+    # too little to pay for its sort.
+    if ordering is None or depth == 1:
+        return move_to_front(node, node.get_children(), move)
+    return ordering.order(node, node.get_children(), move, ply)
+
+
+def ordered_children(node: Node, table: TranspositionTable):
+    # The children of the node in the order minimax searches them.
+    entry = table.get(node.get_board()) if table is not None else None
+    return move_to_front(node, node.get_children(), entry.move if entry is not None else None)
+
+
+def move_to_front(node: Node, children, move):
+    # Returns the children with the child for the given move first.
+    if move is None:
+        return children
+    board = node.get_geometry().add_move(move, node.get_board())
+    for i, child in enumerate(children):
+        if child.get_board() == board:
+            if i == 0:
+                return children
+            return [child] + children[:i] + children[i + 1:]
+    return children
+
+
+def test_minimax(board, depth, geometry=core.DEFAULT_GEOMETRY):
     # Minimax with no caching or pruning, for testing purposes.
 
-    outcome = core.check_outcome(board)
+    outcome = geometry.check_outcome(board)
     if outcome is not None:
         return outcome
 
     if depth == 0:
-        return eval_board(board)
+        return eval_board(board, geometry)
 
-    vals = [test_minimax(child, depth - 1) for child in core.get_children(board)]
+    vals = [test_minimax(child, depth - 1, geometry) for child in geometry.get_children(board)]
     if not core.turn_bit(board):
         return max(core.NEG_INF, *vals)
     return min(core.INF, *vals)
 
 
 # ----------------------------------------------------------------------
-# Global tree object
+# Parallel minimax
 # ----------------------------------------------------------------------
 
-tree = Tree()
+class Pool:
+    # Worker processes for parallel_minimax, along with the bounds they
+    # share: one slot per root child, holding the bound that the child's
+    # search proved on the root's value (NaN until the child is done).
+    # Workers of a search that ran out of budget can't be stopped, so
+    # each search has a new generation, and workers only write bounds
+    # (under the lock) while their search's generation is current.
+
+    def __init__(self, workers, geometry: core.Geometry):
+        self.bounds = Array('d', geometry.offset, lock=False)
+        self.generation = Value('i', 0, lock=False)
+        self.lock = Lock()
+        self.executor = ProcessPoolExecutor(workers, initializer=init_worker,
+                                            initargs=(self.bounds, self.generation, self.lock))
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+# The pool's shared bounds, generation and lock, in worker processes.
+worker_bounds = None
+worker_generation = None
+worker_lock = None
+
+
+def init_worker(bounds, generation, lock):
+    global worker_bounds, worker_generation, worker_lock
+    worker_bounds = bounds
+    worker_generation = generation
+    worker_lock = lock
+
+
+def parallel_minimax(node: Node, stats: Stats, pool: Pool, depth=DEPTH, table: TranspositionTable = None,
+                     budget: Budget = None, threats=False):
+    # Same as minimax(node, stats, depth=depth, get_best_child=True,
+    # table=table, threats=threats), with the same best child and value,
+    # but searches the root's children in parallel. The first child is
+    # searched here first, so that the workers start with its value as a
+    # bound. Each later child is searched with the best bound proved by
+    # the children before it (in search order) that are done by the time
+    # its search starts. The budget only applies to the search of the
+    # first child and to the wait for the workers.
+
+    stats.visited += 1
+    node.add_visit()
+    if node.is_leaf() or depth == 0:
+        return None, node.get_val()
+
+    stats.created += node.create_children(threats)
+    children = ordered_children(node, table)
+    if not children:
+        raise ArenaFull()
+    is_max_node = node.is_max_node()
+    geometry = node.get_geometry()
+
+    with pool.lock:
+        pool.generation.value += 1
+        for i in range(len(children)):
+            pool.bounds[i] = float('nan')
+    generation = pool.generation.value
+
+    first_bound = core.NEG_INF if is_max_node else core.INF
+    first_val = minimax(children[0], stats, depth=depth - 1, table=table, budget=budget, threats=threats)
+    pool.bounds[0] = first_val
+
+    futures = [
+        pool.executor.submit(search_child, child.get_board(), geometry.size, geometry.win_length, i, depth - 1,
+                             is_max_node, threats, generation)
+        for i, child in enumerate(children) if i > 0
+    ]
+    results = [(first_val, first_bound)]
+    for future in futures:
+        if budget is not None:
+            while not wait([future], timeout=WAIT_INTERVAL).done:
+                if budget.exceeded(stats.visited):
+                    for pending in futures:
+                        pending.cancel()
+                    raise BudgetExceeded()
+        val, bound, visited, created = future.result()
+        results.append((val, bound))
+        stats.visited += visited
+        stats.created += created
+
+    if is_max_node:
+        val = max(max(child_val, bound) for child_val, bound in results)
+        exact = [child_val > bound for child_val, bound in results]
+    else:
+        val = min(min(child_val, bound) for child_val, bound in results)
+        exact = [child_val < bound for child_val, bound in results]
+
+    # The first child whose value is exactly the root's value is the one
+    # that minimax would pick. If there is none, every child loses, and
+    # minimax picks the first one.
+    best_child = children[0]
+    for child, (child_val, _), is_exact in zip(children, results, exact):
+        if is_exact and child_val == val:
+            best_child = child
+            break
+
+    if table is not None:
+        table.put(node.get_board(), depth, val, EXACT, geometry.get_move(node.get_board(), best_child.get_board()))
+
+    return best_child, val
+
+
+def search_child(board, size, win_length, index, depth, is_max_root, threats, generation):
+    # Runs in a worker process. Returns the child's value from a search
+    # bounded by the earlier children's bounds, the bound, and the
+    # number of nodes visited and created, or None if the search of the
+    # given generation is over (see Pool).
+
+    with worker_lock:
+        if worker_generation.value != generation:
+            return None
+        known_bounds = [bound for bound in worker_bounds[:index] if not isnan(bound)]
+    stats = Stats()
+    node = Node(board, core.get_geometry(size, win_length))
+    table = TranspositionTable()
+
+    if is_max_root:
+        bound = max(known_bounds, default=core.NEG_INF)
+        val = minimax(node, stats, alpha=bound, depth=depth, table=table, threats=threats)
+        child_bound = max(val, bound)
+    else:
+        bound = min(known_bounds, default=core.INF)
+        val = minimax(node, stats, beta=bound, depth=depth, table=table, threats=threats)
+        child_bound = min(val, bound)
+
+    with worker_lock:
+        if worker_generation.value == generation:
+            worker_bounds[index] = child_bound
+
+    return val, bound, stats.visited, stats.created
@@ -0,0 +1,160 @@
+# Jake Herrmann
+# CS 405
+#
+# playout.py
+# Playout policies for MCTS rollouts.
+
+from math import exp
+from random import Random, random
+
+from . import core
+from .evaluate import get_pattern_evaluator
+
+# ----------------------------------------------------------------------
+# Constants
+# ----------------------------------------------------------------------
+
+# Playout policies (see Playout).
+UNIFORM = 'uniform'
+WIN_BLOCK = 'win-block'
+SOFTMAX = 'softmax'
+
+POLICIES = [UNIFORM, WIN_BLOCK, SOFTMAX]
+
+# Default temperature of SOFTMAX: the difference in evaluations (see
+# evaluate.eval_board) that makes a move e times as likely.
+TEMPERATURE = 1
+
+# The evaluation that gives X a win probability of about 73% (1 / (1 +
+# e^-1)) at a playout's cutoff.
+EVAL_SCALE = 2
+
+
+# ----------------------------------------------------------------------
+# Playout
+# ----------------------------------------------------------------------
+
+class Playout:
+    # Plays games from boards with one of the policies:
+    #
+    # - UNIFORM plays uniformly random moves.
+    # - WIN_BLOCK wins at once if it can, or else blocks the opponent's
+    #   win if there is one, or else plays a uniformly random move.
+    # - SOFTMAX wins and blocks like WIN_BLOCK, or else plays each move
+    #   with a probability proportional to exp(evaluation / temperature),
+    #   where the evaluation is evaluate.eval_board's for the player to
+    #   move.
+    #
+    # With cutoff, a game that lasts cutoff moves is stopped there and
+    # scored by the evaluator instead of played out.
+    #
+    # The wins are found from the win states: each player's threats are
+    # the cells that complete a line of theirs with no enemy pieces, and
+    # only the lines through each new piece can add threats.
+    #
+    # rng, if given, is the random.Random that picks the random moves,
+    # instead of the random module's generator.
+
+    def __init__(self, geometry: core.Geometry = core.DEFAULT_GEOMETRY, policy=WIN_BLOCK, cutoff=None,
+                 temperature=TEMPERATURE, rng: Random = None):
+        assert policy in POLICIES
+        self._geometry = geometry
+        self._policy = policy
+        self._cutoff = cutoff
+        self._temperature = temperature
+        self._random = random if rng is None else rng.random
+        self._evaluator = get_pattern_evaluator(geometry)
+
+    def play(self, board):
+        # Returns X's and O's shares of a win in a game from the board,
+        # which must not have an outcome (with a draw counting as half a
+        # win for each, and a game stopped at the cutoff counting as the
+        # evaluator's win probability for each), and the board at the
+        # end of the game (with the turn bit left as it was).
+        geometry = self._geometry
+        cell_win_states = geometry.cell_win_states
+        full = (1 << geometry.offset) - 1
+        X_pieces, O_pieces = geometry.split_board(board)
+        pieces = [X_pieces & full, O_pieces]
+        empty = full & ~(pieces[0] | pieces[1])
+        empty_count = geometry.count_empty(board)
+        threats = [self._get_threats(pieces[0], pieces[1]), self._get_threats(pieces[1], pieces[0])]
+        mover = core.turn_bit(board)
+        heuristic = self._policy != UNIFORM
+        plies = 0
+
+        while empty_count:
+            if plies == self._cutoff:
+                X_win = self._score(pieces, mover)
+                return X_win, 1 - X_win, self._join(pieces, board)
+
+            if heuristic and threats[mover] & empty:
+                cell = threats[mover] & empty
+                cell &= -cell
+            elif heuristic and threats[1 - mover] & empty:
+                cell = threats[1 - mover] & empty
+                cell &= -cell
+            elif self._policy == SOFTMAX:
+                cell = self._softmax_move(pieces, mover, empty)
+            else:
+                cell = empty
+                for _ in range(int(self._random() * empty_count)):
+                    cell &= cell - 1
+                cell &= -cell
+
+            pieces[mover] |= cell
+            if cell & threats[mover]:
+                return (0, 1, self._join(pieces, board)) if mover else (1, 0, self._join(pieces, board))
+            empty ^= cell
+            empty_count -= 1
+            enemy_pieces = pieces[1 - mover]
+            for state in cell_win_states[cell.bit_length() - 1]:
+                if not state & enemy_pieces:
+                    missing = state & ~pieces[mover]
+                    if missing and not missing & (missing - 1):
+                        threats[mover] |= missing
+            mover = 1 - mover
+            plies += 1
+
+        return 0.5, 0.5, self._join(pieces, board)
+
+    def _get_threats(self, pieces, enemy_pieces):
+        threats = 0
+        for state in self._geometry.win_states:
+            if not state & enemy_pieces:
+                missing = state & ~pieces
+                if missing and not missing & (missing - 1):
+                    threats |= missing
+        return threats
+
+    def _softmax_move(self, pieces, mover, empty):
+        evaluate = self._evaluator.evaluate
+        offset = self._geometry.offset
+        sign = -1 if mover else 1
+        other_pieces = pieces[1 - mover]
+        cells = []
+        scores = []
+        while empty:
+            cell = empty & -empty
+            empty ^= cell
+            X_pieces, O_pieces = (other_pieces, pieces[mover] | cell) if mover else (pieces[mover] | cell, other_pieces)
+            cells.append(cell)
+            scores.append(sign * evaluate(((X_pieces | O_pieces << offset) << 1) | (1 - mover)))
+
+        best = max(scores)
+        weights = [exp((score - best) / self._temperature) for score in scores]
+        target = self._random() * sum(weights)
+        for cell, weight in zip(cells, weights):
+            target -= weight
+            if target < 0:
+                return cell
+        return cells[-1]
+
+    def _score(self, pieces, mover):
+        # X's win probability on the board with the given pieces.
+        offset = self._geometry.offset
+        score = self._evaluator.evaluate(((pieces[0] | pieces[1] << offset) << 1) | mover)
+        return 1 / (1 + exp(-score / EVAL_SCALE))
+
+    def _join(self, pieces, board):
+        return ((pieces[0] | pieces[1] << self._geometry.offset) << 1) | (board & 1)
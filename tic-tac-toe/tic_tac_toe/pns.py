@@ -0,0 +1,324 @@
+# Jake Herrmann
+# CS 405
+#
+# pns.py
+# Depth-first proof-number (df-pn) search for solving positions.
+
+import argparse
+from collections import OrderedDict, namedtuple
+from dataclasses import dataclass
+from time import time
+
+from . import core
+from .budget import Budget, BudgetExceeded
+from .threats import get_moves, get_threats
+
+# ----------------------------------------------------------------------
+# Constants
+# ----------------------------------------------------------------------
+
+# Proof and disproof numbers of proven and disproven nodes. Finite
+# numbers never get anywhere near it.
+PROOF_INF = 10 ** 18
+
+# A child is searched until its number grows to (1 + EPSILON) times the
+# second best child's number rather than just past it, so that the
+# search switches back and forth between children less often.
+EPSILON = 0.25
+
+# Maximum number of entries kept by each of a Solver's tables.
+TABLE_SIZE = 2 ** 20
+
+# Number of nodes visited between progress reports.
+PROGRESS_INTERVAL = 1000
+
+# A proven result: the outcome of the board with best play (core.INF,
+# core.NEG_INF or 0), and a move that gets it (None if the board already
+# has an outcome).
+Result = namedtuple('Result', ['outcome', 'move'])
+
+
+# ----------------------------------------------------------------------
+# Solver
+# ----------------------------------------------------------------------
+
+@dataclass
+class Stats:
+    visited = 0
+
+
+class Solver:
+
+    def __init__(self, geometry: core.Geometry = core.DEFAULT_GEOMETRY, budget: Budget = None,
+                 table_size=TABLE_SIZE, fallback=None):
+        # Without a budget, solve runs until it has a result. fallback, if
+        # given, is a search tree (e.g. a minimax.Tree) whose move
+        # get_next_board plays when the board can't be solved within the
+        # budget. Results stay in the tables between calls.
+        self._geometry = geometry
+        self._budget = budget
+        self._fallback = fallback
+
+        # One table per attacker (indexed by turn bit).
+        self._tables = [ProofTable(table_size), ProofTable(table_size)]
+
+        # cell_images[player][index] is the piece of the player (a turn
+        # bit) in the given cell under each symmetry, so that the images
+        # of a child are those of its parent with one more piece each.
+        self._cell_images = [
+            [[1 << (symmetry[index] + geometry.offset * player) for symmetry in geometry.symmetries]
+             for index in range(geometry.offset)]
+            for player in (0, 1)
+        ]
+
+        self._stats = None
+        self._progress = None
+
+    def get_next_board(self, board, cancel=None, progress=None):
+        # Plays the move from solve, or the fallback's move if there is
+        # no result.
+        result = self.solve(board, cancel, progress)
+        if result is None:
+            assert self._fallback is not None
+            return self._fallback.get_next_board(board, cancel, progress)
+        return self._geometry.add_move(result.move, board)
+
+    def solve(self, board, cancel=None, progress=None):
+        # Returns the board's Result, or None if the budget runs out (or
+        # cancel, a threading.Event, is set) first. progress, if given, is
+        # called with the search's Stats as the search goes.
+        geometry = self._geometry
+        outcome = geometry.check_outcome(board)
+        if outcome is not None:
+            return Result(outcome, None)
+
+        budget = self._budget if self._budget is not None else Budget()
+        budget.start(cancel)
+        self._stats = Stats()
+        self._progress = progress
+
+        mover = core.turn_bit(board)
+        win, loss = (core.NEG_INF, core.INF) if mover else (core.INF, core.NEG_INF)
+
+        t1 = time()
+        try:
+            # The mover can win, or else the other player can, or else
+            # neither can and the board is a draw.
+            if self._prove(board, mover, budget):
+                result = Result(win, self._get_move(board, mover, lambda pn, dn: pn == 0))
+            elif self._prove(board, 1 - mover, budget):
+                result = Result(loss, get_moves(board, geometry)[0])
+            else:
+                result = Result(0, self._get_move(board, 1 - mover, lambda pn, dn: dn == 0))
+        except BudgetExceeded:
+            result = None
+        t2 = time()
+
+        # noinspection PyUnusedLocal
+        total = (t2 - t1) * 10 ** 3
+
+        # noinspection PyUnreachableCode
+        if __debug__:
+            print('Proof-number search')
+            print(f'Result: {result}')
+            print(f'Nodes visited: {self._stats.visited}')
+            print(f'Table entries: {sum(len(table) for table in self._tables)}')
+            print(f'Search time: {total:.3f} ms')
+            print()
+
+        return result
+
+    def _prove(self, board, attacker, budget: Budget):
+        # Whether the attacker (a turn bit) can force a win from the
+        # board.
+        images = [self._geometry.transform_board(board, i) >> 1 for i in range(len(self._geometry.symmetries))]
+        pn, _ = self._mid(board, images, PROOF_INF, PROOF_INF, attacker, budget)
+        return pn == 0
+
+    def _get_move(self, board, attacker, is_result):
+        # The move to the first child whose proof and disproof numbers,
+        # for the given attacker, satisfy is_result(pn, dn).
+        geometry = self._geometry
+        table = self._tables[attacker]
+        for move in get_moves(board, geometry):
+            child = geometry.add_move(move, board)
+            entry = get_terminal(geometry.check_outcome(child), attacker)
+            if entry is None:
+                entry = self._evaluate(child, attacker) or table.get(self._get_key(child))
+            if entry is not None and is_result(*entry):
+                return move
+        assert False
+
+    def _evaluate(self, board, attacker):
+        # The proof and disproof numbers of a board (with no outcome)
+        # whose result the threats on it decide, or None. The player to
+        # move wins with a win or a double threat, and loses if there are
+        # several wins to block. Otherwise, the attacker can't win once
+        # the other player has a piece in every line.
+        geometry = self._geometry
+        threats = get_threats(board, geometry)
+        if threats.wins:
+            mover_wins = True
+        elif threats.blocks & (threats.blocks - 1):
+            mover_wins = False
+        elif threats.double_threats and not threats.blocks:
+            mover_wins = True
+        elif not self._has_open_line(board, attacker):
+            return PROOF_INF, 0
+        else:
+            return None
+        if mover_wins == (core.turn_bit(board) == attacker):
+            return 0, PROOF_INF
+        return PROOF_INF, 0
+
+    def _has_open_line(self, board, attacker):
+        X_pieces, O_pieces = self._geometry.split_board(board)
+        defender_pieces = X_pieces if attacker else O_pieces
+        return any(not (defender_pieces & state) for state in self._geometry.win_states)
+
+    def _mid(self, board, images, pn_threshold, dn_threshold, attacker, budget: Budget):
+        # Expands the board's subtree until its proof number reaches
+        # pn_threshold or its disproof number reaches dn_threshold, and
+        # returns both numbers. images are the pieces of the board under
+        # each symmetry. Boards that the threats on them decide
+        # aren't expanded, and boards with a win to block only get the
+        # child for the block (see threats.get_forced_moves).
+        stats = self._stats
+        stats.visited += 1
+        budget.check(stats.visited)
+        if self._progress is not None and stats.visited % PROGRESS_INTERVAL == 0:
+            self._progress(stats)
+
+        geometry = self._geometry
+        table = self._tables[attacker]
+
+        mover = core.turn_bit(board)
+        key = get_key(images, mover)
+
+        result = self._evaluate(board, attacker)
+        if result is not None:
+            table.put(key, *result)
+            return result
+
+        # No child is a win, since there are no wins. A child can be a full
+        # board, which is a draw that _evaluate disproves.
+        children = []
+        cell_images = self._cell_images[mover]
+        for move in get_moves(board, geometry):
+            child_images = [image | cell_image for image, cell_image in zip(images, cell_images[move])]
+            children.append((geometry.add_move(move, board), child_images, get_key(child_images, 1 - mover)))
+
+        is_or_node = mover == attacker
+        while True:
+            entries = [table.get(child_key) or (1, 1) for _, _, child_key in children]
+            if is_or_node:
+                pn = min(child_pn for child_pn, _ in entries)
+                dn = min(PROOF_INF, sum(child_dn for _, child_dn in entries))
+            else:
+                pn = min(PROOF_INF, sum(child_pn for child_pn, _ in entries))
+                dn = min(child_dn for _, child_dn in entries)
+            if pn >= pn_threshold or dn >= dn_threshold:
+                break
+
+            # Search the most proving child, with thresholds that send
+            # the search back here once another child is clearly the most
+            # proving (see EPSILON).
+            side = 0 if is_or_node else 1
+            best = min(range(len(entries)), key=lambda i: entries[i][side])
+            second = min((entry[side] for i, entry in enumerate(entries) if i != best), default=PROOF_INF)
+            child_pn, child_dn = entries[best]
+            if is_or_node:
+                child_pn_threshold = min(pn_threshold, int(second * (1 + EPSILON)) + 1)
+                child_dn_threshold = min(PROOF_INF, dn_threshold - dn + child_dn)
+            else:
+                child_pn_threshold = min(PROOF_INF, pn_threshold - pn + child_pn)
+                child_dn_threshold = min(dn_threshold, int(second * (1 + EPSILON)) + 1)
+            child, child_images, _ = children[best]
+            self._mid(child, child_images, child_pn_threshold, child_dn_threshold, attacker, budget)
+
+        table.put(key, pn, dn)
+        return pn, dn
+
+    def _get_key(self, board):
+        # Symmetric boards share table entries.
+        return self._geometry.canonical_board(board)[0]
+
+
+def get_key(images, turn_bit):
+    # The table key of a board given its images, which is the same as
+    # its canonical board.
+    return (min(images) << 1) | turn_bit
+
+
+def get_terminal(outcome, attacker):
+    # The proof and disproof numbers of a board with the given outcome.
+    if outcome is None:
+        return None
+    if outcome == (core.NEG_INF if attacker else core.INF):
+        return 0, PROOF_INF
+    return PROOF_INF, 0
+
+
+# ----------------------------------------------------------------------
+# Proof table
+# ----------------------------------------------------------------------
+
+class ProofTable:
+    # Maps boards to (proof number, disproof number). When the table is
+    # full, the least recently used entry is evicted.
+
+    def __init__(self, size=TABLE_SIZE):
+        assert size > 0
+        self._size = size
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, board):
+        entry = self._entries.get(board)
+        if entry is not None:
+            self._entries.move_to_end(board)
+        return entry
+
+    def put(self, board, pn, dn):
+        if board not in self._entries and len(self._entries) >= self._size:
+            self._entries.popitem(last=False)
+        self._entries[board] = (pn, dn)
+        self._entries.move_to_end(board)
+
+
+# ----------------------------------------------------------------------
+# Command line
+# ----------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description='Solve a tic-tac-toe position.')
+    parser.add_argument('moves', nargs='*', type=int, help='cell indices of the moves so far, starting with X')
+    parser.add_argument('--size', type=int, default=core.SIZE)
+    parser.add_argument('--win-length', type=int)
+    parser.add_argument('--nodes', type=int, help='maximum number of nodes to visit')
+    parser.add_argument('--seconds', type=float, help='maximum search time')
+    args = parser.parse_args()
+
+    geometry = core.get_geometry(args.size, args.win_length)
+    board = core.EMPTY_BOARD
+    for move in args.moves:
+        if move not in geometry.legal_moves(board) or geometry.check_outcome(board) is not None:
+            parser.error(f'illegal move: {move}')
+        board = geometry.add_move(move, board)
+
+    budget = None
+    if args.nodes is not None or args.seconds is not None:
+        budget = Budget(args.seconds, args.nodes)
+
+    result = Solver(geometry, budget).solve(board)
+    if result is None:
+        print('Unknown (budget exceeded)')
+    else:
+        outcome = {core.INF: 'X wins', core.NEG_INF: 'O wins', 0: 'Draw'}[result.outcome]
+        print(outcome if result.move is None else f'{outcome}, move {result.move}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# Jake Herrmann
+# CS 405
+#
+# records.py
+# Sorted binary files of per-board records, searched in place with mmap.
+
+import mmap
+import struct
+
+from . import core
+
+# ----------------------------------------------------------------------
+# Constants
+# ----------------------------------------------------------------------
+
+MAGIC = b'TTTR'
+VERSION = 2
+
+# Magic, version, board size, win length, key size, fewest and most
+# empty cells of the boards, value format and record count.
+HEADER = struct.Struct('<4sBBBBHH16sQ')
+
+
+# ----------------------------------------------------------------------
+# Writing
+# ----------------------------------------------------------------------
+
+def write_records(path, geometry: core.Geometry, value_format, records):
+    # Writes a file of the (board, values) pairs in records, where values
+    # is a tuple packed with the struct format value_format. Each board
+    # is stored as a big-endian key just wide enough for the geometry's
+    # boards, so the records sorted by board are also sorted by key
+    # bytes.
+    value_struct = struct.Struct('<' + value_format)
+    key_size = get_key_size(geometry)
+    records = sorted(records)
+    empty_counts = [geometry.count_empty(board) for board, _ in records]
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, geometry.size, geometry.win_length, key_size,
+                            min(empty_counts, default=0), max(empty_counts, default=0), value_format.encode(),
+                            len(records)))
+        for board, values in records:
+            f.write(board.to_bytes(key_size, 'big'))
+            f.write(value_struct.pack(*values))
+
+
+def get_key_size(geometry: core.Geometry):
+    # Bytes per board: two bits per cell plus the turn bit.
+    return (2 * geometry.offset + 1 + 7) // 8
+
+
+# ----------------------------------------------------------------------
+# Reading
+# ----------------------------------------------------------------------
+
+class RecordFile:
+    # A file written by write_records. Only the pages that lookups touch
+    # are read, so opening even a large file is cheap.
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._map = None
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, size, win_length, key_size, min_empty, max_empty, value_format, count = \
+                HEADER.unpack_from(self._map, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f'Not a record file: {path}')
+            self.geometry = core.get_geometry(size, win_length)
+            self.min_empty = min_empty
+            self.max_empty = max_empty
+            self._key_size = key_size
+            self._value_struct = struct.Struct('<' + value_format.rstrip(b'\0').decode())
+            self._record_size = key_size + self._value_struct.size
+            self._count = count
+            if len(self._map) != HEADER.size + count * self._record_size:
+                raise ValueError(f'Truncated record file: {path}')
+        except (ValueError, struct.error):
+            self.close()
+            raise
+
+    def __len__(self):
+        return self._count
+
+    def covers(self, board):
+        # Whether the board has as many empty cells as some board in the
+        # file, which is a quick check before a lookup.
+        return self.min_empty <= self.geometry.count_empty(board) <= self.max_empty
+
+    def get(self, board):
+        # The values for the board, or None if it has no record. A binary
+        # search over the sorted keys.
+        if not self._count:
+            return None
+        key = board.to_bytes(self._key_size, 'big')
+        low, high = 0, self._count
+        while low < high:
+            mid = (low + high) // 2
+            pos = HEADER.size + mid * self._record_size
+            mid_key = self._map[pos:pos + self._key_size]
+            if mid_key < key:
+                low = mid + 1
+            elif mid_key > key:
+                high = mid
+            else:
+                return self._value_struct.unpack_from(self._map, pos + self._key_size)
+        return None
+
+    def items(self):
+        # The (board, values) pairs in order of board.
+        for i in range(self._count):
+            pos = HEADER.size + i * self._record_size
+            board = int.from_bytes(self._map[pos:pos + self._key_size], 'big')
+            yield board, self._value_struct.unpack_from(self._map, pos + self._key_size)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
@@ -0,0 +1,248 @@
+# Jake Herrmann
+# CS 405
+#
+# tablebase.py
+# Endgame tablebases: exact outcomes of positions, found by retrograde
+# analysis.
+
+import argparse
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+
+from . import core
+from .records import RecordFile, write_records
+
+# ----------------------------------------------------------------------
+# Constants
+# ----------------------------------------------------------------------
+
+TABLEBASE_DIR = 'tablebases'
+
+# Outcome (1 if X wins, -1 if O wins, 0 for a draw) and the number of
+# plies to the end of the game with best play, where the winner wins as
+# soon as they can and the loser holds out as long as they can.
+VALUE_FORMAT = 'bB'
+
+# Number of chunks per worker that each layer is split into.
+CHUNKS_PER_WORKER = 4
+
+TablebaseEntry = namedtuple('TablebaseEntry', ['outcome', 'plies'])
+
+OUTCOMES = {1: core.INF, -1: core.NEG_INF, 0: 0}
+SIGNS = {outcome: sign for sign, outcome in OUTCOMES.items()}
+
+
+# ----------------------------------------------------------------------
+# Tablebase
+# ----------------------------------------------------------------------
+
+class Tablebase:
+    # A tablebase file, which has a record for each canonical board (see
+    # core.Geometry.canonical_board) with no outcome, that can come up
+    # in a game and has at most a given number of empty cells. The file
+    # is memory mapped, so loading a tablebase costs next to nothing.
+
+    def __init__(self, path):
+        self._records = RecordFile(path)
+        self.geometry = self._records.geometry
+
+    def __len__(self):
+        return len(self._records)
+
+    def get(self, board):
+        # The TablebaseEntry for the board, or None if the board isn't in
+        # the tablebase.
+        if not self._records.covers(board):
+            return None
+        values = self._records.get(self.geometry.canonical_board(board)[0])
+        if values is None:
+            return None
+        sign, plies = values
+        return TablebaseEntry(OUTCOMES[sign], plies)
+
+    def get_outcome(self, board):
+        entry = self.get(board)
+        return None if entry is None else entry.outcome
+
+    def get_next_board(self, board):
+        # The child of the board that gets its outcome soonest (or puts off
+        # a loss longest), or None if the board isn't in the tablebase.
+        if self.get(board) is None:
+            return None
+        geometry = self.geometry
+        children = geometry.get_children(board)
+        values = []
+        for child in children:
+            outcome = geometry.check_outcome(child)
+            if outcome is None:
+                entry = self.get(child)
+                values.append((SIGNS[entry.outcome], entry.plies))
+            else:
+                values.append((SIGNS[outcome], 0))
+        return children[best_value_index(values, core.turn_bit(board))]
+
+    def close(self):
+        self._records.close()
+
+
+def get_tablebase_path(geometry: core.Geometry, directory=TABLEBASE_DIR):
+    return os.path.join(directory, f'tablebase-{geometry.size}-{geometry.win_length}.bin')
+
+
+def load_tablebase(geometry: core.Geometry, directory=TABLEBASE_DIR):
+    # The tablebase for the geometry, or None if it hasn't been built.
+    path = get_tablebase_path(geometry, directory)
+    if not os.path.exists(path):
+        return None
+    return Tablebase(path)
+
+
+def best_value_index(values, turn_bit):
+    # The index of the best of values, which are (outcome sign, plies)
+    # pairs for the children of a board, for the player to move.
+    player_sign = -1 if turn_bit else 1
+
+    def key(i):
+        sign, plies = values[i]
+        score = player_sign * sign
+        return score, -plies if score > 0 else plies
+
+    return max(range(len(values)), key=key)
+
+
+# ----------------------------------------------------------------------
+# Building
+# ----------------------------------------------------------------------
+
+def build_tablebase(geometry: core.Geometry, path, max_empty=None, workers=None):
+    # Solves every board that can come up in a game, has no outcome and
+    # has at most max_empty empty cells (by default, any number), and
+    # writes the tablebase to path. With workers, each layer of boards
+    # is split across that many processes. Returns the number of boards
+    # in the tablebase.
+    #
+    # The boards are found layer by layer from the empty board, keeping
+    # one canonical board per symmetry class. Every move adds a piece,
+    # so the outcomes can then be found in a single pass back from the
+    # fullest layer, where the outcome of each board follows from those
+    # of its children in the layer before.
+    if max_empty is None:
+        max_empty = geometry.offset
+    layers = get_layers(geometry, workers)
+
+    records = []
+    values = {}
+    for pieces in reversed(range(len(layers))):
+        if geometry.offset - pieces > max_empty:
+            break
+        layer_values = {}
+        for chunk_values in run_chunks(solve_boards, layers[pieces], workers,
+                                       (geometry.size, geometry.win_length, values)):
+            layer_values.update(chunk_values)
+        values = layer_values
+        records += values.items()
+
+        # noinspection PyUnreachableCode
+        if __debug__:
+            print(f'Tablebase: solved {len(values)} boards with {pieces} pieces')
+
+    write_records(path, geometry, VALUE_FORMAT, records)
+    return len(records)
+
+
+def get_layers(geometry: core.Geometry, workers=None):
+    # layers[pieces] is the list of canonical boards with no outcome
+    # that have the given number of pieces and can come up in a game.
+    layers = [[core.EMPTY_BOARD]]
+    while True:
+        layer = set().union(*run_chunks(expand_boards, layers[-1], workers,
+                                        (geometry.size, geometry.win_length, None)))
+        if not layer:
+            return layers
+        layers.append(sorted(layer))
+
+        # noinspection PyUnreachableCode
+        if __debug__:
+            print(f'Tablebase: found {len(layer)} boards with {len(layers) - 1} pieces')
+
+
+def run_chunks(func, boards, workers, state):
+    # Returns the results of func on chunks of boards, which run in
+    # worker processes if there are workers. state is the arguments of
+    # init_worker.
+    if workers is None:
+        init_worker(*state)
+        return [func(boards)]
+    chunk_count = workers * CHUNKS_PER_WORKER
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=state) as executor:
+        return list(executor.map(func, [boards[i::chunk_count] for i in range(chunk_count)]))
+
+
+# The geometry and the previous layer's values, in worker processes
+# (or in this one if there are no workers).
+worker_state = None
+
+
+def init_worker(size, win_length, values):
+    global worker_state
+    worker_state = (core.get_geometry(size, win_length), values)
+
+
+def expand_boards(boards):
+    # The canonical children of the boards that have no outcome.
+    geometry, _ = worker_state
+    children = set()
+    for board in boards:
+        for child in geometry.get_children(board):
+            if geometry.check_outcome(child) is None:
+                children.add(geometry.canonical_board(child)[0])
+    return children
+
+
+def solve_boards(boards):
+    # Maps each of the boards to its (outcome sign, plies) from the
+    # values of its children, which have one more piece.
+    geometry, child_values = worker_state
+    values = {}
+    for board in boards:
+        outcomes = []
+        for child in geometry.get_children(board):
+            outcome = geometry.check_outcome(child)
+            if outcome is None:
+                outcomes.append(child_values[geometry.canonical_board(child)[0]])
+            else:
+                outcomes.append((SIGNS[outcome], 0))
+        sign, plies = outcomes[best_value_index(outcomes, core.turn_bit(board))]
+        values[board] = (sign, plies + 1)
+    return values
+
+
+# ----------------------------------------------------------------------
+# Command line
+# ----------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description='Build an endgame tablebase.')
+    parser.add_argument('--size', type=int, default=3)
+    parser.add_argument('--win-length', type=int)
+    parser.add_argument('--max-empty', type=int, help='most empty cells of a board in the tablebase')
+    parser.add_argument('--workers', type=int, help='number of worker processes')
+    parser.add_argument('--output', help=f'tablebase file (default: in {TABLEBASE_DIR}/, where the game looks for it)')
+    args = parser.parse_args()
+
+    geometry = core.get_geometry(args.size, args.win_length)
+    path = args.output
+    if path is None:
+        os.makedirs(TABLEBASE_DIR, exist_ok=True)
+        path = get_tablebase_path(geometry)
+
+    t1 = time()
+    count = build_tablebase(geometry, path, args.max_empty, args.workers)
+    t2 = time()
+    print(f'Wrote {count} boards to {path} in {t2 - t1:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# Jake Herrmann
+# CS 405
+#
+# threats.py
+# Immediate wins, forced blocks and double threats.
+
+from collections import namedtuple
+
+from . import core
+
+# The threats on a board, as masks of cells (bit i is cell i). wins are
+# the cells where the player to move would complete a line, blocks are
+# the cells where the other player would, and double_threats are the
+# cells where the player to move would make two different wins at once.
+Threats = namedtuple('Threats', ['wins', 'blocks', 'double_threats'])
+
+
+def get_threats(board, geometry: core.Geometry = core.DEFAULT_GEOMETRY):
+    X_pieces, O_pieces = geometry.split_board(board)
+    if core.turn_bit(board):
+        pieces, enemy_pieces = O_pieces, X_pieces
+    else:
+        pieces, enemy_pieces = X_pieces, O_pieces
+
+    wins = 0
+    blocks = 0
+
+    # For each cell that is one of the two empty cells of an open line,
+    # the other empty cells of such lines.
+    partners = {}
+
+    for state in geometry.win_states:
+        if not (enemy_pieces & state):
+            missing = state & ~pieces
+            rest = missing & (missing - 1)
+            if missing and not rest:
+                wins |= missing
+            elif rest and not (rest & (rest - 1)):
+                first = missing ^ rest
+                partners[first] = partners.get(first, 0) | rest
+                partners[rest] = partners.get(rest, 0) | first
+        elif not (pieces & state):
+            missing = state & ~enemy_pieces
+            if missing and not (missing & (missing - 1)):
+                blocks |= missing
+
+    double_threats = 0
+    for cell, cell_partners in partners.items():
+        if cell_partners & (cell_partners - 1):
+            double_threats |= cell
+
+    return Threats(wins, blocks, double_threats)
+
+
+def get_forced_moves(board, geometry: core.Geometry = core.DEFAULT_GEOMETRY):
+    # Returns the only moves worth considering on the board, or None if
+    # there is no threat. These are a winning move, else the moves that
+    # block the other player's wins (if there are several, every move
+    # loses), else a move that makes a double threat, which wins in three
+    # plies. The board must not have an outcome.
+    threats = get_threats(board, geometry)
+    if threats.wins:
+        return [lowest_cell(threats.wins)]
+    if threats.blocks:
+        return list(geometry.get_indices(threats.blocks))
+    if threats.double_threats:
+        return [lowest_cell(threats.double_threats)]
+    return None
+
+
+def get_moves(board, geometry: core.Geometry = core.DEFAULT_GEOMETRY):
+    # The forced moves on the board if there are any, else its legal
+    # moves.
+    forced_moves = get_forced_moves(board, geometry)
+    if forced_moves is None:
+        return geometry.legal_moves(board)
+    return forced_moves
+
+
+def lowest_cell(cells):
+    return (cells & -cells).bit_length() - 1